@@ -1,7 +1,6 @@
 
 from flask import Flask, redirect, request
 from flask_login import LoginManager
-from flask_sqlalchemy import SQLAlchemy
 from flask_wtf.csrf import CSRFProtect
 
 app = Flask(__name__, instance_relative_config=True)
@@ -27,8 +26,10 @@ def page_not_found(e):
 # Enable global CSRF protection for this app
 csrf = CSRFProtect(app)
 
-# Flask-SQLAlchemy
-db = SQLAlchemy(app)
+# Flask-SQLAlchemy (with the connection pool set up from the DB_POOL_* settings)
+from .utils.pool import PooledSQLAlchemy
+
+db = PooledSQLAlchemy(app)
 
 # Flask-Login
 lm = LoginManager()
@@ -39,11 +40,12 @@ lm.login_message_category = 'danger'
 
 # Import the User model
 from . import models
+from .utils import users
 
-# Tell Flask-Login how to load users from the database
+# Tell Flask-Login how to load users (from a short-lived cache in front of the database)
 @lm.user_loader
 def load_user(id):
-    return models.User.query.get(int(id))
+    return users.load(int(id))
 
 # Routing logic is stored in views package
 from .views import *
@@ -0,0 +1,410 @@
+
+# The asyncio server for the developer JSON API (launched by serve_api.py).
+#
+# Only this module needs aiohttp, so the rest of the app runs without it.
+
+from . import app, models
+from .utils import geocode, metrics, validator, weather
+from .views import location as location_views
+from .views import recommendation as recommendation_views
+
+from aiohttp import web
+from concurrent.futures import ThreadPoolExecutor
+from multidict import CIMultiDict
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+import aiohttp
+import asyncio
+import datetime
+import json
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+# Headers that describe a connection rather than a response
+HOP_BY_HOP = {'connection', 'content-length', 'keep-alive', 'transfer-encoding', 'upgrade'}
+
+# How much of a streamed body is gathered on the database thread before it is handed to the event loop
+STREAM_CHUNK_BYTES = 65536
+
+# How many chunks can wait to be written to a client before the database thread stops producing more
+STREAM_QUEUE_SIZE = 4
+
+class Abandoned(Exception):
+    pass
+
+def dispatch(method, path, query_string, headers, body, base_url, remote_addr, send):
+
+    """
+
+    Run a request through the Flask app (on a database thread), passing the response on as it is produced.
+
+    Streamed responses (e.g. ?format=ndjson) are iterated on this same thread, since
+        their request context and database session belong to it.
+
+    Args:
+        send: Called with (status, headers) first, then each chunk of the body, then None (required)
+
+    """
+
+    app_iter = None
+
+    try:
+
+        # The builder sets these from the body and content_type
+        content_type = dict((name.lower(), value) for name, value in headers).get('content-type')
+        headers = [(name, value) for name, value in headers if name.lower() not in ('content-length', 'content-type')]
+
+        environ = EnvironBuilder(
+            path=path, method=method, query_string=query_string, headers=headers, data=body,
+            content_type=content_type, base_url=base_url, environ_overrides={ 'REMOTE_ADDR': remote_addr }
+        ).get_environ()
+
+        app_iter, status, response_headers = run_wsgi_app(app, environ)
+
+        send((int(status.split()[0]), list(response_headers)))
+
+        # Gather small pieces (like single NDJSON lines) into bigger chunks
+        pending = []
+        size = 0
+
+        for piece in app_iter:
+            pending.append(piece)
+            size += len(piece)
+            if size >= STREAM_CHUNK_BYTES:
+                send(b''.join(pending))
+                pending = []
+                size = 0
+
+        if pending:
+            send(b''.join(pending))
+
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+        send(None)
+
+def _in_app_context(function, *args):
+    with app.app_context():
+        return function(*args)
+
+def _import_addresses(user_id, items):
+
+    # The addresses import_locations will geocode (valid items, up to the user's location limit)
+    available = app.config['MAX_LOCATIONS'] - models.Location.query.filter_by(user_id=user_id).count()
+
+    addresses = [
+        x['locationAddress'] for x in items
+        if type(x) is dict and not location_views.validate_address_and_name(x.get('locationAddress'), x.get('locationName'))
+    ]
+
+    return addresses[:max(available, 0)]
+
+class Server(object):
+
+    """
+
+    Serve the /api/<key>/... endpoints from an asyncio event loop.
+
+    The Flask views still answer every request, on a pool of ASYNC_API_DB_THREADS
+        threads (so they keep their validation, limits and responses). Before a
+        view that geocodes an address or fetches a forecast runs, the server makes
+        those calls with aiohttp and stores the answers in the geocode and forecast
+        caches. The view then finds them there and only waits on the database.
+
+    A thread is only held while a view runs, so one process can keep hundreds of
+        requests in flight while they wait on the third-party APIs.
+
+    """
+
+    # Views that geocode an address (and fetch a forecast for it), or fetch forecasts for coordinates
+    PREFETCH = ('location/create', 'location/update', 'locations/import', 'recommendations')
+
+    def __init__(self):
+        self.db_pool = ThreadPoolExecutor(max_workers=app.config['ASYNC_API_DB_THREADS'], thread_name_prefix='api-db')
+        self.timeout = aiohttp.ClientTimeout(total=app.config['FORECAST_FETCH_TIMEOUT'])
+        self.geocode_timeout = aiohttp.ClientTimeout(total=app.config['GEOCODE_FETCH_TIMEOUT'])
+        self.session = None
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.fetches = 0
+        self.fetch_errors = 0
+        self.streams = 0
+
+    async def start(self, api):
+        connector = aiohttp.TCPConnector(limit=app.config['ASYNC_API_MAX_FETCHES'])
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+
+    async def close(self, api):
+        await self.session.close()
+        self.db_pool.shutdown(wait=False)
+
+    async def run_db(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.db_pool, _in_app_context, function, *args)
+
+    async def fetch_json(self, url, timeout=None):
+
+        self.fetches += 1
+
+        async with self.session.get(url, timeout=timeout or self.timeout) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    async def fetch_coordinates(self, api_key, address):
+
+        try:
+            return geocode.parse_response(await self.fetch_json(geocode.request_url(api_key, address), self.geocode_timeout))
+        except Exception:
+            self.fetch_errors += 1
+            return None, None, geocode.FETCH_ERROR, True
+
+    async def fetch_forecast(self, key, lat, lng):
+
+        try:
+            response = await self.fetch_json(weather.request_url(key, lat, lng))
+        except Exception:
+            self.fetch_errors += 1
+            return None, weather.FETCH_ERROR
+
+        if not response:
+            return None, 'The API returned an empty response.'
+
+        return response, None
+
+    async def prefetch_coordinates(self, addresses):
+
+        """
+
+        Geocode addresses the way geocode.get_coordinates_batch does, with the requests made by aiohttp.
+
+        """
+
+        results, pending, api_key = await self.run_db(geocode.reserve_batch, addresses)
+
+        answers = await asyncio.gather(*[self.fetch_coordinates(api_key, group[0]) for group in pending.values()])
+
+        results.update(await self.run_db(geocode.store_batch, pending, dict(zip(pending, answers))))
+
+        return results
+
+    async def prefetch_forecasts(self, cells, checked=None):
+
+        """
+
+        Fetch forecasts the way weather.get_forecasts_for_cells does, with the requests made by aiohttp.
+
+        """
+
+        now = datetime.datetime.now()
+
+        responses, errors, reserved, key = await self.run_db(weather.reserve_cells, cells, None, now, checked)
+
+        answers = await asyncio.gather(*[self.fetch_forecast(key, *weather.cell_center(cell)) for cell in reserved])
+
+        for cell, (response, error) in zip(reserved, answers):
+            if not error:
+                weather.store_response(cell, response, now)
+
+    async def prefetch(self, key, action, payload):
+
+        # Only for valid keys, so that made-up ones can't spend API calls
+        user, error = await self.run_db(validator.validate_developer, key)
+        if error:
+            return
+
+        if action == 'locations/import':
+
+            items = payload.get('locations')
+
+            if type(items) is list and len(items) <= app.config['MAX_LOCATION_IMPORT']:
+                await self.prefetch_coordinates(await self.run_db(_import_addresses, user.id, items))
+
+            # Forecasts for imported locations are fetched in the background anyway
+            return
+
+        if action == 'recommendations':
+
+            items, error = recommendation_views.parse_items(payload.get('coordinates'))
+            if error:
+                return
+
+            cells = set(x for item in recommendation_views.item_cells(items) for x in item)
+
+            # The same limits as the view (the view then finds these cells cached, so they aren't counted twice)
+            checked, error = await self.run_db(recommendation_views.reserve_fetches, user.id, cells)
+            if not error:
+                await self.prefetch_forecasts(cells, checked)
+
+            return
+
+        address, name = payload.get('locationAddress'), payload.get('locationName')
+
+        if location_views.validate_address_and_name(address, name):
+            return
+
+        lat, lng, error = (await self.prefetch_coordinates([address]))[address]
+
+        if not error:
+            await self.prefetch_forecasts([weather.grid_cell(lat, lng)])
+
+    async def handle(self, request):
+
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        try:
+
+            body = await request.read()
+
+            action = request.match_info.get('action')
+
+            if request.method == 'POST' and action in self.PREFETCH:
+
+                try:
+                    payload = json.loads(body)
+                except ValueError:
+                    payload = None
+
+                # The view makes any calls that weren't made here, so a failure only costs time
+                if type(payload) is dict:
+                    try:
+                        await self.prefetch(request.match_info['key'], action, payload)
+                    except Exception:
+                        log.exception('Prefetch for %s failed.', request.path)
+
+            return await self.respond(request, body)
+
+        finally:
+            self.in_flight -= 1
+
+    async def respond(self, request, body):
+
+        """
+
+        Dispatch a request to Flask on a database thread, and write its response to the client.
+
+        Responses with a Content-Length are sent in one piece. Streamed ones are written
+            chunk by chunk as the database thread produces them, and the small queue
+            between the two means a slow client holds back the database thread
+            rather than the whole body piling up in memory.
+
+        """
+
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        abandoned = threading.Event()
+
+        def send(item):
+
+            # Stop producing the body once the client has gone
+            if abandoned.is_set() and item is not None:
+                raise Abandoned()
+
+            asyncio.run_coroutine_threadsafe(chunks.put(item), loop).result()
+
+        future = loop.run_in_executor(self.db_pool, dispatch,
+            request.method, request.path, request.query_string, list(request.headers.items()), body,
+            f'{request.scheme}://{request.host}', request.remote, send
+        )
+
+        finished = False
+
+        try:
+
+            first = await chunks.get()
+
+            # The view failed before it had a response
+            if first is None:
+                finished = True
+                await future
+
+            status, headers = first
+
+            length = any(name.lower() == 'content-length' for name, value in headers)
+            headers = CIMultiDict((name, value) for name, value in headers if name.lower() not in HOP_BY_HOP)
+
+            if length:
+
+                body = []
+                while True:
+                    chunk = await chunks.get()
+                    if chunk is None:
+                        break
+                    body.append(chunk)
+
+                finished = True
+                await future
+
+                return web.Response(status=status, headers=headers, body=b''.join(body))
+
+            self.streams += 1
+
+            response = web.StreamResponse(status=status, headers=headers)
+            await response.prepare(request)
+
+            while True:
+                chunk = await chunks.get()
+                if chunk is None:
+                    break
+                await response.write(chunk)
+
+            finished = True
+            await future
+
+            await response.write_eof()
+
+            return response
+
+        finally:
+
+            # Let the database thread finish (and release its connection) if the client went away
+            if not finished:
+                abandoned.set()
+                loop.create_task(self.drain(chunks, future))
+
+    async def drain(self, chunks, future):
+
+        while await chunks.get() is not None:
+            pass
+
+        try:
+            await future
+        except Abandoned:
+            pass
+        except Exception:
+            log.exception('Abandoned API response failed.')
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "inFlight": self.in_flight,
+            "maxInFlight": self.max_in_flight,
+            "fetches": self.fetches,
+            "fetchErrors": self.fetch_errors,
+            "streams": self.streams
+        }
+
+def create_app():
+
+    """
+
+    Build the aiohttp application for the developer JSON API.
+
+    Requests for /metrics/<token> are answered too, since each process reports its own counters.
+
+    """
+
+    server = Server()
+
+    api = web.Application()
+    api.router.add_route('*', '/api/{key}/{action:.+}', server.handle)
+    api.router.add_route('GET', '/metrics/{token}', server.handle)
+    api.on_startup.append(server.start)
+    api.on_cleanup.append(server.close)
+
+    metrics.register('asyncApi', server.stats)
+
+    return api
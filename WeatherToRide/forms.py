@@ -4,8 +4,8 @@ from . import models
 from flask_wtf import FlaskForm, RecaptchaField
 
 from wtforms import PasswordField, SelectField, SelectMultipleField, StringField, SubmitField
-from wtforms.fields.html5 import EmailField
-from wtforms.validators import DataRequired, Email, EqualTo, Length, ValidationError
+from wtforms.fields.html5 import EmailField, TimeField
+from wtforms.validators import DataRequired, Email, EqualTo, Length, Optional, ValidationError
 from wtforms.widgets import CheckboxInput, ListWidget
 
 class MultiCheckboxField(SelectMultipleField):
@@ -129,3 +129,6 @@ class RouteForm(FlaskForm):
         (5, 'Saturday'), 
         (6, 'Sunday') 
     ])
+
+    depart_time = TimeField('Departure time (optional)', validators=[Optional()])
+    return_time = TimeField('Return time (optional)', validators=[Optional()])
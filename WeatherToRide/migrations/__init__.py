@@ -0,0 +1,149 @@
+
+from .. import db
+
+from sqlalchemy import Column, DateTime, func, Integer, MetaData, select, String, Table
+
+import datetime
+
+# Applied migrations are recorded here (kept out of the models, so db.create_all() leaves it alone)
+metadata = MetaData()
+
+schema_version = Table('schema_version', metadata,
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('description', String(255), nullable=False),
+    Column('applied_at', DateTime, nullable=False)
+)
+
+class Migration(object):
+
+    def __init__(self, version, description, upgrade):
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+
+migrations = []
+
+def migration(version, description):
+
+    """
+
+    Register a function as the migration step for a schema version.
+
+    The function is called with a connection inside of a transaction. Each step
+        should check whether its change is already there before making it, since
+        databases created by db.create_all() may already be partly up to date.
+
+    Args:
+        version: The schema version the step upgrades to (required)
+        description: What the step changes (required)
+
+    """
+
+    def decorator(upgrade):
+        migrations.append(Migration(version, description, upgrade))
+        return upgrade
+
+    return decorator
+
+def head():
+    return max(x.version for x in migrations)
+
+def current_version(connection):
+
+    """
+
+    Get the version of the database's schema (0 if no migrations have been recorded).
+
+    """
+
+    if not db.engine.dialect.has_table(connection, schema_version.name):
+        return 0
+
+    return connection.execute(select([func.max(schema_version.c.version)])).scalar() or 0
+
+def _record(connection, step):
+    connection.execute(schema_version.insert().values(
+        version=step.version,
+        description=step.description,
+        applied_at=datetime.datetime.now()
+    ))
+
+def upgrade(target=None, log=print):
+
+    """
+
+    Bring the database's schema up to date.
+
+    An empty database gets every table from the models, and is marked as up to date.
+        Otherwise, each step newer than the database's version is applied in order,
+        and recorded in the schema_version table along with its changes.
+
+    MySQL commits schema changes as soon as they are made, so a step that fails
+        part way through can't be rolled back there. Since every step checks for
+        its own changes, it is safe to run the upgrade again once the problem is fixed.
+
+    Args:
+        target: The version to stop at (optional, defaults to the newest one)
+        log: Called with a message for each step that is applied (optional)
+
+    Returns:
+        The version of the schema after upgrading
+
+    """
+
+    target = target or head()
+
+    with db.engine.connect() as connection:
+        empty = not db.engine.table_names(connection=connection)
+
+    # A new database gets the current schema straight from the models
+    if empty:
+        db.create_all()
+        metadata.create_all(db.engine)
+
+        with db.engine.begin() as connection:
+            for step in sorted(migrations, key=lambda x: x.version):
+                _record(connection, step)
+
+        log(f'Created a new schema at version {head()}')
+
+        return head()
+
+    metadata.create_all(db.engine)
+
+    with db.engine.connect() as connection:
+        version = current_version(connection)
+
+    for step in sorted(migrations, key=lambda x: x.version):
+
+        if step.version <= version or step.version > target:
+            continue
+
+        log(f'Applying {step.version}: {step.description}')
+
+        with db.engine.begin() as connection:
+            step.upgrade(connection)
+            _record(connection, step)
+
+        version = step.version
+
+    return version
+
+def history():
+
+    """
+
+    List every migration step, along with when it was applied (None if it hasn't been).
+
+    """
+
+    applied = {}
+
+    with db.engine.connect() as connection:
+        if db.engine.dialect.has_table(connection, schema_version.name):
+            applied = { row.version: row.applied_at for row in connection.execute(select([schema_version])) }
+
+    return [(x.version, x.description, applied.get(x.version)) for x in sorted(migrations, key=lambda x: x.version)]
+
+# Register the migration steps
+from . import steps
@@ -0,0 +1,132 @@
+
+from .. import db, models
+
+from ..utils import conditional, outbox, recommendations, weather
+from ..views import location, route
+
+from sqlalchemy import select
+
+import datetime
+import re
+
+def hot_queries(user_id=1, location_ids=(1, 2), route_ids=(1,)):
+
+    """
+
+    Build the queries that run on (nearly) every page view or API call.
+
+    Where a view or util has a query builder, the statement comes from it, so the
+        check can't drift from what actually runs. Each one is named after where
+        it comes from. The parameters only fill in the statements; the plans
+        shouldn't depend on them.
+
+    Returns:
+        A list of (name, statement) tuples
+
+    """
+
+    now = datetime.datetime.now()
+
+    api = models.API.__table__
+    worker = outbox.OutboxWorker()
+
+    queries = [
+        ('load_user', models.User.query.filter(models.User.id == user_id)),
+        ('login (user by email)', models.User.query.filter_by(email='rider@example.com')),
+        ('validator.validate_developer', models.Developer.query.filter_by(key='0' * 32)),
+        ('user.developer', models.Developer.query.filter_by(user_id=user_id)),
+        ('views.location.load_locations', location.locations_query(user_id)),
+        ('views.location.load_locations (page)', location.locations_query(user_id, location_ids[0], 50)),
+        ('views.route.load_routes', route.routes_query(user_id)),
+        ('views.route.load_routes (page)', route.routes_query(user_id, route_ids[0], 50)),
+        ('Forecast.days', models.ForecastDay.query.filter(
+            models.ForecastDay.location_id.in_(location_ids)
+        ).order_by(models.ForecastDay.day)),
+        ('recommendations.load', recommendations.load_query(route_ids, now.date())),
+        ('recommendations.refresh_locations (and cascade.delete_locations)', recommendations.location_routes_query(location_ids)),
+        ('conditional.location_version', conditional.location_aggregates(user_id)),
+        ('conditional.route_version', conditional.route_aggregates(user_id)),
+        ('weather.update_forecasts (neighbors)', weather.neighbors_query([weather.grid_cell(33.5, -86.8)])),
+        ('outbox.claim (due)', worker.due_query(now)),
+        ('outbox.claim (update)', worker.claim_query(location_ids, '0' * 32, now)),
+        ('outbox.claim (claimed)', worker.claimed_query('0' * 32)),
+        ('quota._take', api.update().where(api.c.name == weather.API_NAME).values(calls_today=api.c.calls_today + 1)),
+        ('geocode.lookup', select([models.GeocodeCache.__table__]).where(models.GeocodeCache.address_hash == '0' * 40))
+    ]
+
+    return [(name, getattr(query, 'statement', query)) for name, query in queries]
+
+def explain(connection, statement):
+
+    """
+
+    Get the query plan for a statement on SQLite or MySQL.
+
+    Returns:
+        A list of (table, access, detail) tuples, one per step in the plan
+            (access is 'scan' for a full table or index scan, or 'search')
+
+    """
+
+    compiled = statement.compile(dialect=connection.dialect)
+
+    if compiled.positional:
+        params = tuple(compiled.params[x] for x in compiled.positiontup)
+    else:
+        params = compiled.params
+
+    plan = []
+
+    if connection.dialect.name == 'sqlite':
+
+        for row in connection.execute(f'EXPLAIN QUERY PLAN {compiled}', params):
+
+            # e.g. 'SCAN location', 'SEARCH route USING INDEX ix_route_user_id (user_id=?)'
+            match = re.match(r'(SCAN|SEARCH) (?:TABLE )?(\S+)(?: AS \S+)?', row.detail)
+            if match:
+                plan.append((match.group(2), match.group(1).lower(), row.detail))
+
+    elif connection.dialect.name == 'mysql':
+
+        for row in connection.execute(f'EXPLAIN {compiled}', params):
+
+            # 'ALL' reads the whole table and 'index' the whole index
+            row = dict(row)
+            access = 'scan' if row.get('type') in ('ALL', 'index') else 'search'
+            plan.append((row.get('table'), access, f"type={row.get('type')} key={row.get('key')} rows={row.get('rows')}"))
+
+    else:
+        raise RuntimeError(f'Query plans can only be checked on SQLite or MySQL, not {connection.dialect.name}.')
+
+    return plan
+
+def check(log=print):
+
+    """
+
+    Explain every hot query and report the ones that scan a whole table.
+
+    Run this against a database with a realistic amount of data. On nearly
+        empty tables, MySQL will often choose to scan, even with an index.
+
+    Returns:
+        A list of (name, table, detail) tuples, one for each full scan found
+
+    """
+
+    tables = set(db.metadata.tables)
+    scans = []
+
+    with db.engine.connect() as connection:
+        for name, statement in hot_queries():
+            for table, access, detail in explain(connection, statement):
+
+                # Only real tables count (not derived tables or subqueries)
+                full_scan = access == 'scan' and table in tables
+
+                log(f"{'SCAN' if full_scan else 'ok  '} {name}: {detail}")
+
+                if full_scan:
+                    scans.append((name, table, detail))
+
+    return scans
@@ -0,0 +1,247 @@
+
+from .. import app
+
+from . import migration
+
+from sqlalchemy import Column, Date, DateTime, DECIMAL, ForeignKey, Index, inspect, Integer, MetaData, SmallInteger, String, Table, Text, text
+
+import datetime
+
+# Tables created by a step are defined here as they were at that version,
+#   so that later changes to the models don't change what old steps do
+
+def _frozen():
+
+    metadata = MetaData()
+
+    # Only referenced by foreign keys
+    Table('user', metadata, Column('id', Integer, primary_key=True))
+    Table('location', metadata, Column('id', Integer, primary_key=True))
+    Table('route', metadata, Column('id', Integer, primary_key=True))
+
+    return metadata
+
+def _columns(connection, table):
+    return set(x['name'] for x in inspect(connection).get_columns(table))
+
+def _indexes(connection, table):
+
+    inspector = inspect(connection)
+
+    indexes = set(x['name'] for x in inspector.get_indexes(table))
+    indexes |= set(x['name'] for x in inspector.get_unique_constraints(table))
+
+    return indexes
+
+def _quote(connection, name):
+    return connection.dialect.identifier_preparer.quote(name)
+
+def _remove_duplicates(connection, table, column, keep):
+
+    # Delete every row but one (the lowest or highest ID) for each repeated value
+    rows = connection.execute(text(
+        f'SELECT {_quote(connection, column)} AS value, MIN(id) AS low, MAX(id) AS high FROM {table} '
+        f'GROUP BY {_quote(connection, column)} HAVING COUNT(*) > 1'
+    )).fetchall()
+
+    for row in rows:
+        connection.execute(
+            text(f'DELETE FROM {table} WHERE {_quote(connection, column)} = :value AND id != :keep'),
+            value=row.value, keep=row.low if keep == 'lowest' else row.high
+        )
+
+@migration(1, 'Add updated_at to location and route')
+def add_updated_at(connection):
+
+    for table in ('location', 'route'):
+        if 'updated_at' not in _columns(connection, table):
+            connection.execute(text(f'ALTER TABLE {table} ADD COLUMN updated_at DATETIME NULL'))
+
+@migration(2, 'Move forecast days from the day_N_* columns into forecast_day')
+def add_forecast_day(connection):
+
+    metadata = _frozen()
+
+    forecast_day = Table('forecast_day', metadata,
+        Column('location_id', Integer, ForeignKey('location.id'), primary_key=True, autoincrement=False),
+        Column('day', SmallInteger, primary_key=True, autoincrement=False),
+        Column('icon', String(32)),
+        Column('summary', String(255)),
+        Column('recommendation', SmallInteger)
+    )
+
+    forecast_day.create(connection, checkfirst=True)
+
+    if 'day_0_icon' not in _columns(connection, 'forecast'):
+        return
+
+    # Each location should only have one forecast (keep the newest one)
+    _remove_duplicates(connection, 'forecast', 'location_id', keep='highest')
+
+    # Only the days within the forecast horizon are kept (as update_forecasts would)
+    days = ' UNION ALL '.join(
+        f'SELECT location_id, {i} AS day, day_{i}_icon AS icon, day_{i}_summary AS summary, day_{i}_recommendation AS recommendation FROM forecast'
+        for i in range(min(app.config['FORECAST_DAYS'], 8))
+    )
+
+    # Recommendation levels: 0 = ok, 1 = warn, 2 = danger, NULL = unrecognized weather
+    connection.execute(text(f"""
+        INSERT INTO forecast_day (location_id, day, icon, summary, recommendation)
+        SELECT location_id, day, icon, summary,
+            CASE recommendation
+                WHEN 'Looks like great weather to go for a ride!' THEN 0
+                WHEN 'It should be ok to ride, but be careful!' THEN 1
+                WHEN 'It might be a good idea to take the car instead.' THEN 2
+            END
+        FROM ({days}) AS days
+        WHERE icon IS NOT NULL
+    """))
+
+    # One column at a time, since SQLite can't drop several at once
+    for i in range(8):
+        for field in ('icon', 'summary', 'recommendation'):
+            connection.execute(text(f'ALTER TABLE forecast DROP COLUMN day_{i}_{field}'))
+
+@migration(3, 'Add the geocode_cache table')
+def add_geocode_cache(connection):
+
+    metadata = _frozen()
+
+    Table('geocode_cache', metadata,
+        Column('id', Integer, primary_key=True, autoincrement=True),
+        Column('address_hash', String(40), nullable=False, unique=True),
+        Column('address', String(255), nullable=False),
+        Column('lat', DECIMAL(precision=10, scale=6)),
+        Column('lng', DECIMAL(precision=10, scale=6)),
+        Column('error', String(255)),
+        Column('created_at', DateTime(timezone=True), nullable=False)
+    ).create(connection, checkfirst=True)
+
+@migration(4, 'Add the route_recommendation table')
+def add_route_recommendation(connection):
+
+    metadata = _frozen()
+
+    Table('route_recommendation', metadata,
+        Column('route_id', Integer, ForeignKey('route.id'), primary_key=True, autoincrement=False),
+        Column('day', SmallInteger, primary_key=True, autoincrement=False),
+        Column('date', Date, nullable=False),
+        Column('recommendation', SmallInteger, nullable=False)
+    ).create(connection, checkfirst=True)
+
+    # Rows are filled in for each route the next time one of its forecasts is refreshed
+
+@migration(5, 'Add indexes and uniqueness constraints for the hot queries')
+def add_indexes(connection):
+
+    # Each location has one forecast (keep the newest one)
+    _remove_duplicates(connection, 'forecast', 'location_id', keep='highest')
+
+    # Each API has one usage counter (keep the first one, which the quota has been counting against)
+    _remove_duplicates(connection, 'api', 'name', keep='lowest')
+
+    # Duplicate API keys can't be resolved automatically
+    duplicates = connection.execute(text(
+        f'SELECT COUNT(*) FROM (SELECT {_quote(connection, "key")} FROM developer GROUP BY {_quote(connection, "key")} HAVING COUNT(*) > 1) AS duplicates'
+    )).scalar()
+
+    if duplicates:
+        raise RuntimeError(f'{duplicates} API keys are shared by more than one developer. Give them new keys and run the upgrade again.')
+
+    # The same names db.create_all() gives the indexes declared in models.py
+    indexes = [
+        ('location', 'ix_location_user_id', ['user_id'], False),
+        ('location', 'ix_location_lat_lng', ['lat', 'lng'], False),
+        ('route', 'ix_route_user_id', ['user_id'], False),
+        ('route', 'ix_route_location_id_1', ['location_id_1'], False),
+        ('route', 'ix_route_location_id_2', ['location_id_2'], False),
+        ('forecast', 'ix_forecast_location_id', ['location_id'], True),
+        ('developer', 'ix_developer_user_id', ['user_id'], False),
+        ('developer', 'ix_developer_key', ['key'], True),
+        ('api', 'ix_api_name', ['name'], True)
+    ]
+
+    for table, name, columns, unique in indexes:
+        if name not in _indexes(connection, table):
+            connection.execute(text(
+                f"CREATE {'UNIQUE ' if unique else ''}INDEX {name} ON {table} ({', '.join(_quote(connection, x) for x in columns)})"
+            ))
+
+@migration(6, 'Add the outbox table for queued e-mails')
+def add_outbox(connection):
+
+    metadata = _frozen()
+
+    Table('outbox', metadata,
+        Column('id', Integer, primary_key=True, autoincrement=True),
+        Column('to_address', String(255), nullable=False),
+        Column('subject', String(255), nullable=False),
+        Column('html', Text, nullable=False),
+        Column('created_at', DateTime(timezone=True), nullable=False),
+        Column('attempts', SmallInteger, nullable=False),
+        Column('next_attempt_at', DateTime(timezone=True)),
+        Column('claim', String(32)),
+        Column('last_error', String(255)),
+        Index('ix_outbox_next_attempt_at', 'next_attempt_at'),
+        Index('ix_outbox_claim', 'claim')
+    ).create(connection, checkfirst=True)
+
+@migration(7, 'Add created_at to user')
+def add_user_created_at(connection):
+
+    if 'created_at' not in _columns(connection, 'user'):
+        connection.execute(text(f'ALTER TABLE {_quote(connection, "user")} ADD COLUMN created_at DATETIME NULL'))
+
+        # Existing accounts count as created now, so none are purged before they've had time to confirm
+        connection.execute(text(f'UPDATE {_quote(connection, "user")} SET created_at = :now'), now=datetime.datetime.now())
+
+    if 'ix_user_email_confirmed_created_at' not in _indexes(connection, 'user'):
+        connection.execute(text(
+            f'CREATE INDEX ix_user_email_confirmed_created_at ON {_quote(connection, "user")} (email_confirmed, created_at)'
+        ))
+
+@migration(8, 'Add the numeric scoring fields to forecast_day')
+def add_forecast_day_fields(connection):
+
+    columns = _columns(connection, 'forecast_day')
+
+    # Days saved before this step keep their icon-only recommendation until they're refreshed
+    for name in ('precip_probability', 'precip_intensity', 'wind_speed', 'wind_gust', 'temperature_high', 'temperature_low', 'visibility'):
+        if name not in columns:
+            connection.execute(text(f'ALTER TABLE forecast_day ADD COLUMN {name} FLOAT NULL'))
+
+@migration(9, 'Add route times, packed hourly forecasts and window recommendations')
+def add_route_windows(connection):
+
+    columns = {
+        'route': [('depart_time', 'TIME'), ('return_time', 'TIME')],
+        'forecast': [('hourly_start', 'DATETIME'), ('hourly', 'BLOB')],
+        'route_recommendation': [('depart_recommendation', 'SMALLINT'), ('return_recommendation', 'SMALLINT')]
+    }
+
+    # Forecasts get their hours (and routes their window recommendations) at their next refresh
+    for table, added in columns.items():
+        existing = _columns(connection, table)
+        for name, kind in added:
+            if name not in existing:
+                connection.execute(text(f'ALTER TABLE {table} ADD COLUMN {name} {kind} NULL'))
+
+@migration(10, 'Drop forecast days beyond the forecast horizon')
+def drop_extra_forecast_days(connection):
+
+    # Step 2 used to copy all 8 days, and forecasts saved before the horizon was set kept all of theirs
+    connection.execute(text('DELETE FROM forecast_day WHERE day >= :days'), days=app.config['FORECAST_DAYS'])
+
+@migration(11, 'Add the fetch_budget table for per-developer batch limits')
+def add_fetch_budget(connection):
+
+    metadata = _frozen()
+
+    Table('fetch_budget', metadata,
+        Column('user_id', Integer, ForeignKey('user.id'), primary_key=True, autoincrement=False),
+        Column('fetches', Integer, nullable=False),
+        Column('day', Date, nullable=False)
+    ).create(connection, checkfirst=True)
+
+    # These budgets used to be kept as rows of the api table
+    connection.execute(text("DELETE FROM api WHERE name LIKE 'Batch recommendations %'"))
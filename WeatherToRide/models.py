@@ -1,18 +1,23 @@
 
 from . import db
 
-from flask_login import UserMixin
+from .utils import passwords
 
-from passlib.hash import argon2
+from flask_login import UserMixin
 
-from sqlalchemy import Boolean, Column, DateTime, DECIMAL, ForeignKey, Integer, String
+from sqlalchemy import Boolean, Column, Date, DateTime, DECIMAL, Float, ForeignKey, Index, Integer, LargeBinary, SmallInteger, String, Text, Time
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship
 
+import datetime
+
 class User(db.Model, UserMixin):
 
     __tablename__ = 'user'
 
+    # Finds old unconfirmed accounts (see cascade.purge_unconfirmed)
+    __table_args__ = (Index('ix_user_email_confirmed_created_at', 'email_confirmed', 'created_at'),)
+
     id = Column(Integer, primary_key=True, autoincrement=True)
 
     name = Column(String(32), nullable=False)
@@ -22,6 +27,8 @@ class User(db.Model, UserMixin):
 
     _password = Column('password', String(73), nullable=False)
 
+    created_at = Column(DateTime(timezone=True), default=datetime.datetime.now)
+
     locations = relationship('Location', backref='user', lazy=True)
 
     routes = relationship('Route', backref='user', lazy=True)
@@ -33,14 +40,20 @@ class User(db.Model, UserMixin):
     def password(self):
         return self._password
 
-    # Hash the password before storing it
+    # Hash the password before storing it (off of the request thread, see utils/passwords.py)
     @password.setter
     def password(self, plaintext):
-        self._password = argon2.hash(plaintext)
+        self._password = passwords.hash(plaintext)
 
-    # Check a plaintext candidate against the stored hash
+    # Check a plaintext candidate against the stored hash, upgrading the hash if the cost settings changed
     def validate_password(self, plaintext):
-        return argon2.verify(plaintext, self._password)
+
+        valid, new_hash = passwords.verify(plaintext, self._password)
+
+        if new_hash:
+            self._password = new_hash
+
+        return valid
 
     # Serialize method for JSON API
     def serialize(self):
@@ -60,15 +73,21 @@ class Location(db.Model):
 
     __tablename__ = 'location'
 
+    # Finds the locations in a forecast grid cell (see weather.update_forecasts)
+    __table_args__ = (Index('ix_location_lat_lng', 'lat', 'lng'),)
+
     id = Column(Integer, primary_key=True, autoincrement=True)
 
-    user_id = Column(Integer, ForeignKey('user.id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('user.id'), nullable=False, index=True)
 
     lat = Column(DECIMAL(precision=10, scale=6), nullable=False)
     lng = Column(DECIMAL(precision=10, scale=6), nullable=False)
 
     name = Column(String(32), nullable=False)
 
+    # Used to build cache validators for the JSON API
+    updated_at = Column(DateTime(timezone=True), default=datetime.datetime.now, onupdate=datetime.datetime.now)
+
     forecast = relationship('Forecast', backref='location', lazy=True, uselist=False)
 
     # Serialize method for JSON API
@@ -86,10 +105,13 @@ class Route(db.Model):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
 
-    user_id = Column(Integer, ForeignKey('user.id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('user.id'), nullable=False, index=True)
 
-    location_id_1 = Column(Integer, ForeignKey('location.id'), nullable=False)
-    location_id_2 = Column(Integer, ForeignKey('location.id'), nullable=False)
+    location_id_1 = Column(Integer, ForeignKey('location.id'), nullable=False, index=True)
+    location_id_2 = Column(Integer, ForeignKey('location.id'), nullable=False, index=True)
+
+    location_1 = relationship('Location', foreign_keys=[location_id_1], lazy=True)
+    location_2 = relationship('Location', foreign_keys=[location_id_2], lazy=True)
 
     name = Column(String(32), nullable=False)
 
@@ -101,6 +123,13 @@ class Route(db.Model):
     sat = Column(Boolean, nullable=False, default=False)
     sun = Column(Boolean, nullable=False, default=False)
 
+    # When the route is ridden there and back, in local time (optional)
+    depart_time = Column(Time)
+    return_time = Column(Time)
+
+    # Used to build cache validators for the JSON API
+    updated_at = Column(DateTime(timezone=True), default=datetime.datetime.now, onupdate=datetime.datetime.now)
+
     # Serialize method for JSON API
     def serialize(self):
 
@@ -126,68 +155,111 @@ class Route(db.Model):
             "routeLocation1": self.location_id_1, 
             "routeLocation2": self.location_id_2, 
             "routeName": self.name, 
-            "routeDays": days 
+            "routeDays": days, 
+            "routeDepartTime": self.depart_time.strftime('%H:%M') if self.depart_time else None, 
+            "routeReturnTime": self.return_time.strftime('%H:%M') if self.return_time else None 
         }
 
+# Ride recommendation levels, from best to worst
+RIDE_OK = 0
+RIDE_WARN = 1
+RIDE_DANGER = 2
+
+recommendations = { 
+    RIDE_OK: 'Looks like great weather to go for a ride!', 
+    RIDE_WARN: 'It should be ok to ride, but be careful!', 
+    RIDE_DANGER: 'It might be a good idea to take the car instead.' 
+}
+
 class Forecast(db.Model):
 
     __tablename__ = 'forecast'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
 
-    location_id = Column(Integer, ForeignKey('location.id'), nullable=False)
+    # One forecast per location
+    location_id = Column(Integer, ForeignKey('location.id'), nullable=False, unique=True, index=True)
+
+    updated_at = Column(DateTime(timezone=True))
+
+    # The hourly forecast, packed (see hourly.py), and the location's local time of its first hour
+    hourly_start = Column(DateTime)
+    hourly = Column(LargeBinary)
 
-    day_0_icon = Column(String(32))
-    day_0_summary = Column(String(255))
-    day_0_recommendation = Column(String(255))
+    # One row per forecast day, loaded for every forecast in a query with one extra SELECT
+    days = relationship('ForecastDay', 
+        primaryjoin='Forecast.location_id == foreign(ForecastDay.location_id)', 
+        order_by='ForecastDay.day', lazy='selectin', viewonly=True)
 
-    day_1_icon = Column(String(32))
-    day_1_summary = Column(String(255))
-    day_1_recommendation = Column(String(255))
+    # Serialize method for JSON API
+    def serialize(self):
+        return { 
+            "forecastDays": [x.serialize() for x in self.days], 
+            "lastUpdate": self.updated_at.isoformat() 
+        }
 
-    day_2_icon = Column(String(32))
-    day_2_summary = Column(String(255))
-    day_2_recommendation = Column(String(255))
+class ForecastDay(db.Model):
 
-    day_3_icon = Column(String(32))
-    day_3_summary = Column(String(255))
-    day_3_recommendation = Column(String(255))
+    __tablename__ = 'forecast_day'
 
-    day_4_icon = Column(String(32))
-    day_4_summary = Column(String(255))
-    day_4_recommendation = Column(String(255))
+    location_id = Column(Integer, ForeignKey('location.id'), primary_key=True, autoincrement=False)
 
-    day_5_icon = Column(String(32))
-    day_5_summary = Column(String(255))
-    day_5_recommendation = Column(String(255))
+    # Days from the forecast's first day (0 is the day it was fetched)
+    day = Column(SmallInteger, primary_key=True, autoincrement=False)
 
-    day_6_icon = Column(String(32))
-    day_6_summary = Column(String(255))
-    day_6_recommendation = Column(String(255))
+    icon = Column(String(32))
+    summary = Column(String(255))
 
-    day_7_icon = Column(String(32))
-    day_7_summary = Column(String(255))
-    day_7_recommendation = Column(String(255))
+    # The numeric daily fields the recommendation is scored on (see scoring.py), in Dark Sky's US units
+    precip_probability = Column(Float)
+    precip_intensity = Column(Float)
+    wind_speed = Column(Float)
+    wind_gust = Column(Float)
+    temperature_high = Column(Float)
+    temperature_low = Column(Float)
+    visibility = Column(Float)
 
-    updated_at = Column(DateTime(timezone=True))
+    # A ride recommendation level (None if the weather wasn't recognized)
+    recommendation = Column(SmallInteger)
+
+    @property
+    def recommendation_text(self):
+        return recommendations.get(self.recommendation, 'YOLO!')
 
     # Serialize method for JSON API
     def serialize(self):
+        return { "icon": self.icon, "summary": self.summary, "recommendation": self.recommendation_text }
 
-        days = []
+class RouteRecommendation(db.Model):
 
-        days.append({ "icon": self.day_0_icon, "summary": self.day_0_summary, "recommendation": self.day_0_recommendation })
-        days.append({ "icon": self.day_1_icon, "summary": self.day_1_summary, "recommendation": self.day_1_recommendation })
-        days.append({ "icon": self.day_2_icon, "summary": self.day_2_summary, "recommendation": self.day_2_recommendation })
-        days.append({ "icon": self.day_3_icon, "summary": self.day_3_summary, "recommendation": self.day_3_recommendation })
-        days.append({ "icon": self.day_4_icon, "summary": self.day_4_summary, "recommendation": self.day_4_recommendation })
-        days.append({ "icon": self.day_5_icon, "summary": self.day_5_summary, "recommendation": self.day_5_recommendation })
-        days.append({ "icon": self.day_6_icon, "summary": self.day_6_summary, "recommendation": self.day_6_recommendation })
+    __tablename__ = 'route_recommendation'
 
-        return { 
-            "forecastDays": days, 
-            "lastUpdate": self.updated_at.isoformat() 
-        }
+    route_id = Column(Integer, ForeignKey('route.id'), primary_key=True, autoincrement=False)
+
+    # The forecast day this was combined from (see ForecastDay.day)
+    day = Column(SmallInteger, primary_key=True, autoincrement=False)
+
+    date = Column(Date, nullable=False)
+
+    # The combined ride recommendation level for both of the route's locations
+    #   (the worst of its windows below, when the hourly forecast covers them)
+    recommendation = Column(SmallInteger, nullable=False)
+
+    # The levels for the hours after the route's departure and return times (None if not covered)
+    depart_recommendation = Column(SmallInteger)
+    return_recommendation = Column(SmallInteger)
+
+    @property
+    def recommendation_text(self):
+        return recommendations.get(self.recommendation, 'YOLO!')
+
+    @property
+    def depart_recommendation_text(self):
+        return recommendations.get(self.depart_recommendation)
+
+    @property
+    def return_recommendation_text(self):
+        return recommendations.get(self.return_recommendation)
 
 class API(db.Model):
 
@@ -195,19 +267,74 @@ class API(db.Model):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
 
-    name = Column(String(32), nullable=False)
+    name = Column(String(32), nullable=False, unique=True, index=True)
 
     calls_today = Column(Integer, nullable=False)
     calls_total = Column(Integer, nullable=False)
 
     last_reset = Column(DateTime(timezone=True), nullable=False)
 
+class FetchBudget(db.Model):
+
+    __tablename__ = 'fetch_budget'
+
+    # How many new forecasts a developer's batch recommendations have needed today (see quota.reserve_budget)
+    user_id = Column(Integer, ForeignKey('user.id'), primary_key=True, autoincrement=False)
+
+    fetches = Column(Integer, nullable=False)
+
+    day = Column(Date, nullable=False)
+
+class GeocodeCache(db.Model):
+
+    __tablename__ = 'geocode_cache'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+
+    # SHA-1 of the normalized address
+    address_hash = Column(String(40), nullable=False, unique=True)
+
+    address = Column(String(255), nullable=False)
+
+    # Both are empty if the address couldn't be found
+    lat = Column(DECIMAL(precision=10, scale=6))
+    lng = Column(DECIMAL(precision=10, scale=6))
+
+    error = Column(String(255))
+
+    created_at = Column(DateTime(timezone=True), nullable=False)
+
 class Developer(db.Model):
 
     __tablename__ = 'developer'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
 
-    user_id = Column(Integer, ForeignKey('user.id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('user.id'), nullable=False, index=True)
+
+    key = Column(String(32), nullable=False, unique=True, index=True)
+
+class OutboxMessage(db.Model):
+
+    __tablename__ = 'outbox'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+
+    to_address = Column(String(255), nullable=False)
+
+    subject = Column(String(255), nullable=False)
+
+    html = Column(Text, nullable=False)
+
+    created_at = Column(DateTime(timezone=True), nullable=False)
+
+    # How many times sending has failed
+    attempts = Column(SmallInteger, nullable=False, default=0)
+
+    # When the message should be sent (or retried), empty once it has failed for good
+    next_attempt_at = Column(DateTime(timezone=True), index=True)
+
+    # Set by the worker that is currently sending the message
+    claim = Column(String(32), index=True)
 
-    key = Column(String(32), nullable=False)
+    last_error = Column(String(255))
@@ -0,0 +1,81 @@
+
+import collections
+import threading
+import time
+
+# Returned by TTLCache.get when a key is not cached (None is a valid cached value)
+MISSING = object()
+
+class TTLCache(object):
+
+    """
+
+    A thread-safe, size-bounded LRU cache whose entries expire after a fixed age.
+
+    Args:
+        max_size: The maximum number of entries to hold before evicting the least recently used
+        ttl: How many seconds an entry stays valid (can be overridden per entry)
+
+    Hit and miss counts are kept so that the cache can be sized from real traffic.
+
+    """
+
+    def __init__(self, max_size=1024, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            # Drop the entry if it has outlived its TTL
+            if entry and entry[1] <= now:
+                del self._entries[key]
+                entry = None
+
+            if not entry:
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+
+            # Evict the least recently used entries
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxSize": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRatio": round(self.hits / lookups, 4) if lookups else None
+            }
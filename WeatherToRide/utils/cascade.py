@@ -0,0 +1,156 @@
+
+from .. import db, models
+
+from . import users, validator
+
+from sqlalchemy import and_, or_, select
+
+import datetime
+import logging
+
+log = logging.getLogger(__name__)
+
+# Each function below deletes rows (and everything that depends on them) with a
+#   few set-based statements in the session's transaction. Nothing is committed,
+#   so a caller can combine them and commit once. The ORM objects for deleted rows
+#   are not updated, so expunge any that are still needed before committing.
+#
+# Subqueries only ever read a table other than the one being deleted from,
+#   since MySQL rejects a DELETE that selects from its own table (error 1093).
+
+def _delete(model, condition):
+    return db.session.execute(model.__table__.delete().where(condition)).rowcount
+
+def delete_routes(route_ids):
+
+    """
+
+    Delete routes and their stored recommendations.
+
+    Args:
+        route_ids: A list of route IDs (required)
+
+    """
+
+    if not route_ids:
+        return 0
+
+    _delete(models.RouteRecommendation, models.RouteRecommendation.route_id.in_(route_ids))
+
+    return _delete(models.Route, models.Route.id.in_(route_ids))
+
+def delete_locations(location_ids):
+
+    """
+
+    Delete locations, their forecasts and every route that uses one of them.
+
+    Args:
+        location_ids: A list of location IDs (required)
+
+    """
+
+    if not location_ids:
+        return 0
+
+    routes = select([models.Route.id]).where(or_(
+        models.Route.location_id_1.in_(location_ids), models.Route.location_id_2.in_(location_ids)
+    ))
+
+    # Route recommendations first, while the routes are still there to find them by
+    _delete(models.RouteRecommendation, models.RouteRecommendation.route_id.in_(routes))
+    _delete(models.Route, or_(
+        models.Route.location_id_1.in_(location_ids), models.Route.location_id_2.in_(location_ids)
+    ))
+
+    _delete(models.ForecastDay, models.ForecastDay.location_id.in_(location_ids))
+    _delete(models.Forecast, models.Forecast.location_id.in_(location_ids))
+
+    return _delete(models.Location, models.Location.id.in_(location_ids))
+
+def delete_users(user_ids):
+
+    """
+
+    Delete users along with their routes, locations, forecasts and API keys.
+
+    The users and their API keys are also dropped from this process's caches
+        (other processes notice within USER_CACHE_TTL and DEVELOPER_CACHE_TTL seconds).
+
+    Args:
+        user_ids: A list of user IDs (required)
+
+    Returns:
+        The number of users deleted
+
+    """
+
+    if not user_ids:
+        return 0
+
+    keys = [key for key, in db.session.query(models.Developer.key).filter(models.Developer.user_id.in_(user_ids))]
+
+    # Load the IDs first, so that neither DELETE selects from its own table
+    route_ids = [route_id for route_id, in db.session.query(models.Route.id).filter(models.Route.user_id.in_(user_ids))]
+    location_ids = [location_id for location_id, in db.session.query(models.Location.id).filter(models.Location.user_id.in_(user_ids))]
+
+    delete_routes(route_ids)
+    delete_locations(location_ids)
+
+    _delete(models.Developer, models.Developer.user_id.in_(user_ids))
+    _delete(models.FetchBudget, models.FetchBudget.user_id.in_(user_ids))
+
+    deleted = _delete(models.User, models.User.id.in_(user_ids))
+
+    for key in keys:
+        validator.forget_developer(key)
+
+    for user_id in user_ids:
+        users.forget(user_id)
+
+    return deleted
+
+def purge_unconfirmed(days, batch_size=1000, log=log.info):
+
+    """
+
+    Delete every account whose e-mail address hasn't been confirmed within a number of days.
+
+    Accounts are deleted in batches of batch_size, each in its own transaction,
+        so that no transaction holds locks on more than one batch of rows.
+
+    Args:
+        days: How old an unconfirmed account has to be (required)
+        batch_size: How many accounts to delete per transaction (optional)
+        log: Called with a progress message after each batch (optional)
+
+    Returns:
+        The number of accounts deleted
+
+    """
+
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+
+    # Uses ix_user_email_confirmed_created_at
+    batch = select([models.User.id]).where(and_(
+        models.User.email_confirmed == False, models.User.created_at < cutoff
+    )).order_by(models.User.id).limit(batch_size)
+
+    total = 0
+
+    while True:
+
+        user_ids = [user_id for user_id, in db.session.execute(batch)]
+        if not user_ids:
+            break
+
+        try:
+            total += delete_users(user_ids)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+
+        log(f'Deleted {total} unconfirmed accounts')
+
+    return total
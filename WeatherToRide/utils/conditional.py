@@ -0,0 +1,143 @@
+
+from .. import db, models
+
+from . import weather
+
+from flask import request
+from sqlalchemy import func
+
+import datetime
+import hashlib
+
+def _validator(parts, timestamps):
+
+    # A weak ETag, since forecast ages in the body move with the clock
+    etag = hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    timestamps = [x for x in timestamps if x]
+    last_modified = max(timestamps).astimezone(datetime.timezone.utc) if timestamps else None
+
+    return etag, last_modified
+
+def _forecasts_fresh(locations, forecasts, oldest_forecast):
+
+    # Only fresh forecasts can be answered with a 304, since stale ones need revalidating
+    if locations != forecasts:
+        return False
+
+    return not oldest_forecast or datetime.datetime.now() - oldest_forecast <= weather.MAX_FORECAST_AGE
+
+def location_aggregates(user_id):
+
+    # The aggregate query behind location_version (also explained by check-plans)
+    return db.session.query(
+        func.count(models.Location.id),
+        func.coalesce(func.sum(models.Location.id), 0),
+        func.max(models.Location.updated_at),
+        func.count(models.Forecast.id),
+        func.max(models.Forecast.updated_at),
+        func.min(models.Forecast.updated_at)
+    ).outerjoin(
+        models.Forecast, models.Forecast.location_id == models.Location.id
+    ).filter(
+        models.Location.user_id == user_id
+    )
+
+def location_version(user_id):
+
+    """
+
+    Get the cache validators for a user's locations and their forecasts with one aggregate query.
+
+    Returns:
+        etag, last_modified, fresh - fresh is False if any forecast needs refreshing
+
+    """
+
+    row = location_aggregates(user_id).one()
+
+    etag, last_modified = _validator(row[:5], [row[2], row[4]])
+
+    return etag, last_modified, _forecasts_fresh(row[0], row[3], row[5])
+
+def route_aggregates(user_id):
+
+    # The query behind route_version: the routes' aggregates next to the locations' (also explained by check-plans)
+    routes = db.session.query(
+        func.count(models.Route.id).label('count'),
+        func.coalesce(func.sum(models.Route.id), 0).label('ids'),
+        func.max(models.Route.updated_at).label('updated_at')
+    ).filter(
+        models.Route.user_id == user_id
+    ).subquery()
+
+    locations = location_aggregates(user_id).subquery()
+
+    return db.session.query(routes, locations)
+
+def route_version(user_id):
+
+    """
+
+    Get the cache validators for a user's routes, their locations and their forecasts with one aggregate query.
+
+    Returns:
+        etag, last_modified, fresh - fresh is False if any forecast needs refreshing
+
+    """
+
+    row = route_aggregates(user_id).one()
+
+    etag, last_modified = _validator(row[:8], [row[2], row[5], row[7]])
+
+    return etag, last_modified, _forecasts_fresh(row[3], row[6], row[8])
+
+def variant(etag, *parts):
+
+    """
+
+    Get a separate ETag for each page or format of the same listing.
+
+    Requests without any of the parts keep the listing's own ETag.
+
+    """
+
+    if not any(parts):
+        return etag
+
+    return hashlib.sha1(repr((etag,) + parts).encode()).hexdigest()
+
+def not_modified(etag, last_modified):
+
+    """
+
+    Check the request's If-None-Match / If-Modified-Since headers against the validators.
+
+    If-None-Match takes precedence. Deleting rows doesn't move Last-Modified,
+        so clients should prefer ETags.
+
+    """
+
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+
+    since = request.if_modified_since
+
+    if since and last_modified:
+        if not since.tzinfo:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        return last_modified.replace(microsecond=0) <= since
+
+    return False
+
+def tag(response, etag, last_modified):
+
+    response.set_etag(etag, weak=True)
+
+    if last_modified:
+        response.last_modified = last_modified
+
+    # Let clients cache the response, but make them check back every time
+    response.headers['Cache-Control'] = 'private, no-cache'
+
+    return response
@@ -1,9 +1,10 @@
 
 # Adapted from https://sendgrid.com/
 
-from .. import app, db, models
+from .. import app
+
+from . import quota
 
-import datetime
 import sendgrid
 
 from sendgrid.helpers.mail import *
@@ -11,47 +12,31 @@ from sendgrid.helpers.mail import *
 API_NAME = 'SendGrid'
 MAX_DAILY_CALLS = 50
 
-def send(to_address, subject, message):
+# The most recipients SendGrid accepts in one API call
+MAX_RECIPIENTS = 1000
+
+FROM_ADDRESS = 'support@WeatherToRide.com'
+
+def _client():
 
     # Check for the API key
     try:
-        sg = sendgrid.SendGridAPIClient(apikey=app.config['SENDGRID_KEY'])
+        return sendgrid.SendGridAPIClient(apikey=app.config['SENDGRID_KEY'], host=app.config['SENDGRID_URL']), None
     except:
         return None, 'The e-mail API key is not configured.'
 
-    # Get the current date/time
-    now = datetime.datetime.now()
-
-    # Get the entry for this API from the database
-    status = models.API.query.filter_by(name=API_NAME).first()
-
-    # If there isn't an entry for this API yet
-    if not status:
-        status = models.API(name=API_NAME)
-        status.calls_today = 0
-        status.calls_total = 0
-        status.last_reset = now
-        db.session.add(status)
-        db.session.commit()
-
-    # Check if the API call limit needs to be refreshed
-    if now.date() > status.last_reset.date():
-        status.calls_today = 0
-        status.last_reset = now
-        db.session.add(status)
-        db.session.commit()
-
-    # Check if the API has reached its call limit for today
-    if status.calls_today < MAX_DAILY_CALLS:
-        status.calls_today += 1
-        status.calls_total += 1
-        db.session.add(status)
-        db.session.commit()
-    else:
+def send(to_address, subject, message):
+
+    sg, error = _client()
+    if error:
+        return None, error
+
+    # Count this call against the daily limit
+    if not quota.reserve(API_NAME, MAX_DAILY_CALLS):
         return None, 'The e-mail service has reached capacity for today.'
 
     # Get the information for this e-mail
-    from_email = Email('support@WeatherToRide.com')
+    from_email = Email(FROM_ADDRESS)
     to_email = Email(to_address)
     subject = subject
     content = Content("text/html", message)
@@ -63,4 +48,40 @@ def send(to_address, subject, message):
     try:
         return sg.client.mail.send.post(request_body=mail.get()), None
     except:
-        return None
+        return None, 'The e-mail could not be sent.'
+
+def send_batch(to_addresses, subject, message):
+
+    """
+
+    Send the same e-mail to several recipients with one API call.
+
+    Each recipient gets their own copy (one personalization each), so no one
+        sees anyone else's address. The caller is responsible for counting the
+        call against the daily limit.
+
+    Args:
+        to_addresses: Up to MAX_RECIPIENTS e-mail addresses (required)
+        subject: The subject of the e-mail (required)
+        message: The HTML body of the e-mail (required)
+
+    Returns:
+        response, error
+
+    """
+
+    sg, error = _client()
+    if error:
+        return None, error
+
+    mail = {
+        "personalizations": [{ "to": [{ "email": x }] } for x in to_addresses],
+        "from": { "email": FROM_ADDRESS },
+        "subject": subject,
+        "content": [{ "type": "text/html", "value": message }]
+    }
+
+    try:
+        return sg.client.mail.send.post(request_body=mail), None
+    except Exception as e:
+        return None, f'The e-mail could not be sent: {e}'
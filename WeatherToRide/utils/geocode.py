@@ -1,14 +1,23 @@
 
 from .. import app, db, models
 
+from . import metrics, quota
+from .cache import MISSING, TTLCache
+
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.exc import IntegrityError
 from urllib.parse import urlencode
 
 import datetime
+import hashlib
+import re
 import requests
 
 API_NAME = 'Google Geocode'
 MAX_DAILY_CALLS = 500
 
+FETCH_ERROR = 'There was a problem while trying to find this address.'
+
 def get_coordinates(address):
 
     """
@@ -24,6 +33,9 @@ def get_coordinates(address):
 
                 '1720 2nd Ave S, Birmingham, AL 35294'
 
+        Answers are cached by normalized address (in memory and in the 
+            geocode_cache table), so repeated addresses don't use up API calls.
+
     Returns:
         lat, lng, error - The coordinates for the address, plus any error that was caught
 
@@ -48,60 +60,291 @@ def get_coordinates(address):
         except:
             return None, None, 'There is a problem with the given coordinates.'
 
-    # The payload for the API request
-    payload = {'address' : address}
+    # Check the cache before spending an API call
+    key = normalize(address)
+
+    cached = lookup(key)
+    if cached is not MISSING:
+        return cached
 
     # Check for the API key
     try:
-        payload['key'] = app.config['GOOGLE_KEY']
+        api_key = app.config['GOOGLE_KEY']
     except:
         return None, None, 'The geocoding API key is not configured.'
 
-    # Get the current date/time
-    now = datetime.datetime.now()
-
-    # Get the entry for this API from the database
-    status = models.API.query.filter_by(name=API_NAME).first()
-
-    # If there isn't an entry for this API yet
-    if not status:
-        status = models.API(name=API_NAME)
-        status.calls_today = 0
-        status.calls_total = 0
-        status.last_reset = now
-        db.session.add(status)
-        db.session.commit()
-
-    # Check if the API call limit needs to be refreshed
-    if now.date() > status.last_reset.date():
-        status.calls_today = 0
-        status.last_reset = now
-        db.session.add(status)
-        db.session.commit()
-
-    # Check if the API has reached its call limit for today
-    if status.calls_today >= MAX_DAILY_CALLS:
+    # Count this call against the daily limit
+    if not quota.reserve(API_NAME, MAX_DAILY_CALLS):
         return None, None, 'The location service has reached capacity for today.'
-    else:
-        status.calls_today += 1
-        status.calls_total += 1
-        db.session.add(status)
-        db.session.commit()
 
-    # Try to query the Google Geocoding API
+    lat, lng, error, found = fetch_coordinates(api_key, address)
+
+    # Remember the answer (including addresses that don't exist, but not other failures)
+    if not error or not found:
+        store(key, address, lat, lng, error)
+
+    return lat, lng, error
+
+def get_coordinates_batch(addresses):
+
+    """
+
+    Get the coordinates for many addresses at once (see get_coordinates).
+
+    Addresses are deduplicated by their normalized form and checked against 
+        the cache. The remaining ones are counted against the daily limit, 
+        then geocoded concurrently on a bounded thread pool.
+
+    Args:
+        addresses: An iterable of address strings (required)
+
+    Returns:
+        A dict of address -> (lat, lng, error)
+
+    """
+
+    results, pending, api_key = reserve_batch(addresses)
+
+    futures = { key: fetch_pool.submit(fetch_coordinates, api_key, group[0]) for key, group in pending.items() }
+
+    # Collect the answers
+    results.update(store_batch(pending, { key: future.result() for key, future in futures.items() }))
+
+    return results
+
+def reserve_batch(addresses):
+
+    """
+
+    Answer what can be answered from the cache, and count the rest against the daily limit.
+
+    This is the part of get_coordinates_batch that uses the database, so that the 
+        requests themselves can be made by any HTTP client (see asyncapi.py).
+
+    Returns:
+        results, pending, api_key
+
+        results: address -> (lat, lng, error) for cache hits and errors
+        pending: Normalized address -> the addresses to request it for (one call each)
+
+    """
+
+    results = {}
+    keys = {}
+
+    for address in set(addresses):
+
+        # Resolved addresses and cache hits don't need the API
+        if address.startswith('<<<') and address.endswith('>>>'):
+            results[address] = get_coordinates(address)
+        else:
+            keys.setdefault(normalize(address), []).append(address)
+
+    pending = {}
+
+    for key, group in keys.items():
+        cached = lookup(key)
+        if cached is not MISSING:
+            results.update({ address: cached for address in group })
+        else:
+            pending[key] = group
+
+    if not pending:
+        return results, {}, None
+
+    # Check for the API key
     try:
+        api_key = app.config['GOOGLE_KEY']
+    except:
+        error = (None, None, 'The geocoding API key is not configured.')
+        return dict(results, **{ address: error for group in pending.values() for address in group }), {}, None
+
+    # Count the calls against the daily limit (this uses the database, so it stays on this thread)
+    reserved = {}
+
+    for key, group in pending.items():
+        if quota.reserve(API_NAME, MAX_DAILY_CALLS):
+            reserved[key] = group
+        else:
+            error = (None, None, 'The location service has reached capacity for today.')
+            results.update({ address: error for address in group })
+
+    return results, reserved, api_key
+
+def store_batch(pending, answers):
+
+    """
+
+    Cache the answers for a batch reserved with reserve_batch.
+
+    Args:
+        pending: The pending addresses from reserve_batch (required)
+        answers: Normalized address -> (lat, lng, error, found) (required)
+
+    Returns:
+        A dict of address -> (lat, lng, error)
+
+    """
+
+    results = {}
+
+    for key, (lat, lng, error, found) in answers.items():
+
+        # Remember the answer (including addresses that don't exist, but not other failures)
+        if not error or not found:
+            store(key, pending[key][0], lat, lng, error)
+
+        results.update({ address: (lat, lng, error) for address in pending[key] })
+
+    return results
+
+def request_url(api_key, address):
+    return f"{app.config['GOOGLE_GEOCODE_URL']}?{urlencode({'address' : address, 'key': api_key})}"
+
+def fetch_coordinates(api_key, address):
 
-        url = f'https://maps.googleapis.com/maps/api/geocode/json?{urlencode(payload)}'
+    """
+
+    Request the coordinates for an address from the Google Geocoding API.
+
+    This doesn't touch the database, so it is safe to run on worker threads.
+
+    Returns:
+        lat, lng, error, found - found is False if Google doesn't know the address
+
+    """
+
+    # Try to query the Google Geocoding API
+    try:
 
         # Extract the JSON response
-        response = requests.get(url).json()
+        response = requests.get(request_url(api_key, address), timeout=app.config['GEOCODE_FETCH_TIMEOUT'])
+        response.raise_for_status()
+
+        return parse_response(response.json())
+
+    except:
+        return None, None, FETCH_ERROR, True
+
+def parse_response(response):
+
+    """
+
+    Get the coordinates out of a Google Geocoding API response.
+
+    Returns:
+        lat, lng, error, found (see fetch_coordinates)
+
+    """
+
+    try:
+
+        if response.get('status') == 'ZERO_RESULTS':
+            return None, None, FETCH_ERROR, False
 
         # Parse the response for the coordinates
         lat = response['results'][0]['geometry']['location']['lat']
         lng = response['results'][0]['geometry']['location']['lng']
 
         # Return the coordinates
-        return lat, lng, None
+        return lat, lng, None, True
 
     except:
-        return None, None, 'There was a problem while trying to find this address.'
+        return None, None, FETCH_ERROR, True
+
+def normalize(address):
+
+    """
+
+    Reduce an address to a cache key, so that '1720 2nd Ave S,  Birmingham' 
+        and '1720 2nd ave s, birmingham' share one entry.
+
+    """
+
+    address = re.sub(r'[^\w\s]', ' ', address.lower())
+
+    return ' '.join(address.split())
+
+def lookup(key):
+
+    """
+
+    Look up a normalized address in memory, then in the geocode_cache table.
+
+    Returns:
+        (lat, lng, error), or MISSING if the address needs to be geocoded
+
+    """
+
+    cached = memory_cache.get(key)
+    if cached is not MISSING:
+        stats['memoryHits'] += 1
+        return cached
+
+    cache = models.GeocodeCache.__table__
+
+    with db.engine.connect() as connection:
+        row = connection.execute(
+            cache.select().where(cache.c.address_hash == hash_key(key))
+        ).first()
+
+    if row:
+        ttl = app.config['GEOCODE_NEGATIVE_TTL'] if row.error else app.config['GEOCODE_CACHE_TTL']
+        age = (datetime.datetime.now() - row.created_at).total_seconds()
+
+        if age < ttl:
+            stats['databaseHits'] += 1
+            cached = (float(row.lat) if row.lat is not None else None, float(row.lng) if row.lng is not None else None, row.error)
+            memory_cache.set(key, cached, ttl=ttl - age)
+            return cached
+
+    stats['misses'] += 1
+
+    return MISSING
+
+def store(key, address, lat, lng, error):
+
+    ttl = app.config['GEOCODE_NEGATIVE_TTL'] if error else app.config['GEOCODE_CACHE_TTL']
+
+    memory_cache.set(key, (lat, lng, error), ttl=ttl)
+
+    cache = models.GeocodeCache.__table__
+
+    # Write outside of the request's session, replacing any expired entry
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(cache.delete().where(cache.c.address_hash == hash_key(key)))
+            connection.execute(cache.insert().values(
+                address_hash=hash_key(key), 
+                address=address[:255], 
+                lat=lat, 
+                lng=lng, 
+                error=error, 
+                created_at=datetime.datetime.now()
+            ))
+    except IntegrityError:
+        # Another process stored the same address at the same time
+        pass
+
+def hash_key(key):
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def cache_stats():
+
+    lookups = stats['memoryHits'] + stats['databaseHits'] + stats['misses']
+
+    return dict(stats, 
+        hitRatio=round((lookups - stats['misses']) / lookups, 4) if lookups else None, 
+        memory=memory_cache.stats()
+    )
+
+# Normalized address -> (lat, lng, error), in front of the geocode_cache table
+memory_cache = TTLCache(max_size=app.config['GEOCODE_MEMORY_CACHE_SIZE'], ttl=app.config['GEOCODE_CACHE_TTL'])
+
+# Every hit is an API call that didn't count against the daily limit
+stats = { "memoryHits": 0, "databaseHits": 0, "misses": 0 }
+
+metrics.register('geocodeCache', cache_stats)
+
+# Bounded thread pool for batched geocoding
+fetch_pool = ThreadPoolExecutor(max_workers=app.config['GEOCODE_FETCH_WORKERS'], thread_name_prefix='geocode-fetch')
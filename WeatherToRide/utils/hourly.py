@@ -0,0 +1,110 @@
+
+from . import scoring
+
+import datetime
+import numpy
+
+# The hourly fields that are kept, with the Dark Sky field each one comes from
+FIELDS = {
+    'precip_probability': 'precipProbability',
+    'precip_intensity': 'precipIntensity',
+    'wind_speed': 'windSpeed',
+    'wind_gust': 'windGust',
+    'temperature': 'temperature',
+    'visibility': 'visibility'
+}
+
+HOUR = datetime.timedelta(hours=1)
+
+def pack(values, icon_levels):
+
+    """
+
+    Pack an hourly forecast into bytes: one row of float32s per hour, with the
+        icon's level followed by FIELDS (NaN where missing). 49 hours take 1372 bytes.
+
+    Args:
+        values: A list of FIELDS values (numbers or None) for each hour (required)
+        icon_levels: The level from each hour's icon, None where it wasn't recognized (required)
+
+    """
+
+    return numpy.array([[level] + x for x, level in zip(values, icon_levels)], dtype=numpy.float32).tobytes()
+
+def unpack(packed):
+    return numpy.frombuffer(packed, dtype=numpy.float32).reshape(-1, len(FIELDS) + 1)
+
+def score_windows(forecasts, windows):
+
+    """
+
+    Score many windows of time at once from packed hourly forecasts.
+
+    Every hour that overlaps a window is gathered into one array and scored in a single
+        pass (see scoring.py), then each window takes the worst level of its hours.
+
+    Args:
+        forecasts: A dict of key -> (time of the first hour, packed hours) (required)
+        windows: A list of (start, end, keys) - a window covers the same hours of every key's forecast (required)
+
+    Returns:
+        A level for each window, None if a forecast is missing or doesn't cover it
+
+    """
+
+    hours = { key: unpack(packed) for key, (start, packed) in forecasts.items() }
+
+    # The hours of every forecast in one matrix, after each other
+    offsets = {}
+    total = 0
+    for key, matrix in hours.items():
+        offsets[key] = total
+        total += len(matrix)
+
+    # Each slice of rows to score, and the window it belongs to
+    firsts, lengths, owners = [], [], []
+
+    for i, (start, end, keys) in enumerate(windows):
+
+        slices = []
+
+        for key in keys:
+
+            if key not in hours:
+                break
+
+            first = (start - forecasts[key][0]) // HOUR
+            last = -((forecasts[key][0] - end) // HOUR)
+
+            if first < 0 or last > len(hours[key]) or last <= first:
+                break
+
+            slices.append((offsets[key] + first, last - first))
+
+        else:
+            for first, length in slices:
+                firsts.append(first)
+                lengths.append(length)
+                owners.append(i)
+
+    levels = numpy.full(len(windows), numpy.nan)
+
+    if firsts:
+
+        lengths = numpy.array(lengths)
+
+        # The row numbers of every slice, without a loop over the rows
+        index = numpy.repeat(numpy.array(firsts) - numpy.cumsum(lengths) + lengths, lengths) + numpy.arange(lengths.sum())
+
+        rows = numpy.concatenate(list(hours.values()))[index]
+        columns = { field: rows[:, i + 1] for i, field in enumerate(FIELDS) }
+
+        # An hour's temperature is checked against both the hot and the cold thresholds
+        columns['temperature_high'] = columns['temperature_low'] = columns.pop('temperature')
+
+        hour_levels = scoring.score(columns, rows[:, 0])
+
+        # The worst hour of each window (fmax ignores NaN)
+        numpy.fmax.at(levels, numpy.repeat(owners, lengths), hour_levels)
+
+    return [None if numpy.isnan(x) else int(x) for x in levels]
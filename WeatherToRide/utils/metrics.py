@@ -0,0 +1,9 @@
+
+# Modules register a callable here that returns a JSON-serializable dict of their counters
+_sources = {}
+
+def register(name, source):
+    _sources[name] = source
+
+def snapshot():
+    return { name: source() for name, source in _sources.items() }
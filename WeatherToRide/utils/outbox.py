@@ -0,0 +1,292 @@
+
+from .. import app, db, models
+
+from . import email, metrics, quota
+
+from sqlalchemy import func, select
+
+import datetime
+import logging
+import threading
+import time
+import uuid
+
+log = logging.getLogger(__name__)
+
+def enqueue(to_address, subject, html):
+
+    """
+
+    Queue an e-mail to be sent by the outbox worker, instead of waiting on SendGrid.
+
+    The message is committed along with any other pending changes in the session.
+
+    Args:
+        to_address: The recipient's e-mail address (required)
+        subject: The subject of the e-mail (required)
+        html: The HTML body of the e-mail (required)
+
+    Returns:
+        message, error
+
+    """
+
+    now = datetime.datetime.now()
+
+    message = models.OutboxMessage(
+        to_address=to_address, subject=subject, html=html, created_at=now, attempts=0, next_attempt_at=now
+    )
+
+    try:
+        db.session.add(message)
+        db.session.commit()
+    except:
+        db.session.rollback()
+        log.exception('Could not queue e-mail.')
+        return None, 'The e-mail could not be queued.'
+
+    return message, None
+
+class OutboxWorker(object):
+
+    """
+
+    Send the e-mails queued in the outbox table from outside of the request path.
+
+    Due messages are claimed in batches of up to OUTBOX_BATCH_SIZE. Messages with
+        the same subject and body (e.g. an announcement) are sent with one API call.
+
+    A failed send is retried after OUTBOX_RETRY_DELAY seconds, doubling with each
+        attempt up to OUTBOX_MAX_RETRY_DELAY. After OUTBOX_MAX_ATTEMPTS the message
+        is kept (with its last error) but no longer retried. Messages that can't be
+        sent because the daily quota is used up wait until the next day.
+
+    A claim expires after OUTBOX_CLAIM_TIMEOUT seconds, so the messages of a worker
+        that died mid-batch are picked up again.
+
+    """
+
+    def __init__(self):
+        self.batch_size = min(app.config['OUTBOX_BATCH_SIZE'], email.MAX_RECIPIENTS)
+        self.poll_interval = datetime.timedelta(seconds=app.config['OUTBOX_POLL_INTERVAL'])
+        self.retry_delay = app.config['OUTBOX_RETRY_DELAY']
+        self.max_retry_delay = app.config['OUTBOX_MAX_RETRY_DELAY']
+        self.max_attempts = app.config['OUTBOX_MAX_ATTEMPTS']
+        self.claim_timeout = datetime.timedelta(seconds=app.config['OUTBOX_CLAIM_TIMEOUT'])
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.api_calls = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+        self._call_total = 0.0
+        self._stop = threading.Event()
+
+    def claim(self, now):
+
+        """
+
+        Claim up to batch_size due messages for this worker.
+
+        Claimed messages are pushed back by the claim timeout, so that no other
+            worker picks them up unless this one dies before finishing.
+
+        """
+
+        token = uuid.uuid4().hex
+
+        with db.engine.begin() as connection:
+
+            ids = [row.id for row in connection.execute(self.due_query(now))]
+            if not ids:
+                return []
+
+            connection.execute(self.claim_query(ids, token, now))
+
+            return connection.execute(self.claimed_query(token)).fetchall()
+
+    # The statements behind claim (also explained by check-plans)
+
+    def due_query(self, now):
+        outbox = models.OutboxMessage.__table__
+        return select([outbox.c.id]).where(outbox.c.next_attempt_at <= now).order_by(
+            outbox.c.next_attempt_at
+        ).limit(self.batch_size)
+
+    def claim_query(self, ids, token, now):
+
+        # Only messages that are still due, in case another worker claimed some of them first
+        outbox = models.OutboxMessage.__table__
+        return outbox.update().where(outbox.c.id.in_(ids)).where(
+            outbox.c.next_attempt_at <= now
+        ).values(claim=token, next_attempt_at=now + self.claim_timeout)
+
+    def claimed_query(self, token):
+        outbox = models.OutboxMessage.__table__
+        return select([outbox]).where(outbox.c.claim == token)
+
+    def backoff(self, attempts):
+        return datetime.timedelta(seconds=min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay))
+
+    def run_once(self, now=None):
+
+        """
+
+        Send one batch of due messages, then return when the next batch should be sent.
+
+        """
+
+        now = now or datetime.datetime.now()
+
+        messages = self.claim(now)
+
+        # Group identical e-mails, so each group is one API call
+        groups = {}
+        for message in messages:
+            groups.setdefault((message.subject, message.html), []).append(message)
+
+        outbox = models.OutboxMessage.__table__
+
+        for (subject, html), group in groups.items():
+
+            ids = [x.id for x in group]
+
+            # Wait until tomorrow without counting it as a failed attempt
+            if not quota.reserve(email.API_NAME, email.MAX_DAILY_CALLS):
+                tomorrow = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time.min)
+                with db.engine.begin() as connection:
+                    connection.execute(outbox.update().where(outbox.c.id.in_(ids)).values(
+                        claim=None, next_attempt_at=tomorrow, last_error='The e-mail service has reached capacity for today.'
+                    ))
+                log.warning('E-mail quota reached, %s messages postponed until %s.', len(ids), tomorrow)
+                continue
+
+            started = time.monotonic()
+            response, error = email.send_batch([x.to_address for x in group], subject, html)
+            elapsed = time.monotonic() - started
+
+            self.api_calls += 1
+            self._call_total += elapsed
+
+            if not error:
+
+                with db.engine.begin() as connection:
+                    connection.execute(outbox.delete().where(outbox.c.id.in_(ids)))
+
+                sent_at = datetime.datetime.now()
+                for message in group:
+                    latency = (sent_at - message.created_at).total_seconds()
+                    self._latency_total += latency
+                    self._latency_max = max(self._latency_max, latency)
+
+                self.sent += len(group)
+                log.info('Sent %s e-mails with one API call in %.2f s.', len(group), elapsed)
+                continue
+
+            self.failed += len(group)
+
+            # Each message keeps its own attempt count, since it may have joined a retried group late
+            with db.engine.begin() as connection:
+                for message in group:
+
+                    attempts = message.attempts + 1
+
+                    if attempts >= self.max_attempts:
+                        next_attempt_at = None
+                        self.dropped += 1
+                        log.error('Giving up on e-mail %s to %s after %s attempts: %s', message.id, message.to_address, attempts, error)
+                    else:
+                        next_attempt_at = now + self.backoff(attempts)
+
+                    connection.execute(outbox.update().where(outbox.c.id == message.id).values(
+                        claim=None, attempts=attempts, next_attempt_at=next_attempt_at, last_error=error[:255]
+                    ))
+
+            log.warning('Could not send %s e-mails: %s', len(group), error)
+
+        # A full batch means there are probably more waiting
+        if len(messages) >= self.batch_size:
+            return now
+
+        return now + self.poll_interval
+
+    def run_forever(self):
+
+        while not self._stop.is_set():
+
+            try:
+                next_run = self.run_once()
+            except Exception:
+                log.exception('Outbox cycle failed.')
+                next_run = datetime.datetime.now() + self.poll_interval
+            finally:
+                db.session.remove()
+
+            wait = (next_run - datetime.datetime.now()).total_seconds()
+            if wait > 0:
+                self._stop.wait(wait)
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "apiCalls": self.api_calls,
+            "averageLatencySeconds": round(self._latency_total / self.sent, 3) if self.sent else None,
+            "maxLatencySeconds": round(self._latency_max, 3),
+            "averageCallSeconds": round(self._call_total / self.api_calls, 3) if self.api_calls else None
+        }
+
+def start_thread():
+
+    """
+
+    Run an OutboxWorker on a daemon thread inside of this process.
+
+    """
+
+    worker = OutboxWorker()
+
+    def run():
+        with app.app_context():
+            worker.run_forever()
+
+    thread = threading.Thread(target=run, name='outbox-worker', daemon=True)
+    thread.start()
+
+    metrics.register('outboxWorker', worker.stats)
+
+    return worker
+
+def stats():
+
+    """
+
+    Report the depth of the outbox, which every process can see.
+
+    """
+
+    outbox = models.OutboxMessage.__table__
+
+    with db.engine.connect() as connection:
+
+        queued, oldest = connection.execute(select([func.count(), func.min(outbox.c.created_at)]).where(
+            outbox.c.next_attempt_at.isnot(None)
+        )).first()
+
+        dead = connection.execute(select([func.count()]).where(outbox.c.next_attempt_at.is_(None))).scalar()
+
+    # SQLite returns plain strings for aggregates of DATETIME columns
+    if isinstance(oldest, str):
+        oldest = datetime.datetime.fromisoformat(oldest)
+
+    return {
+        "queued": queued,
+        "dead": dead,
+        "oldestQueuedSeconds": round((datetime.datetime.now() - oldest).total_seconds(), 1) if oldest else None
+    }
+
+metrics.register('outbox', stats)
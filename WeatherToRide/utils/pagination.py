@@ -0,0 +1,109 @@
+
+from .. import app, db
+
+from flask import json, request, Response, stream_with_context
+
+def parse_args():
+
+    """
+
+    Read the paging parameters of a JSON API listing request.
+
+        after: Only return items with a higher ID (the nextCursor of the previous page)
+        limit: How many items to return (up to API_MAX_PAGE_SIZE)
+        format: 'ndjson' to stream every item (after the cursor) as one JSON object per line
+
+    Returns:
+        after, limit, stream, error
+
+    """
+
+    try:
+        after = int(request.args.get('after', 0))
+        limit = int(request.args.get('limit', app.config['API_PAGE_SIZE']))
+    except ValueError:
+        return None, None, None, 'The after and limit parameters must be whole numbers.'
+
+    if after < 0 or limit < 1:
+        return None, None, None, 'The after parameter can\'t be negative, and limit must be at least 1.'
+
+    stream = request.args.get('format') == 'ndjson'
+
+    # Streams only take a limit when it is asked for
+    if stream and 'limit' not in request.args:
+        limit = None
+    else:
+        limit = min(limit, app.config['API_MAX_PAGE_SIZE'])
+
+    return after, limit, stream, None
+
+def page(load, after, limit):
+
+    """
+
+    Load one page of rows by keyset (WHERE id > after ORDER BY id LIMIT n).
+
+    Args:
+        load: A function of (after, n) that returns up to n rows ordered by ID (required)
+        after: The ID to start after (required)
+        limit: The most rows to return (required)
+
+    Returns:
+        rows, next_cursor - next_cursor is None on the last page
+
+    """
+
+    # One extra row tells whether there is another page
+    rows = load(after, limit + 1)
+
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1].id
+
+    return rows, None
+
+def chunks(load, after, limit=None):
+
+    """
+
+    Load rows by keyset, API_STREAM_CHUNK_SIZE at a time, until there are none left (or limit is reached).
+
+    The session is emptied after each chunk, so memory stays flat however many rows there are.
+
+    """
+
+    size = app.config['API_STREAM_CHUNK_SIZE']
+
+    while limit is None or limit > 0:
+
+        n = size if limit is None else min(size, limit)
+
+        rows = load(after, n)
+        if not rows:
+            return
+
+        yield rows
+
+        # A short chunk is the last one
+        if len(rows) < n:
+            return
+
+        after = rows[-1].id
+
+        if limit is not None:
+            limit -= len(rows)
+
+        db.session.expunge_all()
+
+def ndjson(items):
+
+    """
+
+    Stream items as newline-delimited JSON (one object per line).
+
+    """
+
+    def generate():
+        for item in items:
+            yield json.dumps(item) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
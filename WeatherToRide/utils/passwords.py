@@ -0,0 +1,199 @@
+
+from .. import app
+
+from . import metrics
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from passlib.hash import argon2
+
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+class Busy(Exception):
+
+    """
+
+    Raised when too many passwords are already waiting to be hashed or verified.
+
+    """
+
+    pass
+
+def _settings():
+    return {
+        'rounds': app.config['ARGON2_TIME_COST'],
+        'memory_cost': app.config['ARGON2_MEMORY_COST'],
+        'parallelism': app.config['ARGON2_PARALLELISM']
+    }
+
+# These run in the worker processes, so they only use passlib
+
+_handlers = {}
+
+def _handler(settings):
+
+    key = tuple(sorted(settings.items()))
+
+    if key not in _handlers:
+        _handlers[key] = argon2.using(**settings)
+
+    return _handlers[key]
+
+def _hash(plaintext, settings):
+
+    started = time.time()
+
+    return _handler(settings).hash(plaintext), started
+
+def _verify(plaintext, hashed, settings):
+
+    started = time.time()
+    handler = _handler(settings)
+
+    valid = handler.verify(plaintext, hashed)
+
+    # Rehash with the current cost settings while the plaintext is at hand
+    new_hash = handler.hash(plaintext) if valid and handler.needs_update(hashed) else None
+
+    return valid, new_hash, started
+
+def _run(function, *args):
+
+    """
+
+    Run a hashing function on the process pool, waiting for a free slot first.
+
+    At most PASSWORD_MAX_QUEUED calls can be waiting or running at once. When
+        they are all taken, a caller waits up to PASSWORD_QUEUE_TIMEOUT seconds
+        before giving up, so a burst of logins can't tie up every request thread.
+
+    If a worker dies (e.g. killed for running out of memory), the whole pool stops
+        accepting work, so it is replaced and the call is tried once more.
+
+    """
+
+    submitted = time.time()
+
+    if not _slots.acquire(timeout=app.config['PASSWORD_QUEUE_TIMEOUT']):
+        with _lock:
+            _stats['rejected'] += 1
+        raise Busy('Too many passwords are waiting to be checked.')
+
+    try:
+
+        for attempt in range(2):
+
+            pool = _get_pool()
+
+            try:
+                *result, started = pool.submit(function, *args, _settings()).result()
+                break
+            except BrokenProcessPool:
+                log.warning('A password worker died, so its pool is being replaced.')
+                _replace_pool(pool)
+
+        else:
+            raise Busy('The password workers are restarting.')
+
+    finally:
+        _slots.release()
+
+    waited = max(started - submitted, 0)
+    worked = time.time() - started
+
+    with _lock:
+        _stats['completed'] += 1
+        _stats['queueSeconds'] += waited
+        _stats['maxQueueSeconds'] = max(_stats['maxQueueSeconds'], waited)
+        _stats['workSeconds'] += worked
+
+    return result
+
+def hash(plaintext):
+
+    """
+
+    Hash a password with Argon2 (using the ARGON2_* cost settings) on the process pool.
+
+    Raises:
+        Busy: If the password couldn't be queued in time
+
+    """
+
+    hashed, = _run(_hash, plaintext)
+
+    return hashed
+
+def verify(plaintext, hashed):
+
+    """
+
+    Check a password against an Argon2 hash on the process pool.
+
+    Returns:
+        valid, new_hash - new_hash is set if the password was right but the hash
+            was made with different cost settings, and should be stored instead
+
+    Raises:
+        Busy: If the password couldn't be queued in time
+
+    """
+
+    return _run(_verify, plaintext, hashed)
+
+def _get_pool():
+
+    global _pool
+
+    # Started on first use, so that each web server process gets its own workers
+    with _lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=app.config['PASSWORD_HASH_WORKERS'])
+
+    return _pool
+
+def _replace_pool(pool):
+
+    global _pool
+
+    # Only the first caller to find this pool broken replaces it
+    with _lock:
+        if _pool is pool:
+            _pool = None
+            _stats['restarts'] += 1
+
+    pool.shutdown(wait=False)
+
+def stats():
+
+    with _lock:
+        completed = _stats['completed']
+        return {
+            "workers": app.config['PASSWORD_HASH_WORKERS'],
+            "maxQueued": app.config['PASSWORD_MAX_QUEUED'],
+            "completed": completed,
+            "rejected": _stats['rejected'],
+            "restarts": _stats['restarts'],
+            "averageQueueSeconds": round(_stats['queueSeconds'] / completed, 4) if completed else None,
+            "maxQueueSeconds": round(_stats['maxQueueSeconds'], 4),
+            "averageWorkSeconds": round(_stats['workSeconds'] / completed, 4) if completed else None
+        }
+
+_pool = None
+_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(app.config['PASSWORD_MAX_QUEUED'])
+
+_stats = {
+    "completed": 0,
+    "rejected": 0,
+    "restarts": 0,
+    "queueSeconds": 0.0,
+    "maxQueueSeconds": 0.0,
+    "workSeconds": 0.0
+}
+
+metrics.register('passwords', stats)
@@ -0,0 +1,137 @@
+
+# This module is imported before the app's database is set up, so it only imports metrics
+from . import metrics
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+import threading
+import time
+
+_lock = threading.Lock()
+
+_stats = {
+    "checkouts": 0,
+    "overflowCheckouts": 0,
+    "timeouts": 0,
+    "connects": 0,
+    "invalidations": 0,
+    "softInvalidations": 0,
+    "checkoutSeconds": 0.0,
+    "maxCheckoutSeconds": 0.0,
+    "maxOverflow": 0
+}
+
+_pool = None
+
+class TimedQueuePool(QueuePool):
+
+    """
+
+    A QueuePool that records how long each checkout waits for a connection.
+
+    The time includes opening a new connection (when the pool is empty) and
+        the pre-ping, so it is the delay a request actually sees.
+
+    """
+
+    def _timed(self, checkout):
+
+        started = time.perf_counter()
+
+        try:
+            connection = checkout()
+        except exc.TimeoutError:
+            with _lock:
+                _stats['timeouts'] += 1
+            raise
+
+        waited = time.perf_counter() - started
+        overflow = max(self.overflow(), 0)
+
+        with _lock:
+            _stats['checkoutSeconds'] += waited
+            _stats['maxCheckoutSeconds'] = max(_stats['maxCheckoutSeconds'], waited)
+            _stats['maxOverflow'] = max(_stats['maxOverflow'], overflow)
+            if overflow:
+                _stats['overflowCheckouts'] += 1
+
+        return connection
+
+    # Engines check connections out with unique_connection() in SQLAlchemy 1.3, and connect() after that
+    def connect(self):
+        return self._timed(super().connect)
+
+    def unique_connection(self):
+        return self._timed(super().unique_connection)
+
+def _count(name):
+    def listener(*args):
+        with _lock:
+            _stats[name] += 1
+    return listener
+
+class PooledSQLAlchemy(SQLAlchemy):
+
+    """
+
+    Flask-SQLAlchemy with the connection pool set up from the DB_POOL_* settings.
+
+    Settings in SQLALCHEMY_ENGINE_OPTIONS still take priority. SQLite databases
+        keep Flask-SQLAlchemy's defaults (apart from pre-ping), since SQLite
+        connections are cheap and aren't dropped by a server.
+
+    """
+
+    def apply_driver_hacks(self, app, sa_url, options):
+
+        sa_url, options = super().apply_driver_hacks(app, sa_url, options)
+
+        if sa_url.drivername != 'sqlite':
+            options.update(
+                poolclass=TimedQueuePool,
+                pool_size=app.config['DB_POOL_SIZE'],
+                max_overflow=app.config['DB_MAX_OVERFLOW'],
+                pool_recycle=app.config['DB_POOL_RECYCLE'],
+                pool_timeout=app.config['DB_POOL_TIMEOUT']
+            )
+
+        options['pool_pre_ping'] = app.config['DB_POOL_PRE_PING']
+
+        return sa_url, options
+
+    def create_engine(self, sa_url, engine_opts):
+
+        global _pool
+
+        engine = super().create_engine(sa_url, engine_opts)
+
+        event.listen(engine.pool, 'checkout', _count('checkouts'))
+        event.listen(engine.pool, 'connect', _count('connects'))
+        event.listen(engine.pool, 'invalidate', _count('invalidations'))
+        event.listen(engine.pool, 'soft_invalidate', _count('softInvalidations'))
+
+        _pool = engine.pool
+
+        return engine
+
+def stats():
+
+    with _lock:
+
+        checkouts = _stats['checkouts']
+        result = dict(_stats)
+
+        # Only a TimedQueuePool measures the checkout time
+        result['averageCheckoutSeconds'] = round(_stats['checkoutSeconds'] / checkouts, 4) if checkouts and isinstance(_pool, TimedQueuePool) else None
+        result['maxCheckoutSeconds'] = round(_stats['maxCheckoutSeconds'], 4)
+        del result['checkoutSeconds']
+
+    # A snapshot of the pool right now
+    if isinstance(_pool, QueuePool):
+        result.update(size=_pool.size(), checkedOut=_pool.checkedout(), overflow=max(_pool.overflow(), 0))
+
+    return result
+
+metrics.register('dbPool', stats)
@@ -0,0 +1,286 @@
+
+from .. import app, db, models
+
+from . import metrics
+
+from sqlalchemy import case, or_
+from sqlalchemy.exc import IntegrityError
+
+import atexit
+import datetime
+import threading
+import time
+
+class Lease(object):
+
+    def __init__(self, day, size):
+        self.day = day
+        self.size = size
+        self.remaining = size
+
+_leases = {}
+_exists = {}
+
+# Guards _leases and _stats (never held during a database round trip)
+_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+_stats = {
+    "reserved": 0,
+    "rejected": 0,
+    "dbUpdates": 0,
+    "returned": 0
+}
+
+def _start_of_day(now):
+    return datetime.datetime.combine(now.date(), datetime.time.min)
+
+def _ensure_row(name, now):
+
+    api = models.API.__table__
+
+    # Create the entry for this API if it doesn't exist yet (api.name is unique)
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(api.insert().values(name=name, calls_today=0, calls_total=0, last_reset=now))
+    except IntegrityError:
+        # It already exists, or another process created it at the same time
+        pass
+
+def _take(name, max_daily, n, now):
+
+    """
+
+    Atomically count n calls against today's limit with a single conditional UPDATE.
+
+    The counter starts over on the first reservation of a new day. Nothing is
+        changed if the calls would go over the limit.
+
+    Returns:
+        True if the calls were counted
+
+    """
+
+    api = models.API.__table__
+    new_day = api.c.last_reset < _start_of_day(now)
+
+    # MySQL applies SET clauses from left to right, so last_reset (the last column) must be assigned last
+    statement = api.update().where(api.c.name == name).where(
+        or_(new_day, api.c.calls_today + n <= max_daily)
+    ).values(
+        calls_today=case([(new_day, n)], else_=api.c.calls_today + n),
+        calls_total=api.c.calls_total + n,
+        last_reset=case([(new_day, now)], else_=api.c.last_reset)
+    )
+
+    # Run it outside of the request's session so the caller's pending changes aren't committed
+    with db.engine.begin() as connection:
+        result = connection.execute(statement)
+
+    _count('dbUpdates', 1)
+
+    if result.rowcount:
+        return True
+
+    # The row might not exist yet
+    if not _exists.get(name):
+        _ensure_row(name, now)
+        _exists[name] = True
+        return _take(name, max_daily, n, now)
+
+    return False
+
+def _count(stat, n):
+    with _lock:
+        _stats[stat] += n
+
+def _give_back(name, lease):
+
+    # Return unused calls, as long as the counter hasn't started over since they were leased
+    #   (the lease must already be out of _leases, so no other thread can hand them out)
+    if not lease.remaining:
+        return
+
+    api = models.API.__table__
+
+    statement = api.update().where(api.c.name == name).where(
+        api.c.last_reset >= datetime.datetime.combine(lease.day, datetime.time.min)
+    ).values(
+        calls_today=api.c.calls_today - lease.remaining,
+        calls_total=api.c.calls_total - lease.remaining
+    )
+
+    with db.engine.begin() as connection:
+        connection.execute(statement)
+
+    _count('dbUpdates', 1)
+    _count('returned', lease.remaining)
+
+    lease.remaining = 0
+
+def reserve(name, max_daily, n=1):
+
+    """
+
+    Count calls to a third-party API against its daily limit.
+
+    With QUOTA_LEASE_SIZE greater than 1, each process leases blocks of calls
+        from the database and hands them out from memory. Unused calls are
+        returned every QUOTA_FLUSH_INTERVAL seconds (and when the process exits),
+        so the stored counts stay close to the real usage.
+
+    Only the lease bookkeeping is done under the process-wide lock, so reservations
+        from different threads can wait on the database at the same time.
+
+    Args:
+        name: The name of the API, as stored in the API table (required)
+        max_daily: The most calls that can be made in a day (required)
+        n: How many calls to count (optional)
+
+    Returns:
+        True if the calls can be made, or False if the limit has been reached
+
+    """
+
+    now = datetime.datetime.now()
+    lease_size = app.config['QUOTA_LEASE_SIZE']
+
+    _flush(force=False)
+
+    # Without leasing, every reservation goes straight to the database (the UPDATE is atomic)
+    if lease_size <= 1:
+        reserved = _take(name, max_daily, n, now)
+        _count('reserved' if reserved else 'rejected', n)
+        return reserved
+
+    with _lock:
+
+        lease = _leases.get(name)
+
+        # Hand the calls out from this process's lease if it has enough left today
+        if lease and lease.day == now.date() and lease.remaining >= n:
+            lease.remaining -= n
+            _stats['reserved'] += n
+            return True
+
+        # Otherwise take the lease out, so that only this thread returns what is left of it
+        old = _leases.pop(name, None)
+
+    # A lease from a previous day is dropped (its calls were counted on that day)
+    if old and old.day == now.date():
+        _give_back(name, old)
+
+    # Lease a new block, falling back to exactly n calls near the limit
+    size = max(lease_size, n)
+    reserved = _take(name, max_daily, size, now)
+
+    if not reserved and size > n:
+        size = n
+        reserved = _take(name, max_daily, size, now)
+
+    replaced = None
+
+    with _lock:
+
+        if reserved:
+            lease = Lease(now.date(), size)
+            lease.remaining -= n
+            replaced = _leases.get(name)
+            _leases[name] = lease
+
+        _stats['reserved' if reserved else 'rejected'] += n
+
+    # Another thread leased a block at the same time
+    if replaced and replaced.day == now.date():
+        _give_back(name, replaced)
+
+    return reserved
+
+def reserve_budget(user_id, max_daily, n, retry=True):
+
+    """
+
+    Count n calls against a user's own daily budget, with the same kind of conditional UPDATE as _take.
+
+    Budgets are kept in the fetch_budget table, one row per user, apart from the
+        third-party APIs' limits (they aren't leased or reported with them).
+
+    Returns:
+        True if the calls were counted
+
+    """
+
+    if n > max_daily:
+        return False
+
+    budget = models.FetchBudget.__table__
+    today = datetime.date.today()
+    new_day = budget.c.day < today
+
+    # MySQL applies SET clauses from left to right, so day (the last column) must be assigned last
+    statement = budget.update().where(budget.c.user_id == user_id).where(
+        or_(new_day, budget.c.fetches + n <= max_daily)
+    ).values(
+        fetches=case([(new_day, n)], else_=budget.c.fetches + n),
+        day=today
+    )
+
+    with db.engine.begin() as connection:
+        result = connection.execute(statement)
+
+    if result.rowcount:
+        return True
+
+    if not retry:
+        return False
+
+    # The user might not have a row yet (another process may be adding it at the same time)
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(budget.insert().values(user_id=user_id, fetches=0, day=today))
+    except IntegrityError:
+        pass
+
+    return reserve_budget(user_id, max_daily, n, retry=False)
+
+def _flush(force=True):
+
+    global _last_flush
+
+    # Take the leases out under the lock, then return their calls without holding it
+    with _lock:
+
+        if not force and time.monotonic() - _last_flush <= app.config['QUOTA_FLUSH_INTERVAL']:
+            return
+
+        leases = list(_leases.items())
+        _leases.clear()
+        _last_flush = time.monotonic()
+
+    for name, lease in leases:
+        if lease.day == datetime.date.today():
+            _give_back(name, lease)
+
+def flush():
+
+    """
+
+    Return this process's unused leased calls to the database.
+
+    """
+
+    _flush()
+
+def stats():
+    with _lock:
+        return dict(_stats, leased={ name: lease.remaining for name, lease in _leases.items() })
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        with app.app_context():
+            flush()
+    except Exception:
+        pass
+
+metrics.register('quota', stats)
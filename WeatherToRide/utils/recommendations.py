@@ -0,0 +1,195 @@
+
+from .. import app, db, models
+
+from . import hourly
+
+from sqlalchemy import or_, select
+
+import datetime
+
+# Route day columns, indexed by date.weekday()
+weekdays = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+def combine_recommendations(*levels):
+
+    """
+
+    Cascade down danger levels to provide a singular recommendation (unknown weather counts as ok).
+
+    """
+
+    return max(models.RIDE_OK if x is None else x for x in levels)
+
+def refresh_routes(routes):
+
+    """
+
+    Recompute the stored recommendations for some routes from their two forecasts.
+
+    One row is stored for each forecast day that falls on one of the route's days.
+        The changes join the caller's transaction, so they are saved (or rolled
+        back) along with the forecast or route that caused them.
+
+    Routes with departure or return times also get a level for the ROUTE_WINDOW_MINUTES
+        after each one, on the days that the hourly forecasts cover. Every window of
+        every route is scored in one pass, and a day's recommendation is the worst of
+        its windows (falling back on the whole day for windows that aren't covered).
+
+    Args:
+        routes: The Routes to recompute (required)
+
+    """
+
+    if not routes:
+        return
+
+    # Make pending routes and forecasts visible to the queries below
+    db.session.flush()
+
+    location_ids = set(x.location_id_1 for x in routes) | set(x.location_id_2 for x in routes)
+
+    forecast = models.Forecast.__table__
+    forecast_day = models.ForecastDay.__table__
+
+    # The packed hours are only needed for routes with times
+    timed = any(x.depart_time or x.return_time for x in routes)
+    columns = [forecast.c.location_id, forecast.c.updated_at] + ([forecast.c.hourly_start, forecast.c.hourly] if timed else [])
+
+    # When each forecast's first day was, and its packed hours
+    first_days = {}
+    hours = {}
+
+    for row in db.session.execute(select(columns).where(forecast.c.location_id.in_(location_ids))):
+        if row.updated_at:
+            first_days[row.location_id] = row.updated_at.date()
+        if timed and row.hourly_start and row.hourly:
+            hours[row.location_id] = (row.hourly_start, row.hourly)
+
+    levels = {}
+
+    for row in db.session.execute(
+        select([forecast_day.c.location_id, forecast_day.c.day, forecast_day.c.recommendation]).where(forecast_day.c.location_id.in_(location_ids))
+    ):
+        levels.setdefault(row.location_id, {})[row.day] = row.recommendation
+
+    rows = []
+
+    # The windows to score, as (row number, column, start, locations)
+    windows = []
+    length = datetime.timedelta(minutes=app.config['ROUTE_WINDOW_MINUTES'])
+
+    for route in routes:
+
+        # Routes need both forecasts (the first location's forecast dates the days)
+        if not all(x in first_days and x in levels for x in (route.location_id_1, route.location_id_2)):
+            continue
+
+        levels_1 = levels[route.location_id_1]
+        levels_2 = levels[route.location_id_2]
+
+        for day in sorted(set(levels_1) & set(levels_2)):
+
+            date = first_days[route.location_id_1] + datetime.timedelta(days=day)
+
+            if getattr(route, weekdays[date.weekday()]):
+
+                row = {
+                    'route_id': route.id,
+                    'day': day,
+                    'date': date,
+                    'recommendation': combine_recommendations(levels_1[day], levels_2[day]),
+                    'depart_recommendation': None,
+                    'return_recommendation': None
+                }
+
+                rows.append(row)
+
+                for column, time in (('depart_recommendation', route.depart_time), ('return_recommendation', route.return_time)):
+                    if time:
+                        windows.append((len(rows) - 1, column, datetime.datetime.combine(date, time), (route.location_id_1, route.location_id_2)))
+
+    if windows:
+
+        scores = hourly.score_windows(hours, [(start, start + length, keys) for i, column, start, keys in windows])
+
+        row_scores = {}
+        for (i, column, start, keys), score in zip(windows, scores):
+            rows[i][column] = score
+            row_scores.setdefault(i, []).append(score)
+
+        # The worst window sets the day's recommendation (the whole day stands in for windows the hours don't cover)
+        for i, found in row_scores.items():
+            if any(x is not None for x in found):
+                day_level = rows[i]['recommendation']
+                rows[i]['recommendation'] = combine_recommendations(*(day_level if x is None else x for x in found))
+
+    # Replace the rows for every route in bulk
+    models.RouteRecommendation.query.filter(
+        models.RouteRecommendation.route_id.in_([x.id for x in routes])
+    ).delete(synchronize_session=False)
+
+    db.session.bulk_insert_mappings(models.RouteRecommendation, rows)
+
+def refresh_locations(location_ids):
+
+    """
+
+    Recompute the stored recommendations for every route that uses one of these locations.
+
+    """
+
+    if not location_ids:
+        return
+
+    refresh_routes(location_routes_query(location_ids).all())
+
+def location_routes_query(location_ids):
+
+    # Every route that uses one of these locations (also explained by check-plans)
+    return models.Route.query.filter(or_(
+        models.Route.location_id_1.in_(location_ids),
+        models.Route.location_id_2.in_(location_ids)
+    ))
+
+def delete_routes(route_ids):
+
+    # Remove the stored recommendations for routes that are about to be deleted
+    if route_ids:
+        models.RouteRecommendation.query.filter(
+            models.RouteRecommendation.route_id.in_(route_ids)
+        ).delete(synchronize_session=False)
+
+def load(route_ids, start, days=None):
+
+    """
+
+    Load the stored recommendations for some routes with one query (on the primary key).
+
+    Args:
+        route_ids: The IDs of the routes (required)
+        start: The first date to include (required)
+        days: How many days to include (optional, FORECAST_DAYS by default)
+
+    Returns:
+        A dict of route ID -> RouteRecommendations, in date order
+
+    """
+
+    result = { x: [] for x in route_ids }
+
+    if not route_ids:
+        return result
+
+    for row in load_query(route_ids, start, days):
+        result[row.route_id].append(row)
+
+    return result
+
+def load_query(route_ids, start, days=None):
+
+    # The query behind load (also explained by check-plans)
+    return models.RouteRecommendation.query.filter(
+        models.RouteRecommendation.route_id.in_(route_ids),
+        models.RouteRecommendation.date >= start,
+        models.RouteRecommendation.date < start + datetime.timedelta(days=days or app.config['FORECAST_DAYS'])
+    ).order_by(models.RouteRecommendation.route_id, models.RouteRecommendation.date)
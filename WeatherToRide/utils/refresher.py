@@ -0,0 +1,306 @@
+
+from .. import app, db, models
+
+from . import metrics, weather
+
+from sqlalchemy.orm import joinedload
+
+import datetime
+import heapq
+import logging
+import queue
+import threading
+
+log = logging.getLogger(__name__)
+
+class ForecastRefresher(object):
+
+    """
+
+    Keep every location's forecast fresh from outside of the request path.
+
+    Locations are kept in a priority queue ordered by the time their forecast
+        goes stale. Each forecast is refreshed FORECAST_REFRESH_LEAD seconds
+        before it reaches MAX_FORECAST_AGE, so page views only ever read.
+
+    The queue is rebuilt from the database every FORECAST_RESCAN_INTERVAL seconds
+        to pick up new, moved and deleted locations.
+
+    A refresh may reuse a cached response that is newer than the lead. The forecast
+        keeps the time that response was fetched, so it goes stale on schedule.
+
+    """
+
+    def __init__(self):
+
+        # A forecast refreshed from a response that is one lead old must not be due again
+        #   right away, so the lead can be at most half of MAX_FORECAST_AGE
+        self.lead = min(datetime.timedelta(seconds=app.config['FORECAST_REFRESH_LEAD']), weather.MAX_FORECAST_AGE / 2)
+
+        self.retry_delay = datetime.timedelta(seconds=app.config['FORECAST_RETRY_DELAY'])
+        self.rescan_interval = datetime.timedelta(seconds=app.config['FORECAST_RESCAN_INTERVAL'])
+        self.refreshed = 0
+        self.failed = 0
+        self._queue = []
+        self._last_scan = None
+        self._stop = threading.Event()
+
+    def due_time(self, updated_at, now):
+
+        # Locations without a forecast are due immediately
+        if not updated_at:
+            return now
+
+        return updated_at + weather.MAX_FORECAST_AGE - self.lead
+
+    def rescan(self, now):
+
+        # One query for every location and the age of its forecast
+        rows = db.session.query(models.Location.id, models.Forecast.updated_at).outerjoin(
+            models.Forecast, models.Forecast.location_id == models.Location.id
+        ).all()
+
+        self._queue = [(self.due_time(updated_at, now), location_id) for location_id, updated_at in rows]
+        heapq.heapify(self._queue)
+
+        self._last_scan = now
+
+    def run_once(self, now=None):
+
+        """
+
+        Refresh every forecast that is due, then return the time of the next due entry.
+
+        """
+
+        now = now or datetime.datetime.now()
+
+        if not self._last_scan or now - self._last_scan >= self.rescan_interval:
+            self.rescan(now)
+
+        due = []
+        while self._queue and self._queue[0][0] <= now:
+            due.append(heapq.heappop(self._queue)[1])
+
+        # Load the due locations (and their forecasts) in one query
+        locations = []
+        if due:
+            locations = models.Location.query.options(joinedload(models.Location.forecast)).filter(
+                models.Location.id.in_(due)
+            ).all()
+
+        stale = []
+        for location in locations:
+
+            # Another location in the same grid cell may have refreshed this one already
+            if location.forecast and self.due_time(location.forecast.updated_at, now) > now:
+                heapq.heappush(self._queue, (self.due_time(location.forecast.updated_at, now), location.id))
+            else:
+                stale.append(location)
+
+        # Refresh the rest in one batch (locations deleted since the last scan are dropped, 
+        #   and cached responses are only reused if they are newer than the refresh lead)
+        forecasts, errors = weather.update_forecasts(stale, max_age=self.lead) if stale else ({}, {})
+
+        for location in stale:
+
+            if location.id in errors:
+                log.warning('Could not refresh forecast for location %s: %s', location.id, errors[location.id])
+                self.failed += 1
+                heapq.heappush(self._queue, (now + self.retry_delay, location.id))
+            else:
+                self.refreshed += 1
+
+                # Never reschedule into this cycle, even if the clock moved backwards
+                next_due = max(self.due_time(forecasts[location.id].updated_at, now), now + datetime.timedelta(seconds=1))
+                heapq.heappush(self._queue, (next_due, location.id))
+
+        next_run = self._last_scan + self.rescan_interval
+
+        if self._queue:
+            next_run = min(next_run, self._queue[0][0])
+
+        return next_run
+
+    def run_forever(self):
+
+        while not self._stop.is_set():
+
+            try:
+                next_run = self.run_once()
+            except Exception:
+                log.exception('Forecast refresh cycle failed.')
+                next_run = datetime.datetime.now() + self.retry_delay
+            finally:
+                # Don't hold on to ORM objects (or a connection) between cycles
+                db.session.remove()
+
+            wait = (next_run - datetime.datetime.now()).total_seconds()
+            self._stop.wait(max(wait, 1))
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        return {
+            "queued": len(self._queue),
+            "refreshed": self.refreshed,
+            "failed": self.failed,
+            "lastScan": self._last_scan.isoformat() if self._last_scan else None
+        }
+
+def start_thread():
+
+    """
+
+    Run a ForecastRefresher on a daemon thread inside of this process.
+
+    """
+
+    refresher = ForecastRefresher()
+
+    def run():
+        with app.app_context():
+            refresher.run_forever()
+
+    thread = threading.Thread(target=run, name='forecast-refresher', daemon=True)
+    thread.start()
+
+    metrics.register('forecastRefresher', refresher.stats)
+
+    return refresher
+
+class Revalidator(object):
+
+    """
+
+    Refresh stale forecasts on a background thread for requests that already served them.
+
+    Each location is only queued once while a refresh for it is pending.
+
+    """
+
+    def __init__(self):
+        self.requested = 0
+        self.refreshed = 0
+        self.failed = 0
+        self._pending = set()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def request(self, location_ids):
+
+        with self._lock:
+
+            new = [x for x in location_ids if x not in self._pending]
+            if not new:
+                return
+
+            self._pending.update(new)
+            self.requested += len(new)
+            self._queue.put(new)
+
+            # Start the worker thread the first time it is needed
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run, name='forecast-revalidator', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+
+        with app.app_context():
+
+            while True:
+
+                # Refresh everything that has been requested so far as one batch
+                ids = self._queue.get()
+                while not self._queue.empty():
+                    ids.extend(self._queue.get_nowait())
+
+                try:
+                    locations = models.Location.query.filter(models.Location.id.in_(ids)).all()
+
+                    # A cached response older than MAX_FORECAST_AGE would leave them just as stale
+                    forecasts, errors = weather.update_forecasts(locations, max_age=weather.MAX_FORECAST_AGE)
+                    self.refreshed += len(forecasts)
+                    self.failed += len(errors)
+                except Exception:
+                    log.exception('Forecast revalidation failed.')
+                    self.failed += len(ids)
+                finally:
+                    db.session.remove()
+                    with self._lock:
+                        self._pending.difference_update(ids)
+
+    def stats(self):
+        return {
+            "pending": len(self._pending),
+            "requested": self.requested,
+            "refreshed": self.refreshed,
+            "failed": self.failed
+        }
+
+def revalidate(locations):
+
+    """
+
+    Decide how each location's stored forecast should be served.
+
+    With FORECAST_SERVE_STALE enabled, forecasts older than MAX_FORECAST_AGE are 
+        served as they are while a refresh is started in the background. Only 
+        forecasts older than MAX_STALE_FORECAST_AGE (or missing) are refreshed 
+        before responding, or reported as errors if STALE_FORECAST_ACTION is 'error'.
+
+    With it disabled, every stale forecast is refreshed before responding.
+
+    Args:
+        locations: The Locations about to be served (required)
+
+    Returns:
+        freshness, errors - Dicts keyed by location ID
+
+        freshness: Staleness flag and age of each forecast that can be served
+        errors: Why a location's forecast can't be served
+
+    """
+
+    now = datetime.datetime.now()
+
+    max_stale_age = datetime.timedelta(seconds=app.config['MAX_STALE_FORECAST_AGE'])
+    serve_stale = app.config['FORECAST_SERVE_STALE']
+
+    stale = []
+    expired = []
+
+    for location in locations:
+        forecast = location.forecast
+        if not forecast or now - forecast.updated_at > max_stale_age:
+            expired.append(location)
+        elif now - forecast.updated_at > weather.MAX_FORECAST_AGE:
+            stale.append(location)
+
+    errors = {}
+
+    if not serve_stale:
+        expired.extend(stale)
+    elif stale:
+        revalidator.request([x.id for x in stale])
+
+    # Forecasts that are too old to serve at all
+    if expired:
+        if serve_stale and app.config['STALE_FORECAST_ACTION'] == 'error':
+            errors = { x.id: 'The forecast for this location is out of date.' for x in expired }
+        else:
+            forecasts, errors = weather.update_forecasts(expired, max_age=weather.MAX_FORECAST_AGE)
+
+    freshness = {}
+
+    for location in locations:
+        if location.id not in errors and location.forecast:
+            freshness[location.id] = weather.forecast_freshness(location.forecast, now)
+
+    return freshness, errors
+
+revalidator = Revalidator()
+
+metrics.register('forecastRevalidator', revalidator.stats)
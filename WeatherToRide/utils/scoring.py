@@ -0,0 +1,90 @@
+
+from .. import app
+
+import math
+import numpy
+
+# The numeric ForecastDay columns, with the Dark Sky daily field each one comes from
+FIELDS = {
+    'precip_probability': 'precipProbability',
+    'precip_intensity': 'precipIntensity',
+    'wind_speed': 'windSpeed',
+    'wind_gust': 'windGust',
+    'temperature_high': 'temperatureHigh',
+    'temperature_low': 'temperatureLow',
+    'visibility': 'visibility'
+}
+
+def _column(values):
+
+    # Missing values (None) become NaN
+    return numpy.asarray(values, dtype=float)
+
+def score(columns, icon_levels=None):
+
+    """
+
+    Score many forecast days at once from their numeric fields.
+
+    Each field is compared with its (warn, danger) thresholds from RIDE_MAX_THRESHOLDS
+        (too high) or RIDE_MIN_THRESHOLDS (too low), and each day takes the worst
+        level of any field or its icon. Missing values don't count either way.
+
+    Args:
+        columns: A dict of field name -> sequence of values, all the same length (required)
+        icon_levels: The level from each day's icon, None where it wasn't recognized (optional)
+
+    Returns:
+        An array of levels (as floats), NaN for days with nothing to score them on
+
+    """
+
+    size = len(next(iter(columns.values())))
+
+    levels = numpy.full(size, numpy.nan) if icon_levels is None else _column(icon_levels)
+
+    for thresholds, higher in ((app.config['RIDE_MAX_THRESHOLDS'], True), (app.config['RIDE_MIN_THRESHOLDS'], False)):
+
+        for field, (warn, danger) in thresholds.items():
+
+            if field not in columns:
+                continue
+
+            values = _column(columns[field])
+
+            # NaN compares as False, so the missing values are put back afterwards
+            with numpy.errstate(invalid='ignore'):
+                if higher:
+                    field_levels = (values >= warn).astype(float) + (values >= danger)
+                else:
+                    field_levels = (values <= warn).astype(float) + (values <= danger)
+
+            field_levels[numpy.isnan(values)] = numpy.nan
+
+            # The worst level so far (fmax ignores NaN)
+            levels = numpy.fmax(levels, field_levels)
+
+    return levels
+
+def score_rows(rows):
+
+    """
+
+    Score ForecastDay rows (as dicts) in place, cascading their numeric fields into the icon's recommendation.
+
+    Returns:
+        rows
+
+    """
+
+    if not rows:
+        return rows
+
+    columns = { field: [x.get(field) for x in rows] for field in FIELDS }
+
+    levels = score(columns, [x.get('recommendation') for x in rows])
+
+    for row, level in zip(rows, levels.tolist()):
+        row['recommendation'] = None if math.isnan(level) else int(level)
+
+    return rows
@@ -0,0 +1,82 @@
+
+from .. import app, db, models
+
+from . import metrics
+from .cache import MISSING, TTLCache
+
+from flask_login import UserMixin
+
+class CachedUser(UserMixin):
+
+    """
+
+    A plain copy of a User's columns, kept between requests instead of the ORM object.
+
+    The user's locations, routes and developer key are queried whenever they
+        are used, since they change far more often than the user does. Each access
+        is a query, so read them once per request.
+
+    """
+
+    def __init__(self, id, name, email, email_confirmed):
+        self.id = id
+        self.name = name
+        self.email = email
+        self.email_confirmed = email_confirmed
+
+    @property
+    def locations(self):
+        return models.Location.query.filter_by(user_id=self.id).order_by(models.Location.id).all()
+
+    @property
+    def routes(self):
+        return models.Route.query.filter_by(user_id=self.id).order_by(models.Route.id).all()
+
+    @property
+    def developer(self):
+        return models.Developer.query.filter_by(user_id=self.id).first()
+
+def load(user_id):
+
+    """
+
+    Get the user for a session (this is Flask-Login's user loader).
+
+    Returns:
+        A CachedUser, or None if the user doesn't exist
+
+    """
+
+    user = user_cache.get(user_id)
+
+    if user is MISSING:
+
+        row = db.session.query(
+            models.User.id, models.User.name, models.User.email, models.User.email_confirmed
+        ).filter(models.User.id == user_id).first()
+
+        # Users that don't exist aren't cached, so that nothing is kept for made-up IDs
+        if not row:
+            return None
+
+        user = CachedUser(*row)
+        user_cache.set(user_id, user)
+
+    return user
+
+def forget(user_id):
+
+    """
+
+    Drop a user from this process's cache. Call this whenever a user is changed or deleted.
+
+    Other processes notice within USER_CACHE_TTL seconds.
+
+    """
+
+    user_cache.delete(user_id)
+
+# User ID -> CachedUser
+user_cache = TTLCache(max_size=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
+
+metrics.register('userCache', user_cache.stats)
@@ -1,5 +1,13 @@
 
-from .. import models
+from .. import app, db, models
+
+from . import metrics
+from .cache import MISSING, TTLCache
+
+import collections
+
+# What an API key authenticates as (just the user's ID, so that no user row is loaded)
+DeveloperUser = collections.namedtuple('DeveloperUser', ['id'])
 
 def validate_user(id):
     
@@ -19,19 +27,54 @@ def validate_user(id):
 
 def validate_developer(key):
 
+    """
+
+    Authenticate an API key.
+
+    Keys are cached in memory (invalid ones too, for a shorter time), so a key
+        that was seen recently is authenticated without touching the database.
+
+    Returns:
+        user, error - A DeveloperUser with the ID of the key's owner, plus any error
+
+    """
+
     if type(key) is not str:
         return None, 'API key must be a string.'
-    
+
+    user = developer_cache.get(key)
+
     # Try to find the developer in the database
-    developer = None
-    try:
-        developer = models.Developer.query.filter_by(key=key).first()
-    except:
-        return None, 'Error while trying to authenticate API key.'
-    if not developer:
+    if user is MISSING:
+        try:
+            user_id = db.session.query(models.Developer.user_id).filter_by(key=key).scalar()
+        except:
+            return None, 'Error while trying to authenticate API key.'
+
+        if user_id is None:
+            user = None
+            developer_cache.set(key, user, ttl=app.config['DEVELOPER_NEGATIVE_TTL'])
+        else:
+            user = DeveloperUser(user_id)
+            developer_cache.set(key, user)
+
+    if not user:
         return None, 'The API key is invalid.'
     else:
-        return developer.user, None
+        return user, None
+
+def forget_developer(key):
+
+    """
+
+    Drop an API key from this process's cache. Call this whenever a key is 
+        created, deleted or moved to another user (or its user is deleted).
+
+    Other processes notice within DEVELOPER_CACHE_TTL (or DEVELOPER_NEGATIVE_TTL) seconds.
+
+    """
+
+    developer_cache.delete(key)
 
 def validate_location(id):
 
@@ -64,3 +107,8 @@ def validate_route(id):
         return None, 'Route does not exist.'
     else:
         return route, None
+
+# API key -> DeveloperUser (or None for invalid keys)
+developer_cache = TTLCache(max_size=app.config['DEVELOPER_CACHE_SIZE'], ttl=app.config['DEVELOPER_CACHE_TTL'])
+
+metrics.register('developerCache', developer_cache.stats)
@@ -1,12 +1,27 @@
 
 from .. import app, db, models
 
+from . import hourly, metrics, quota, recommendations, scoring
+from .cache import MISSING, TTLCache
+
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+
 import datetime
+import math
 import requests
 
 API_NAME = 'Dark Sky'
 MAX_DAILY_CALLS = 500
 
+FETCH_ERROR = 'There was a problem while trying to get the weather for this location.'
+
+# How old can forecasts be before needing to be refreshed?
+MAX_FORECAST_AGE = datetime.timedelta(seconds=900)
+
 # Icons from https://www.flaticon.com/
 icon_map = { 
     'clear-day': 'clear-day', 
@@ -21,23 +36,52 @@ icon_map = {
     'partly-cloudy-night': 'cloudy-night' 
 }
 
-ride_ok = 'Looks like great weather to go for a ride!'
-ride_warn = 'It should be ok to ride, but be careful!'
-ride_danger = 'It might be a good idea to take the car instead.'
-
+# Ride recommendation level for each icon (the numeric fields can make it worse, see scoring.py)
 recommendation_map = { 
-    'clear-day': ride_ok, 
-    'clear-night': ride_ok, 
-    'rain': ride_danger, 
-    'snow': ride_danger, 
-    'sleet': ride_danger, 
-    'wind': ride_warn, 
-    'fog': ride_warn, 
-    'cloudy': ride_ok, 
-    'partly-cloudy-day': ride_ok, 
-    'partly-cloudy-night': ride_ok 
+    'clear-day': models.RIDE_OK, 
+    'clear-night': models.RIDE_OK, 
+    'rain': models.RIDE_DANGER, 
+    'snow': models.RIDE_DANGER, 
+    'sleet': models.RIDE_DANGER, 
+    'wind': models.RIDE_WARN, 
+    'fog': models.RIDE_WARN, 
+    'cloudy': models.RIDE_OK, 
+    'partly-cloudy-day': models.RIDE_OK, 
+    'partly-cloudy-night': models.RIDE_OK 
 }
 
+def fetch_forecast(key, lat, lng):
+
+    """
+
+    Request a forecast from the Dark Sky API over the shared HTTP session.
+
+    This doesn't touch the database, so it is safe to run on worker threads.
+
+    Returns:
+        response, error
+
+    """
+
+    # Try to query the Dark Sky API
+    try:
+
+        response = http.get(request_url(key, lat, lng), timeout=app.config['FORECAST_FETCH_TIMEOUT'])
+        response.raise_for_status()
+        response = response.json()
+
+        if not response:
+            return None, 'The API returned an empty response.'
+
+    except:
+        return None, FETCH_ERROR
+
+    # Return the response
+    return response, None
+
+def request_url(key, lat, lng):
+    return f"{app.config['DARKSKY_URL']}/forecast/{key}/{lat},{lng}"
+
 def get_forecast_from_api(lat, lng):
 
     """
@@ -62,122 +106,404 @@ def get_forecast_from_api(lat, lng):
     except:
         return None, 'The weather API key is not configured.'
 
-    # Get the current date/time
+    # Count this call against the daily limit
+    if not quota.reserve(API_NAME, MAX_DAILY_CALLS):
+        return None, 'The weather service has reached capacity for today.'
+
+    return fetch_forecast(key, lat, lng)
+
+def grid_cell(lat, lng):
+
+    """
+
+    Get the forecast grid cell that contains a pair of coordinates.
+
+    Locations in the same cell share one forecast, so the cell size 
+        (FORECAST_GRID_SIZE, in degrees) trades accuracy for API calls.
+
+    """
+
+    size = app.config['FORECAST_GRID_SIZE']
+
+    # Rounded before flooring, so a point on an edge lands in the same cell as cell_bounds (and the SQL) put it
+    #   (e.g. 0.3 / 0.1 is 2.9999999999999996)
+    return math.floor(round(float(lat) / size, 9)), math.floor(round(float(lng) / size, 9))
+
+def cell_bounds(cell):
+
+    """
+
+    Get the bounds of a grid cell as (min_lat, min_lng, max_lat, max_lng).
+
+    """
+
+    size = app.config['FORECAST_GRID_SIZE']
+
+    # Round to the precision of the Location columns
+    return tuple(round(x * size, 6) for x in (cell[0], cell[1], cell[0] + 1, cell[1] + 1))
+
+def cell_center(cell):
+
+    min_lat, min_lng, max_lat, max_lng = cell_bounds(cell)
+
+    return round((min_lat + max_lat) / 2, 6), round((min_lng + max_lng) / 2, 6)
+
+def get_forecasts_for_cells(cells, max_age=None, checked=None):
+
+    """
+
+    Get the forecast for many grid cells, reusing cached responses when possible.
+
+    Cache misses are counted against the daily limit up front, then fetched 
+        concurrently on a bounded thread pool. Each forecast is requested for 
+        the center of its cell so that every location inside gets the same answer.
+
+    Args:
+        cells: An iterable of grid cells (required)
+        max_age: Refetch cached responses older than this timedelta (optional)
+        checked: What check_cache already found for these cells, to use instead of checking again (optional)
+
+    Returns:
+        responses, errors - Dicts keyed by grid cell
+
+        responses: (response, fetched_at) for each cell that was found
+
+    """
+
     now = datetime.datetime.now()
 
-    # Get the entry for this API from the database
-    status = models.API.query.filter_by(name=API_NAME).first()
+    responses, errors, reserved, key = reserve_cells(cells, max_age, now, checked)
 
-    # If there isn't an entry for this API yet
-    if not status:
-        status = models.API(name=API_NAME)
-        status.calls_today = 0
-        status.calls_total = 0
-        status.last_reset = now
-        db.session.add(status)
-        db.session.commit()
+    # Fetch the forecasts concurrently
+    futures = { cell: fetch_pool.submit(fetch_forecast, key, *cell_center(cell)) for cell in reserved }
 
-    # Check if the API call limit needs to be refreshed
-    if now.date() > status.last_reset.date():
-        status.calls_today = 0
-        status.last_reset = now
-        db.session.add(status)
-        db.session.commit()
+    for cell, future in futures.items():
+        response, error = future.result()
+        if error:
+            errors[cell] = error
+        else:
+            responses[cell] = store_response(cell, response, now)
 
-    # Check if the API has reached its call limit for today
-    if status.calls_today >= MAX_DAILY_CALLS:
-        return None, 'The weather service has reached capacity for today.'
-    else:
-        status.calls_today += 1
-        status.calls_total += 1
-        db.session.add(status)
-        db.session.commit()
+    return responses, errors
 
-    # Try to query the Dark Sky API
-    try:
+def reserve_cells(cells, max_age=None, now=None, checked=None):
 
-        url = f'https://api.darksky.net/forecast/{key}/{lat},{lng}'
+    """
 
-        response = requests.get(url).json()
+    Answer what can be answered from the cache, and count the rest against the daily limit.
 
-        if not response:
-            return None, 'The API returned an empty response.'
+    This is the part of get_forecasts_for_cells that uses the database, so that the 
+        requests themselves can be made by any HTTP client (see asyncapi.py).
 
+    Returns:
+        responses, errors, reserved, key
+
+        reserved: The cells to request a forecast for (with the API key)
+
+    """
+
+    errors = {}
+
+    # Check the cache first (unless the caller already has, e.g. to count the pending cells)
+    responses, pending = check_cache(cells, max_age, now) if checked is None else (dict(checked[0]), list(checked[1]))
+
+    if not pending:
+        return responses, errors, [], None
+
+    # Check for the API key
+    try:
+        key = app.config['DARKSKY_KEY']
     except:
-        return None, 'There was a problem while trying to get the weather for this location.'
+        return responses, { cell: 'The weather API key is not configured.' for cell in pending }, [], None
 
-    # Return the response
-    return response, None
+    # Count the calls against the daily limit (this uses the database, so it stays on this thread)
+    reserved = []
+    for cell in pending:
+        if quota.reserve(API_NAME, MAX_DAILY_CALLS):
+            reserved.append(cell)
+        else:
+            errors[cell] = 'The weather service has reached capacity for today.'
+
+    return responses, errors, reserved, key
+
+def check_cache(cells, max_age=None, now=None):
+
+    """
+
+    Split grid cells into those with a usable cached response, and those that would need an API call.
+
+    Returns:
+        responses, pending - A dict of cell -> (response, fetched_at), and a list of cells
+
+    """
+
+    responses = {}
+    pending = []
 
-def update_forecast(location):
+    now = now or datetime.datetime.now()
 
-    # Get the forecast for this location
-    response, error = get_forecast_from_api(location.lat, location.lng)
+    for cell in set(cells):
+        cached = forecast_cache.get(cell)
+        if cached is not MISSING and (max_age is None or now - cached[1] <= max_age):
+            responses[cell] = cached
+        else:
+            pending.append(cell)
 
-    # If there was a problem fetching the forecast
-    if error:
-        return None, error
+    return responses, pending
+
+def store_response(cell, response, fetched_at):
+
+    # Share the response with every location in the cell until it expires
+    forecast_cache.set(cell, (response, fetched_at))
+
+    return response, fetched_at
+
+def get_forecast_for_cell(cell):
+
+    """
+
+    Get the forecast for a single grid cell (see get_forecasts_for_cells).
+
+    Returns:
+        response, error
+
+    """
+
+    responses, errors = get_forecasts_for_cells([cell])
+
+    if cell in errors:
+        return None, errors[cell]
+
+    return responses[cell][0], None
+
+def parse_daily(response):
+
+    """
+
+    Extract the first FORECAST_DAYS daily forecasts from a Dark Sky response (which sends 8).
+
+    Returns:
+        daily, error
+
+    """
 
-    # Extract the daily forecasts from the response
     try:
-        response = response['daily']['data']
+        daily = response['daily']['data']
     except:
         return None, 'There was a problem while trying to get the daily forecast for this location.'
 
-    if len(response) < 8:
-        return None, f'The daily forecast list received is smaller than expected ({len(daily)} instead of 8).'
+    if not daily:
+        return None, 'The daily forecast list received is empty.'
+
+    return daily[:app.config['FORECAST_DAYS']], None
 
-    # Get this location's forecast entry from the database
-    forecast = models.Forecast.query.filter_by(location_id=location.id).first()
+def _number(value):
 
-    # If there isn't a pre-existing entry, then create one
-    if not forecast:
-        forecast = models.Forecast(location_id=location.id)
+    # Numeric fields that are missing (or not numbers) are stored as NULL
+    return float(value) if type(value) in (int, float) else None
+
+def _day_rows(daily):
+
+    # The ForecastDay rows for a list of daily forecasts, with only the icon's recommendation
+    return [ 
+        { 
+            'day': i, 
+            'icon': icon_map.get(x['icon'], 'unknown'), 
+            'summary': x['summary'][:255], 
+            'recommendation': recommendation_map.get(x['icon']), 
+            **{ field: _number(x.get(key)) for field, key in scoring.FIELDS.items() } 
+        } 
+        for i, x in enumerate(daily) 
+    ]
+
+def cell_forecast_days(daily):
+
+    """
+
+    Build and score the ForecastDay rows for many grid cells at once.
+
+    The recommendations are scored from the icons and numeric fields (see scoring.py).
+
+    Args:
+        daily: A dict of grid cell -> list of daily forecasts (required)
+
+    Returns:
+        A dict of grid cell -> rows (without a location ID)
+
+    """
+
+    rows = { cell: _day_rows(x) for cell, x in daily.items() }
+
+    # Score every day of every cell in one pass
+    scoring.score_rows([x for days in rows.values() for x in days])
+
+    return rows
+
+def parse_hourly(response):
+
+    """
+
+    Pack the hourly block of a Dark Sky response (see hourly.py).
+
+    Returns:
+        start, packed - The location's local time of the first hour, and the packed hours (None, None if there aren't any)
+
+    """
 
-    # Add the new information to the forecast
     try:
+        hours = response['hourly']['data']
+        start = datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=hours[0]['time'], hours=response.get('offset', 0))
+    except:
+        return None, None
+
+    values = [[_number(x.get(key)) for key in hourly.FIELDS.values()] for x in hours]
+
+    return start, hourly.pack(values, [recommendation_map.get(x.get('icon')) for x in hours])
+
+def forecast_freshness(forecast, now=None):
+
+    """
+
+    Describe how old a forecast is, for marking stale data in responses.
+
+    """
+
+    age = (now or datetime.datetime.now()) - forecast.updated_at
+
+    return { 
+        "isStale": age > MAX_FORECAST_AGE, 
+        "ageSeconds": max(int(age.total_seconds()), 0) 
+    }
+
+def neighbors_query(cells):
 
-        forecast.day_0_icon = icon_map.get(response[0]['icon'], 'unknown')
-        forecast.day_0_summary = response[0]['summary']
-        forecast.day_0_recommendation = recommendation_map.get(response[0]['icon'], 'YOLO!')
+    # Every location (with its forecast) inside these grid cells (also explained by check-plans)
+    boxes = []
+    for cell in cells:
+        min_lat, min_lng, max_lat, max_lng = cell_bounds(cell)
+        boxes.append(and_( 
+            models.Location.lat >= min_lat, models.Location.lat < max_lat, 
+            models.Location.lng >= min_lng, models.Location.lng < max_lng 
+        ))
 
-        forecast.day_1_icon = icon_map.get(response[1]['icon'], 'unknown')
-        forecast.day_1_summary = response[1]['summary']
-        forecast.day_1_recommendation = recommendation_map.get(response[1]['icon'], 'YOLO!')
+    return models.Location.query.options(joinedload(models.Location.forecast)).filter(or_(*boxes))
 
-        forecast.day_2_icon = icon_map.get(response[2]['icon'], 'unknown')
-        forecast.day_2_summary = response[2]['summary']
-        forecast.day_2_recommendation = recommendation_map.get(response[2]['icon'], 'YOLO!')
+def update_forecasts(locations, max_age=None, retry=True):
 
-        forecast.day_3_icon = icon_map.get(response[3]['icon'], 'unknown')
-        forecast.day_3_summary = response[3]['summary']
-        forecast.day_3_recommendation = recommendation_map.get(response[3]['icon'], 'YOLO!')
+    """
+
+    Refresh the forecasts for many locations, along with every other location in their grid cells.
+
+    Each grid cell costs at most one API call. The calls are made concurrently, 
+        and all of the resulting Forecast rows are written in a single transaction.
+
+    A forecast's update time is when its response was fetched, which can be 
+        earlier than now if the response came from the cache.
+
+    Args:
+        locations: The Locations to refresh (required)
+        max_age: Refetch cached responses older than this timedelta (optional)
+        retry: Start over once if another request saved a forecast at the same time (optional)
 
-        forecast.day_4_icon = icon_map.get(response[4]['icon'], 'unknown')
-        forecast.day_4_summary = response[4]['summary']
-        forecast.day_4_recommendation = recommendation_map.get(response[4]['icon'], 'YOLO!')
+    Returns:
+        forecasts, errors - Dicts keyed by location ID
+
+    """
 
-        forecast.day_5_icon = icon_map.get(response[5]['icon'], 'unknown')
-        forecast.day_5_summary = response[5]['summary']
-        forecast.day_5_recommendation = recommendation_map.get(response[5]['icon'], 'YOLO!')
+    locations = list(locations)
+    cells = { location.id: grid_cell(location.lat, location.lng) for location in locations }
 
-        forecast.day_6_icon = icon_map.get(response[6]['icon'], 'unknown')
-        forecast.day_6_summary = response[6]['summary']
-        forecast.day_6_recommendation = recommendation_map.get(response[6]['icon'], 'YOLO!')
+    # Get the forecast for each grid cell
+    responses, cell_errors = get_forecasts_for_cells(cells.values(), max_age)
 
-        forecast.day_7_icon = icon_map.get(response[7]['icon'], 'unknown')
-        forecast.day_7_summary = response[7]['summary']
-        forecast.day_7_recommendation = recommendation_map.get(response[7]['icon'], 'YOLO!')
+    # Extract the daily forecasts from each response
+    daily = {}
+    for cell, (response, fetched_at) in responses.items():
+        daily[cell], error = parse_daily(response)
+        if error:
+            cell_errors[cell] = error
+            del daily[cell]
 
+    errors = { location.id: cell_errors[cells[location.id]] for location in locations if cells[location.id] in cell_errors }
+
+    if not daily:
+        return {}, errors
+
+    # Build the days and hours once for each cell (every location in a cell gets the same ones)
+    try:
+        days = cell_forecast_days(daily)
+        hours = { cell: parse_hourly(responses[cell][0]) for cell in daily }
     except:
-        return None, 'There was a problem extracting forecast data to the database.'
+        return {}, { location.id: 'There was a problem extracting forecast data to the database.' for location in locations }
+
+    # Find every location (and its forecast) that shares one of these grid cells
+    neighbors = neighbors_query(daily).all()
+
+    # Make sure the requested locations are included (e.g. if they haven't been flushed yet)
+    for location in locations:
+        if location not in neighbors:
+            neighbors.append(location)
+
+    rows = []
+
+    for neighbor in neighbors:
+
+        cell = cells.get(neighbor.id) or grid_cell(neighbor.lat, neighbor.lng)
+        if cell not in daily:
+            continue
+
+        # If there isn't a pre-existing entry, then create one
+        forecast = neighbor.forecast
+        if not forecast:
+            forecast = models.Forecast(location_id=neighbor.id)
+            neighbor.forecast = forecast
+
+        rows.extend(dict(x, location_id=neighbor.id) for x in days[cell])
+
+        # Set the update time on the forecast
+        forecast.updated_at = responses[cell][1]
+        forecast.hourly_start, forecast.hourly = hours[cell]
+
+        db.session.add(forecast)
+
+    try:
+
+        # Replace the days of every forecast in bulk, in the same transaction
+        models.ForecastDay.query.filter( 
+            models.ForecastDay.location_id.in_(set(x['location_id'] for x in rows)) 
+        ).delete(synchronize_session=False)
+
+        db.session.bulk_insert_mappings(models.ForecastDay, rows)
+
+        # Recompute the recommendations for routes using any of these locations
+        recommendations.refresh_locations(set(x['location_id'] for x in rows))
+
+        # Save every forecast at once
+        db.session.commit()
+
+    except IntegrityError:
+
+        db.session.rollback()
+
+        # Another request added a forecast for one of the neighbors first, so start 
+        #   over (once) with the forecasts as they are now (the responses are cached)
+        if retry:
+            return update_forecasts(locations, max_age, retry=False)
+
+        return {}, { location.id: 'There was a problem extracting forecast data to the database.' for location in locations }
+
+    forecasts = { location.id: location.forecast for location in locations if location.id not in errors }
+
+    return forecasts, errors
+
+# Forecast responses cached by grid cell
+forecast_cache = TTLCache(max_size=4096, ttl=app.config['FORECAST_CACHE_TTL'])
 
-    # Set the update time on the forecast
-    forecast.updated_at = datetime.datetime.now()
+metrics.register('forecastCache', forecast_cache.stats)
 
-    # Add the forecast to the database
-    db.session.add(forecast)
-    db.session.commit()
+# One pooled HTTP session (and a bounded thread pool) shared by every forecast request
+http = requests.Session()
+http.mount('https://', HTTPAdapter(pool_maxsize=app.config['FORECAST_FETCH_WORKERS']))
+http.mount('http://', HTTPAdapter(pool_maxsize=app.config['FORECAST_FETCH_WORKERS']))
 
-    # Return the forecast
-    return forecast, None
+fetch_pool = ThreadPoolExecutor(max_workers=app.config['FORECAST_FETCH_WORKERS'], thread_name_prefix='forecast-fetch')
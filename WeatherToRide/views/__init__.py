@@ -12,3 +12,5 @@ def index():
 from . import user
 from . import location
 from . import route
+from . import recommendation
+from . import metrics
@@ -1,27 +1,16 @@
 
 from .. import app, csrf, db, forms, models
 
-from ..utils import geocode, validator, weather
+from ..utils import cascade, conditional, geocode, pagination, refresher, validator, weather
 
-from flask import abort, flash, jsonify, redirect, render_template, request, url_for
+from flask import abort, flash, jsonify, make_response, redirect, render_template, request, url_for
 from flask_login import current_user, login_required
 
-from sqlalchemy import or_
+from sqlalchemy.orm import joinedload
 
 import datetime
 
-# Limit how many locations a user can have at one time
-MAX_LOCATIONS = 5
-
-# How old can forecasts be before needing to be refreshed?
-MAX_FORECAST_AGE = datetime.timedelta(seconds=900)
-
-def create_or_update_location(user_id, address, name, location_id=None):
-
-    # Validate the user
-    user, error = validator.validate_user(user_id)
-    if error:
-        return None, error
+def validate_address_and_name(address, name):
 
     # Validate the location address
     max_length_address = 255
@@ -37,6 +26,20 @@ def create_or_update_location(user_id, address, name, location_id=None):
     if len(name) > max_length_name:
         return f'Location name cannot be longer than {max_length_name} characters.'
 
+    return None
+
+def create_or_update_location(user_id, address, name, location_id=None):
+
+    # Validate the user
+    user, error = validator.validate_user(user_id)
+    if error:
+        return None, error
+
+    # Validate the location address and name
+    error = validate_address_and_name(address, name)
+    if error:
+        return None, error
+
     # Validate the current location (if updating instead of creating)
     location = None
     if location_id:
@@ -46,7 +49,7 @@ def create_or_update_location(user_id, address, name, location_id=None):
 
     # Create a new location if not updating
     if not location:
-        if len(user.locations) < MAX_LOCATIONS:
+        if models.Location.query.filter_by(user_id=user.id).count() < app.config['MAX_LOCATIONS']:
             location = models.Location(user_id=user.id)
         else:
             return None, 'Location limit has been reached.'
@@ -56,6 +59,11 @@ def create_or_update_location(user_id, address, name, location_id=None):
     if error:
         return None, error
 
+    # A forecast for another grid cell no longer applies, so drop it rather than serve it as fresh
+    if location.forecast and weather.grid_cell(location.lat, location.lng) != weather.grid_cell(lat, lng):
+        models.ForecastDay.query.filter_by(location_id=location.id).delete(synchronize_session=False)
+        db.session.delete(location.forecast)
+
     # Save the new information to this location
     location.lat = lat
     location.lng = lng
@@ -65,12 +73,150 @@ def create_or_update_location(user_id, address, name, location_id=None):
     db.session.add(location)
     db.session.commit()
 
-    # Try to get the forecast for this location
-    weather.update_forecast(location)
+    # Fetch its forecast in the background (until then, reads treat it as missing, see refresher.revalidate)
+    refresher.revalidator.request([location.id])
 
     # Return the newly created/updated location
     return location, None
 
+def import_locations(user_id, items):
+
+    """
+
+    Create many locations for a user at once.
+
+    Every item is validated first, then the addresses are geocoded as one 
+        deduplicated, concurrent batch, and all of the new locations are 
+        saved in a single transaction. Forecasts are fetched in the background.
+
+    Args:
+        user_id: The ID of the user (required)
+        items: A list of { 'locationAddress': ..., 'locationName': ... } dicts (required)
+
+    Returns:
+        results, error - One { 'createdLocation': ... } or { 'error': ... } dict per item
+
+    """
+
+    # Validate the user
+    user, error = validator.validate_user(user_id)
+    if error:
+        return None, error
+
+    if type(items) is not list or not items:
+        return None, 'Locations must be a non-empty list.'
+    if len(items) > app.config['MAX_LOCATION_IMPORT']:
+        return None, f"Cannot import more than {app.config['MAX_LOCATION_IMPORT']} locations at once."
+
+    results = [None] * len(items)
+    valid = []
+
+    # How many more locations this user can have
+    available = app.config['MAX_LOCATIONS'] - models.Location.query.filter_by(user_id=user.id).count()
+
+    # Validate every item in one pass
+    for i, item in enumerate(items):
+
+        if type(item) is not dict:
+            results[i] = { 'error': 'Each location must be an object.' }
+            continue
+
+        error = validate_address_and_name(item.get('locationAddress'), item.get('locationName'))
+
+        if not error and len(valid) >= available:
+            error = 'Location limit has been reached.'
+
+        if error:
+            results[i] = { 'error': error }
+        else:
+            valid.append(i)
+
+    # Geocode the addresses as one batch
+    coordinates = geocode.get_coordinates_batch([items[i]['locationAddress'] for i in valid])
+
+    created = {}
+
+    for i in valid:
+
+        lat, lng, error = coordinates[items[i]['locationAddress']]
+
+        if error:
+            results[i] = { 'error': error }
+        else:
+            created[i] = models.Location(user_id=user.id, lat=lat, lng=lng, name=items[i]['locationName'])
+
+    # Save all of the new locations at once
+    db.session.add_all(created.values())
+    db.session.commit()
+
+    for i, location in created.items():
+        results[i] = { 'createdLocation': location.serialize() }
+
+    # Fetch their forecasts in the background
+    refresher.revalidator.request([x.id for x in created.values()])
+
+    return results, None
+
+def locations_query(user_id, after=0, limit=None):
+
+    # The query behind load_locations (also explained by check-plans)
+    query = models.Location.query.filter(
+        models.Location.user_id == user_id, models.Location.id > after
+    ).options( 
+        joinedload(models.Location.forecast) 
+    ).order_by(models.Location.id)
+
+    if limit:
+        query = query.limit(limit)
+
+    return query
+
+def load_locations(user_id, after=0, limit=None):
+
+    """
+
+    Load a user's locations with their forecasts.
+
+    The locations and forecasts come from one joined query, and the forecast 
+        days for all of them from one more, however many locations there are.
+
+    Args:
+        user_id: The ID of the user (required)
+        after: Only load locations with a higher ID (optional)
+        limit: The most locations to load, in ID order (optional)
+
+    """
+
+    return locations_query(user_id, after, limit).all()
+
+def serialize_locations(db_locations):
+
+    """
+
+    Serialize locations with their forecasts for the JSON API.
+
+    """
+
+    # Serve stale forecasts immediately (they are refreshed in the background)
+    freshness, errors = refresher.revalidate(db_locations)
+
+    locations = []
+
+    # Add the forecast for each location
+    for x in db_locations:
+
+        location = x.serialize()
+        locations.append(location)
+
+        if x.id in freshness and x.forecast:
+            location['forecast'] = x.forecast.serialize()
+            location['forecast'].update(freshness[x.id])
+        else:
+            location['forecast'] = None
+            location['forecastError'] = errors.get(x.id, 'The forecast for this location could not be loaded.')
+
+    return locations
+
 def delete_location(user_id, location_id):
 
     # Validate the user
@@ -87,21 +233,11 @@ def delete_location(user_id, location_id):
     if location.user != user:
         return None, 'Location does not belong to user.'
 
-    # Delete the forecast for this location
-    if location.forecast:
-        db.session.delete(location.forecast)
-        db.session.commit()
-
-    # Delete any routes using this location
-    routes = models.Route.query.filter_by(user_id=user.id)
-    routes = routes.filter( or_( models.Route.location_id_1 == location.id, models.Route.location_id_2 == location.id ))
-    if routes:
-        for route in routes:
-            db.session.delete(route)
-        db.session.commit()
-
-    # Delete the location
-    db.session.delete(location)
+    # Keep the loaded location to return, since its row is deleted by a bulk statement
+    db.session.expunge(location)
+
+    # Delete the location, its forecast and any routes using it in one transaction
+    cascade.delete_locations([location.id])
     db.session.commit()
 
     # Return the deleted location
@@ -164,38 +300,56 @@ def location_create_api(key):
     else:
         return jsonify({ 'error': error }), 400
 
+@app.route('/api/<key>/locations/import', methods=['POST'])
+@csrf.exempt
+def location_import_api(key):
+
+    # Validate the API key
+    user, error = validator.validate_developer(key)
+    if error:
+        return jsonify({ 'error': error }), 400
+
+    # Validate the request
+    if not request.json:
+        abort(400)
+    if not 'locations' in request.json:
+        abort(400)
+
+    # Try to add the locations to the database
+    results, error = import_locations(user.id, request.json['locations'])
+
+    if error:
+        return jsonify({ 'error': error }), 400
+
+    return jsonify({ 
+        'numberCreated': len([x for x in results if 'createdLocation' in x]), 
+        'results': results 
+    })
+
 @app.route('/locations')
 @login_required
 def location_view():
 
     # Get this user's locations
-    locations = current_user.locations
+    locations = load_locations(current_user.id)
 
-    # Get the current time
-    now = datetime.datetime.now()
-
-    # Update the forecast for locations if needed
-    for location in locations:
-        if location.forecast:
-            forecast_age = now - location.forecast.updated_at
-            if forecast_age > MAX_FORECAST_AGE:
-                weather.update_forecast(location)
-        else:
-            weather.update_forecast(location)
+    # Forecasts are kept fresh by the background refresher (see worker.py), 
+    #   so stale ones are normally served as they are while being revalidated
+    freshness, errors = refresher.revalidate(locations)
 
     # Get the current date
-    today = now.date()
+    today = datetime.date.today()
+
+    # Name each forecast day
+    horizon = max([len(x.forecast.days) for x in locations if x.forecast] or [0])
+    day_names = ['Today', 'Tomorrow'] + [(today + datetime.timedelta(days=i)).strftime('%A') for i in range(2, horizon)]
 
     # Return the location view
     return render_template('location/locations.html', 
         user=current_user, 
         locations=locations, 
-        day_2=(today + datetime.timedelta(days=2)).strftime('%A'), 
-        day_3=(today + datetime.timedelta(days=3)).strftime('%A'), 
-        day_4=(today + datetime.timedelta(days=4)).strftime('%A'), 
-        day_5=(today + datetime.timedelta(days=5)).strftime('%A'), 
-        day_6=(today + datetime.timedelta(days=6)).strftime('%A'), 
-        day_7=(today + datetime.timedelta(days=7)).strftime('%A')
+        freshness=freshness, 
+        day_names=day_names
     )
 
 @app.route('/api/<key>/locations')
@@ -207,14 +361,41 @@ def location_api(key):
     if error:
         return jsonify({ 'error': error }), 400
 
-    length = len(user.locations)
-    locations = [x.serialize() for x in user.locations]
+    # Read the paging parameters
+    after, limit, stream, error = pagination.parse_args()
+    if error:
+        return jsonify({ 'error': error }), 400
+
+    # Answer conditional requests before loading anything else (each page has its own ETag)
+    etag, last_modified, fresh = conditional.location_version(user.id)
+    etag = conditional.variant(etag, request.query_string)
+    if fresh and conditional.not_modified(etag, last_modified):
+        return conditional.tag(make_response('', 304), etag, last_modified)
+
+    def load(after, n):
+        return load_locations(user.id, after, n)
+
+    # Stream one location per line, loading them a chunk at a time
+    if stream:
+        locations = (x for chunk in pagination.chunks(load, after, limit) for x in serialize_locations(chunk))
+        return conditional.tag(pagination.ndjson(locations), etag, last_modified)
+
+    db_locations, next_cursor = pagination.page(load, after, limit)
+
+    # Only count separately when this isn't the whole list
+    if after or next_cursor:
+        length = models.Location.query.filter_by(user_id=user.id).count()
+    else:
+        length = len(db_locations)
 
-    # Get the forecast for each location
-    for location in locations:
-        location['forecast'] = models.Location.query.get( location['locationId'] ).forecast.serialize()
+    response = jsonify({ 
+        'userId': user.id, 
+        'numberOfLocations': length, 
+        'locations': serialize_locations(db_locations), 
+        'nextCursor': next_cursor 
+    })
 
-    return jsonify({ 'userId': user.id, 'numberOfLocations': length, 'locations': locations })
+    return conditional.tag(response, etag, last_modified)
 
 @app.route('/location/update/<int:id>', methods=['GET', 'POST'])
 @login_required
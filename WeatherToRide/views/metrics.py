@@ -0,0 +1,21 @@
+
+from .. import app, csrf
+
+from ..utils import metrics
+
+from flask import abort, jsonify
+
+import hmac
+
+@app.route('/metrics/<token>')
+@csrf.exempt
+def metrics_view(token):
+
+    # The endpoint only exists when a token has been configured
+    expected = app.config.get('METRICS_TOKEN')
+    # Compared as bytes, since compare_digest raises a TypeError for non-ASCII strings
+    if not expected or not hmac.compare_digest(token.encode(), expected.encode()):
+        abort(404)
+
+    # Return the counters for this process
+    return jsonify(metrics.snapshot())
@@ -0,0 +1,201 @@
+
+from .. import app, csrf, models
+
+from ..utils import quota, recommendations, validator, weather
+
+from flask import abort, jsonify, request
+
+def parse_point(value):
+
+    # A [lat, lng] pair of numbers within range (or None)
+    if type(value) is not list or len(value) != 2:
+        return None
+
+    lat, lng = value
+
+    if type(lat) not in (int, float) or type(lng) not in (int, float):
+        return None
+    if not -90 <= lat <= 90 or not -180 <= lng <= 180:
+        return None
+
+    return lat, lng
+
+def parse_items(items):
+
+    """
+
+    Validate a batch of coordinates, where each item is a [lat, lng] pair or a pair of pairs.
+
+    Returns:
+        items, error - Each item as a tuple of one or two (lat, lng) points
+
+    """
+
+    if type(items) is not list or not items:
+        return None, 'Coordinates must be a non-empty list.'
+
+    if len(items) > app.config['MAX_RECOMMENDATION_ITEMS']:
+        return None, f"No more than {app.config['MAX_RECOMMENDATION_ITEMS']} coordinates can be checked with one request."
+
+    parsed = []
+
+    for i, item in enumerate(items):
+
+        # A single point
+        point = parse_point(item)
+        if point:
+            parsed.append((point,))
+            continue
+
+        # A pair of points (like a route)
+        points = tuple(parse_point(x) for x in item) if type(item) is list and len(item) == 2 else ()
+        if not points or not all(points):
+            return None, f'Item {i} must be a [lat, lng] pair, or a pair of them.'
+
+        parsed.append(points)
+
+    return parsed, None
+
+def item_cells(items):
+
+    # The forecast grid cell of each point in each item
+    return [tuple(weather.grid_cell(lat, lng) for lat, lng in item) for item in items]
+
+def reserve_fetches(user_id, cells):
+
+    """
+
+    Check that a batch may fetch the forecasts it needs, before any calls are reserved from the weather API.
+
+    The weather API's daily limit is shared by every user, so a batch can only need
+        MAX_RECOMMENDATION_FETCHES uncached cells, and each user's batches can only
+        need MAX_RECOMMENDATION_DAILY_FETCHES of them a day.
+
+    Returns:
+        checked, error - What check_cache found (responses, pending), to fetch exactly the cells that were counted
+
+    """
+
+    checked = weather.check_cache(cells)
+    pending = checked[1]
+
+    if len(pending) > app.config['MAX_RECOMMENDATION_FETCHES']:
+        return None, f"These coordinates need {len(pending)} new forecasts, but one request can only need {app.config['MAX_RECOMMENDATION_FETCHES']}."
+
+    if pending and not quota.reserve_budget(user_id, app.config['MAX_RECOMMENDATION_DAILY_FETCHES'], len(pending)):
+        return None, 'This API key has used all of its new forecasts for today.'
+
+    return checked, None
+
+def cell_levels(cells, checked=None):
+
+    """
+
+    Get the daily danger levels for some grid cells, with one forecast lookup per cell.
+
+    Args:
+        cells: A set of grid cells (required)
+        checked: What check_cache already found for them (optional, see reserve_fetches)
+
+    Returns:
+        levels, errors - Dicts keyed by grid cell
+
+        levels: (first date, [level for each day]) for each cell that was found
+
+    """
+
+    responses, errors = weather.get_forecasts_for_cells(cells, checked=checked)
+
+    daily = {}
+
+    for cell, (response, fetched_at) in responses.items():
+        daily[cell], error = weather.parse_daily(response)
+        if error:
+            errors[cell] = error
+            del daily[cell]
+
+    # Score every cell's days at once
+    try:
+        days = weather.cell_forecast_days(daily)
+    except:
+        errors.update((cell, 'There was a problem while trying to get the daily forecast for this location.') for cell in daily)
+        return {}, errors
+
+    levels = { cell: (responses[cell][1].date(), [x['recommendation'] for x in rows]) for cell, rows in days.items() }
+
+    return levels, errors
+
+def batch_recommendations(items, checked=None):
+
+    """
+
+    Get the ride recommendations for a batch of points and pairs of points, without saving anything.
+
+    Items that share grid cells share their forecasts, so a batch costs at most one
+        API call per distinct cell. A pair of points gets the combined recommendation
+        for both (the same cascade as a route, on every day).
+
+    Args:
+        items: Tuples of one or two (lat, lng) points (required)
+        checked: What check_cache found for their cells (optional, see reserve_fetches)
+
+    Returns:
+        results, lookups - One result for each item, and the number of distinct cells
+
+    """
+
+    cells = item_cells(items)
+    levels, errors = cell_levels(set(x for item in cells for x in item), checked)
+
+    results = []
+
+    for item in cells:
+
+        error = next((errors[x] for x in item if x in errors), None)
+        if error:
+            results.append({ 'error': error })
+            continue
+
+        # Line the days up by date (a cell's response may have been fetched the day before)
+        start = max(levels[x][0] for x in item)
+        days = [levels[x][1][(start - levels[x][0]).days:] for x in item]
+
+        results.append({
+            'start': start.isoformat(),
+            'recommendations': [recommendations.combine_recommendations(*x) for x in zip(*days)]
+        })
+
+    return results, len(levels) + len(errors)
+
+@app.route('/api/<key>/recommendations', methods=['POST'])
+@csrf.exempt
+def recommendation_batch_api(key):
+
+    # Validate the API key
+    user, error = validator.validate_developer(key)
+    if error:
+        return jsonify({ 'error': error }), 400
+
+    # Validate the request
+    if not request.json:
+        abort(400)
+    if not 'coordinates' in request.json:
+        abort(400)
+
+    items, error = parse_items(request.json['coordinates'])
+    if error:
+        return jsonify({ 'error': error }), 400
+
+    # Reject batches that would use too much of the weather API's daily limit
+    checked, error = reserve_fetches(user.id, set(x for item in item_cells(items) for x in item))
+    if error:
+        return jsonify({ 'error': error }), 400
+
+    results, lookups = batch_recommendations(items, checked)
+
+    # Each result lists a level for each day from its start date, so the text for each level is only sent once
+    return jsonify({
+        'levels': { str(level): text for level, text in models.recommendations.items() },
+        'forecastLookups': lookups,
+        'results': results
+    })
@@ -1,18 +1,18 @@
 
 from .. import app, csrf, db, forms, models
 
-from ..utils import validator
-from ..utils.weather import ride_danger, ride_ok, ride_warn
+from ..utils import conditional, pagination, recommendations, refresher, validator
 
-from flask import abort, flash, jsonify, redirect, render_template, request, url_for
+from flask import abort, flash, jsonify, make_response, redirect, render_template, request, url_for
 from flask_login import current_user, login_required
+from sqlalchemy.orm import joinedload
 
 import datetime
 
-# Limit how many routes a user can have at one time
-MAX_ROUTES = 5
+# Passed for a time that should be left as it is (e.g. its key was left out of an API update)
+UNCHANGED = object()
 
-def create_or_update_route(user_id, location_id_1, location_id_2, name, days, route_id=None):
+def create_or_update_route(user_id, location_id_1, location_id_2, name, days, route_id=None, depart_time=None, return_time=None):
 
     # Validate the user
     user, error = validator.validate_user(user_id)
@@ -57,6 +57,20 @@ def create_or_update_route(user_id, location_id_1, location_id_2, name, days, ro
         if day < 0 or day > 6:
             return None, 'Encountered day in list that was outside of allowable range [0-6]'
 
+    # Validate the departure and return times (optional, 'HH:MM' from the JSON API)
+    times = []
+    for label, value in (('Departure', depart_time), ('Return', return_time)):
+        if value is UNCHANGED:
+            pass
+        elif type(value) is str:
+            try:
+                value = datetime.datetime.strptime(value, '%H:%M').time()
+            except ValueError:
+                return None, f'{label} time must be formatted as HH:MM.'
+        elif value is not None and type(value) is not datetime.time:
+            return None, f'{label} time must be formatted as HH:MM.'
+        times.append(value)
+
     # Validate the current route (if updating instead of creating)
     route = None
     if route_id:
@@ -66,7 +80,7 @@ def create_or_update_route(user_id, location_id_1, location_id_2, name, days, ro
 
     # Create a new route if not updating
     if not route:
-        if len(user.routes) < MAX_ROUTES:
+        if models.Route.query.filter_by(user_id=user.id).count() < app.config['MAX_ROUTES']:
             route = models.Route(user_id=user.id)
         else:
             return None, 'Route limit has been reached.'
@@ -77,6 +91,14 @@ def create_or_update_route(user_id, location_id_1, location_id_2, name, days, ro
 
     route.name = name
 
+    # Times that weren't given keep their current values (None for a new route)
+    depart_time, return_time = times
+
+    if depart_time is not UNCHANGED:
+        route.depart_time = depart_time
+    if return_time is not UNCHANGED:
+        route.return_time = return_time
+
     route.mon = False
     route.tue = False
     route.wed = False
@@ -101,13 +123,108 @@ def create_or_update_route(user_id, location_id_1, location_id_2, name, days, ro
         if day == 6:
             route.sun = True
 
-    # Save the route to the database
+    # Save the route to the database, along with its recommendations
     db.session.add(route)
+    recommendations.refresh_routes([route])
     db.session.commit()
 
     # Return the created/updated route
     return route, None
 
+def routes_query(user_id, after=0, limit=None):
+
+    # The query behind load_routes (also explained by check-plans)
+    query = models.Route.query.filter(
+        models.Route.user_id == user_id, models.Route.id > after
+    ).options( 
+        joinedload(models.Route.location_1).joinedload(models.Location.forecast), 
+        joinedload(models.Route.location_2).joinedload(models.Location.forecast) 
+    ).order_by(models.Route.id)
+
+    if limit:
+        query = query.limit(limit)
+
+    return query
+
+def load_routes(user_id, after=0, limit=None):
+
+    """
+
+    Load a user's routes with both of their locations and forecasts.
+
+    The routes, locations and forecasts come from one joined query, and the 
+        forecast days for all of them from one more, however many routes there are.
+
+    Args:
+        user_id: The ID of the user (required)
+        after: Only load routes with a higher ID (optional)
+        limit: The most routes to load, in ID order (optional)
+
+    """
+
+    return routes_query(user_id, after, limit).all()
+
+def route_locations(routes):
+
+    # The distinct locations used by a list of routes
+    locations = {}
+    for r in routes:
+        locations[r.location_1.id] = r.location_1
+        locations[r.location_2.id] = r.location_2
+
+    return list(locations.values())
+
+def serialize_routes(db_routes):
+
+    """
+
+    Serialize routes with their locations, forecasts and recommendations for the JSON API.
+
+    """
+
+    # Serve stale forecasts immediately (they are refreshed in the background)
+    freshness, errors = refresher.revalidate(route_locations(db_routes))
+
+    # The combined recommendations for the next week, on the route's days
+    stored = recommendations.load([r.id for r in db_routes], datetime.date.today())
+
+    routes = []
+
+    for r in db_routes:
+
+        route = r.serialize()
+        routes.append(route)
+
+        # Get the locations for this route
+        location1 = r.location_1
+        location2 = r.location_2
+
+        # Add the locations to the JSON response
+        route['routeLocation1'] = location1.serialize()
+        route['routeLocation2'] = location2.serialize()
+
+        # Add the forecasts to the JSON response
+        for location, serialized in ((location1, route['routeLocation1']), (location2, route['routeLocation2'])):
+            if location.id in freshness:
+                serialized['forecast'] = location.forecast.serialize()
+                serialized['forecast'].update(freshness[location.id])
+            else:
+                serialized['forecast'] = None
+                serialized['forecastError'] = errors.get(location.id)
+
+        # Add the recommendations to the JSON response (only when both forecasts can be served)
+        route['routeRecommendations'] = [
+            { 
+                'date': x.date.isoformat(), 
+                'recommendation': x.recommendation_text, 
+                'departRecommendation': x.depart_recommendation_text, 
+                'returnRecommendation': x.return_recommendation_text 
+            }
+            for x in stored[r.id]
+        ] if location1.id in freshness and location2.id in freshness else []
+
+    return routes
+
 def delete_route(user_id, route_id):
 
     # Validate the user
@@ -125,6 +242,7 @@ def delete_route(user_id, route_id):
         return None, 'Route does not belong to user.'
 
     # Delete the route from the database
+    recommendations.delete_routes([route.id])
     db.session.delete(route)
     db.session.commit()
 
@@ -135,15 +253,18 @@ def delete_route(user_id, route_id):
 @login_required
 def route_create_view():
 
+    # Load the user's locations (once, since each access is a query)
+    choices = [(x.id, x.name) for x in current_user.locations]
+
     # Check that the user has enough locations
-    if len(current_user.locations) < 2:
+    if len(choices) < 2:
         flash('You must have at least 2 saved locations to create a route.', 'danger')
         return redirect(url_for('route_view'))
 
     # Get a RouteForm from forms.py
     form = forms.RouteForm()
-    form.location_id_1.choices = [(x.id, x.name) for x in current_user.locations]
-    form.location_id_2.choices = [(x.id, x.name) for x in current_user.locations]
+    form.location_id_1.choices = choices
+    form.location_id_2.choices = choices
 
     # Validate a submitted form
     if form.validate_on_submit():
@@ -154,7 +275,9 @@ def route_create_view():
             location_id_1=form.location_id_1.data, 
             location_id_2=form.location_id_2.data, 
             name=form.name.data, 
-            days=form.days.data
+            days=form.days.data, 
+            depart_time=form.depart_time.data, 
+            return_time=form.return_time.data
         )
 
         # Check if the route was created
@@ -194,7 +317,9 @@ def route_create_api(key):
         location_id_1=request.json['routeLocation1'], 
         location_id_2=request.json['routeLocation2'], 
         name=request.json['routeName'], 
-        days=request.json['routeDays']
+        days=request.json['routeDays'], 
+        depart_time=request.json.get('routeDepartTime'), 
+        return_time=request.json.get('routeReturnTime')
     )
 
     # Check if the route was created
@@ -207,45 +332,65 @@ def route_create_api(key):
 @login_required
 def route_view():
     today = datetime.date.today()
-    db_routes = current_user.routes
+    db_routes = load_routes(current_user.id)
+
+    # Serve stale forecasts immediately (they are refreshed in the background)
+    freshness, errors = refresher.revalidate(route_locations(db_routes))
+
+    # The combined recommendations for the next week, on the route's days
+    stored = recommendations.load([r.id for r in db_routes], today)
+
     routes = []
     for r in db_routes:
-        location_1 = models.Location.query.get(r.location_id_1)
-        location_2 = models.Location.query.get(r.location_id_2)
+        location_1 = r.location_1
+        location_2 = r.location_2
+
+        # Skip the forecast if either location's forecast can't be served
+        if location_1.id not in freshness or location_2.id not in freshness:
+            routes.append({
+                'id': r.id,
+                'name': r.name,
+                'location_1_name': location_1.name,
+                'location_2_name': location_2.name,
+                'forecast': [],
+                'stale': False
+            })
+            continue
+
         forecast = []
-        for i in range(7):
-            day = (today + datetime.timedelta(days=i))
-            # if the route is active for this day
-            if getattr(r, day.strftime('%a').lower()):
-                loc1_rec = getattr(location_1.forecast, f'day_{i}_recommendation')
-                loc2_rec = getattr(location_2.forecast, f'day_{i}_recommendation')
-
-                # cascade down danger levels to provide a singular recommendation
-                if loc1_rec == ride_danger or loc2_rec == ride_danger:
-                    recommendation = ride_danger
-                elif loc1_rec == ride_warn or loc2_rec == ride_warn:
-                    recommendation = ride_warn
-                else:
-                    recommendation = ride_ok
-
-                forecast.append({
-                    'day': 'Today' if i == 0 else 'Tomorrow' if i == 1 else day.strftime('%A'),
-                    'recommendation': recommendation,
-                    'location_1': {
-                        'icon': getattr(location_1.forecast, f'day_{i}_icon'),
-                        'summary': getattr(location_1.forecast, f'day_{i}_summary'),
-                    },
-                    'location_2': {
-                        'icon': getattr(location_2.forecast, f'day_{i}_icon'),
-                        'summary': getattr(location_2.forecast, f'day_{i}_summary'),
-                    }
-                })
+        days_1 = location_1.forecast.days
+        days_2 = location_2.forecast.days
+        for x in stored[r.id]:
+
+            # The forecasts might have changed length since the recommendations were stored
+            if x.day >= len(days_1) or x.day >= len(days_2):
+                continue
+
+            i = (x.date - today).days
+
+            forecast.append({
+                'day': 'Today' if i == 0 else 'Tomorrow' if i == 1 else x.date.strftime('%A'),
+                'recommendation': x.recommendation_text,
+                'depart': x.depart_recommendation_text,
+                'return': x.return_recommendation_text,
+                'location_1': {
+                    'icon': days_1[x.day].icon,
+                    'summary': days_1[x.day].summary,
+                },
+                'location_2': {
+                    'icon': days_2[x.day].icon,
+                    'summary': days_2[x.day].summary,
+                }
+            })
         routes.append({
             'id': r.id,
             'name': r.name,
             'location_1_name': location_1.name,
             'location_2_name': location_2.name,
-            'forecast': forecast
+            'depart_time': r.depart_time,
+            'return_time': r.return_time,
+            'forecast': forecast,
+            'stale': freshness[location_1.id]['isStale'] or freshness[location_2.id]['isStale']
         })
 
     # Return the route view
@@ -260,24 +405,41 @@ def route_api(key):
     if error:
         return jsonify({ 'error': error }), 400
 
-    length = len(user.routes)
-    routes = [r.serialize() for r in user.routes]
+    # Read the paging parameters
+    after, limit, stream, error = pagination.parse_args()
+    if error:
+        return jsonify({ 'error': error }), 400
 
-    for route in routes:
+    # Answer conditional requests before loading anything else (each page has its own ETag)
+    etag, last_modified, fresh = conditional.route_version(user.id)
+    etag = conditional.variant(etag, request.query_string)
+    if fresh and conditional.not_modified(etag, last_modified):
+        return conditional.tag(make_response('', 304), etag, last_modified)
 
-        # Get the locations for this route
-        location1 = models.Location.query.get( route['routeLocation1'] )
-        location2 = models.Location.query.get( route['routeLocation2'] )
+    def load(after, n):
+        return load_routes(user.id, after, n)
 
-        # Add the locations to the JSON response
-        route['routeLocation1'] = location1.serialize()
-        route['routeLocation2'] = location2.serialize()
+    # Stream one route per line, loading them a chunk at a time
+    if stream:
+        routes = (x for chunk in pagination.chunks(load, after, limit) for x in serialize_routes(chunk))
+        return conditional.tag(pagination.ndjson(routes), etag, last_modified)
 
-        # Add the forecasts to the JSON response
-        route['routeLocation1']['forecast'] = location1.forecast.serialize()
-        route['routeLocation2']['forecast'] = location2.forecast.serialize()
+    db_routes, next_cursor = pagination.page(load, after, limit)
+
+    # Only count separately when this isn't the whole list
+    if after or next_cursor:
+        length = models.Route.query.filter_by(user_id=user.id).count()
+    else:
+        length = len(db_routes)
+
+    response = jsonify({ 
+        'userId': user.id, 
+        'numberOfRoutes': length, 
+        'routes': serialize_routes(db_routes), 
+        'nextCursor': next_cursor 
+    })
 
-    return jsonify({ 'userId': user.id, 'numberOfRoutes': length, 'routes': routes })
+    return conditional.tag(response, etag, last_modified)
 
 @app.route('/route/update/<int:id>', methods=['GET', 'POST'])
 @login_required
@@ -310,11 +472,16 @@ def route_update_view(id):
         location_id_1=route.location_id_1, 
         location_id_2=route.location_id_2, 
         name=route.name, 
-        days=days
+        days=days, 
+        depart_time=route.depart_time, 
+        return_time=route.return_time
     )
 
-    form.location_id_1.choices = [(x.id, x.name) for x in current_user.locations]
-    form.location_id_2.choices = [(x.id, x.name) for x in current_user.locations]
+    # Load the user's locations (once, since each access is a query)
+    choices = [(x.id, x.name) for x in current_user.locations]
+
+    form.location_id_1.choices = choices
+    form.location_id_2.choices = choices
 
     # Validate a submitted form
     if form.validate_on_submit():
@@ -326,7 +493,9 @@ def route_update_view(id):
             location_id_2=form.location_id_2.data, 
             name=form.name.data, 
             days=form.days.data, 
-            route_id=route.id
+            route_id=route.id, 
+            depart_time=form.depart_time.data, 
+            return_time=form.return_time.data
         )
 
         # Check if the route was updated
@@ -369,7 +538,9 @@ def route_update_api(key):
         location_id_2=request.json['routeLocation2'], 
         name=request.json['routeName'], 
         days=request.json['routeDays'], 
-        route_id=request.json['routeId']
+        route_id=request.json['routeId'], 
+        depart_time=request.json.get('routeDepartTime', UNCHANGED), 
+        return_time=request.json.get('routeReturnTime', UNCHANGED)
     )
 
     # Check if the route was updated
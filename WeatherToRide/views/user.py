@@ -1,7 +1,7 @@
 
 from .. import app, db, forms, models
 
-from ..utils import email
+from ..utils import cascade, outbox, passwords, users
 
 from flask import abort, flash, redirect, render_template, request, url_for
 from flask_login import current_user, login_required, login_user, logout_user
@@ -34,16 +34,20 @@ def register():
     if form.validate_on_submit():
 
         # Make sure the user limit hasn't been reached
-        users = models.User.query.all()
+        registered = models.User.query.all()
 
-        if len(users) < MAX_USERS:
+        if len(registered) < MAX_USERS:
 
             # Create the new user
-            user = models.User( 
-                email=form.email.data, 
-                password=form.password.data, 
-                name=form.name.data 
-            )
+            try:
+                user = models.User( 
+                    email=form.email.data, 
+                    password=form.password.data, 
+                    name=form.name.data 
+                )
+            except passwords.Busy:
+                flash('We are very busy at the moment. Please try again in a few seconds.', 'danger')
+                return render_template('user/user-form.html', user=current_user, form=form)
 
             # Add the user to the database
             db.session.add(user)
@@ -63,8 +67,8 @@ def register():
             # The e-mail message
             html = render_template('email/confirm.html', user=user, url=url)
 
-            # Send the e-mail
-            email.send(user.email, subject, html)
+            # Queue the e-mail (the outbox worker sends it)
+            outbox.enqueue(user.email, subject, html)
 
             flash('You have successfully registered!', 'success')
 
@@ -97,7 +101,16 @@ def login():
         if user:
 
             # Check if the provided password is correct
-            if user.validate_password(form.password.data):
+            try:
+                valid = user.validate_password(form.password.data)
+            except passwords.Busy:
+                flash('We are very busy at the moment. Please try again in a few seconds.', 'danger')
+                return render_template('user/login.html', user=current_user, form=form)
+
+            if valid:
+
+                # Save the password's hash if it was upgraded to the current cost settings
+                db.session.commit()
 
                 # Sign the user in
                 login_user(user)
@@ -148,6 +161,8 @@ def confirm_email(token):
     # Commit the change to the database
     db.session.commit()
 
+    users.forget(user.id)
+
     flash('Your e-mail address has been confirmed!', 'success')
 
     # Return the login page
@@ -180,8 +195,8 @@ def forgot_password():
             # The e-mail message
             html = render_template('email/reset.html', user=user, url=url)
 
-            # Send the e-mail
-            email.send(user.email, subject, html)
+            # Queue the e-mail (the outbox worker sends it)
+            outbox.enqueue(user.email, subject, html)
 
             flash('Check your e-mail for instructions on how to reset your password.', 'success')
 
@@ -214,11 +229,17 @@ def reset_password(token):
         if user:
 
             # Update the user's password
-            user.password = form.password.data
+            try:
+                user.password = form.password.data
+            except passwords.Busy:
+                flash('We are very busy at the moment. Please try again in a few seconds.', 'danger')
+                return render_template('user/reset-password.html', user=current_user, form=form, token=token)
 
             # Commit the password change to the database
             db.session.commit()
 
+            users.forget(user.id)
+
             flash('Your password has been successfully reset!', 'success')
 
             # Return the login page
@@ -236,16 +257,8 @@ def delete_user():
 
     if request.method == 'POST':
 
-        for route in current_user.routes:
-            db.session.delete(route)
-            db.session.commit()
-
-        for location in current_user.locations:
-            db.session.delete(location.forecast)
-            db.session.delete(location)
-            db.session.commit()
-
-        db.session.delete(current_user)
+        # Delete the user and everything they own in one transaction
+        cascade.delete_users([current_user.id])
         db.session.commit()
 
         logout_user()
@@ -0,0 +1,164 @@
+
+# Compare the old wide forecast row (24 day_N_* columns) with the forecast_day table.
+#
+# Usage: python3 benchmarks/forecast_storage.py [number of locations]
+#
+# Both layouts are filled with the same forecasts in scratch SQLite files. The
+#   script reports the estimated MySQL row size for each layout, the size of
+#   each file on disk, and how long it takes to read the forecasts for a
+#   dashboard's worth of locations at a time.
+
+from sqlalchemy import Column, create_engine, DateTime, Integer, MetaData, select, SmallInteger, String, Table
+
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+DAYS = 8
+
+icons = ['clear-day', 'cloudy-day', 'rain', 'snow', 'wind', 'cloudy']
+
+summaries = [
+    'Clear throughout the day.',
+    'Partly cloudy in the morning.',
+    'Light rain starting in the afternoon, continuing until evening.',
+    'Breezy until afternoon and mostly cloudy throughout the day.',
+    'Snow (1-3 in.) until evening.'
+]
+
+messages = [
+    'Looks like great weather to go for a ride!',
+    'It should be ok to ride, but be careful!',
+    'It might be a good idea to take the car instead.'
+]
+
+def wide_table(metadata):
+
+    columns = [
+        Column('id', Integer, primary_key=True),
+        Column('location_id', Integer, nullable=False, index=True),
+        Column('updated_at', DateTime)
+    ]
+
+    for i in range(DAYS):
+        columns += [
+            Column(f'day_{i}_icon', String(32)),
+            Column(f'day_{i}_summary', String(255)),
+            Column(f'day_{i}_recommendation', String(255))
+        ]
+
+    return Table('forecast', metadata, *columns)
+
+def day_table(metadata):
+
+    return Table('forecast_day', metadata,
+        Column('location_id', Integer, primary_key=True),
+        Column('day', SmallInteger, primary_key=True),
+        Column('icon', String(32)),
+        Column('summary', String(255)),
+        Column('recommendation', SmallInteger)
+    )
+
+def generate(locations):
+
+    random.seed(42)
+
+    return {
+        location_id: [(random.choice(icons), random.choice(summaries), random.randrange(3)) for _ in range(DAYS)]
+        for location_id in range(1, locations + 1)
+    }
+
+def mysql_row_bytes(forecasts):
+
+    # InnoDB payload estimate: INT = 4, SMALLINT = 2, DATETIME = 5, VARCHAR = length + 1
+    wide = 0
+    narrow = 0
+
+    for days in forecasts.values():
+        wide += 4 + 4 + 5 + sum(len(icon) + 1 + len(summary) + 1 + len(messages[level]) + 1 for icon, summary, level in days)
+        narrow += 4 + 4 + 5 + sum(4 + 2 + len(icon) + 1 + len(summary) + 1 + 2 for icon, summary, level in days)
+
+    return wide / len(forecasts), narrow / len(forecasts)
+
+def fill(path, layout, forecasts):
+
+    engine = create_engine(f'sqlite:///{path}')
+    metadata = MetaData()
+    table = layout(metadata)
+    metadata.create_all(engine)
+
+    now = datetime.datetime.now()
+    rows = []
+
+    for location_id, days in forecasts.items():
+        if layout is wide_table:
+            row = { 'location_id': location_id, 'updated_at': now }
+            for i, (icon, summary, level) in enumerate(days):
+                row[f'day_{i}_icon'] = icon
+                row[f'day_{i}_summary'] = summary
+                row[f'day_{i}_recommendation'] = messages[level]
+            rows.append(row)
+        else:
+            rows += [
+                { 'location_id': location_id, 'day': i, 'icon': icon, 'summary': summary, 'recommendation': level }
+                for i, (icon, summary, level) in enumerate(days)
+            ]
+
+    with engine.begin() as connection:
+        connection.execute(table.insert(), rows)
+
+    engine.execute('VACUUM')
+
+    return engine, table
+
+def read(engine, table, batches):
+
+    # Read each batch of locations into per-day dicts, the way the views use them
+    start = time.perf_counter()
+
+    with engine.connect() as connection:
+        for batch in batches:
+            if table.name == 'forecast':
+                for row in connection.execute(select([table]).where(table.c.location_id.in_(batch))):
+                    [{ 'icon': row[f'day_{i}_icon'], 'summary': row[f'day_{i}_summary'], 'recommendation': row[f'day_{i}_recommendation'] } for i in range(DAYS)]
+            else:
+                for row in connection.execute(select([table]).where(table.c.location_id.in_(batch))):
+                    { 'icon': row.icon, 'summary': row.summary, 'recommendation': messages[row.recommendation] }
+
+    return time.perf_counter() - start
+
+def main():
+
+    locations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    forecasts = generate(locations)
+
+    # Dashboards of 5 locations at a time
+    ids = list(forecasts)
+    random.shuffle(ids)
+    batches = [ids[i:i + 5] for i in range(0, len(ids), 5)]
+
+    wide_bytes, narrow_bytes = mysql_row_bytes(forecasts)
+
+    print(f'{locations} locations, {DAYS} days each')
+    print(f'Estimated MySQL bytes per location: wide {wide_bytes:.0f}, forecast_day {narrow_bytes:.0f} ({narrow_bytes / wide_bytes:.0%})')
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        results = {}
+
+        for layout in (wide_table, day_table):
+            path = os.path.join(directory, f'{layout.__name__}.db')
+            engine, table = fill(path, layout, forecasts)
+            results[layout] = (os.path.getsize(path), read(engine, table, batches))
+            engine.dispose()
+
+        (wide_size, wide_time), (narrow_size, narrow_time) = results[wide_table], results[day_table]
+
+        print(f'SQLite file size: wide {wide_size / 1024:.0f} KiB, forecast_day {narrow_size / 1024:.0f} KiB ({narrow_size / wide_size:.0%})')
+        print(f'Read {len(batches)} dashboards: wide {wide_time:.3f} s, forecast_day {narrow_time:.3f} s ({narrow_time / wide_time:.0%})')
+
+if __name__ == '__main__':
+    main()
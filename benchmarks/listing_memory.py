@@ -0,0 +1,128 @@
+# Compare the peak memory of the JSON API location listing as one page, and as an NDJSON stream.
+#
+# Usage: python3 benchmarks/listing_memory.py [locations ...]
+#
+# The app is pointed at a scratch SQLite file, and a user with each number of
+#   locations (with fresh forecasts, so nothing is fetched) is created directly
+#   in the database. For each one, the script traces the memory allocated while
+#   /api/<key>/locations is served as a single page (with API_MAX_PAGE_SIZE raised
+#   to fit every location) and as a stream, first through the Flask app directly
+#   and then through the asyncio API server (asyncapi.py, as it runs in production).
+#   The streams' peaks should stay flat. Run it from the project root, with an
+#   instance/config.py in place.
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from WeatherToRide import app, db, models
+from WeatherToRide import asyncapi
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import asyncio
+import datetime
+
+def seed(count):
+
+    user = models.User(name=f'user{count}', email=f'user{count}@example.com', _password='x')
+    db.session.add(user)
+    db.session.commit()
+
+    first = (db.session.query(db.func.max(models.Location.id)).scalar() or 0) + 1
+    ids = range(first, first + count)
+    now = datetime.datetime.now()
+
+    db.session.bulk_insert_mappings(models.Location, [
+        { 'id': i, 'user_id': user.id, 'name': f'Location {i}', 'lat': 33.5, 'lng': -86.8 } for i in ids
+    ])
+
+    db.session.bulk_insert_mappings(models.Forecast, [{ 'location_id': i, 'updated_at': now } for i in ids])
+
+    db.session.bulk_insert_mappings(models.ForecastDay, [
+        { 'location_id': i, 'day': day, 'icon': 'clear-day', 'summary': 'Clear throughout the day.', 'recommendation': models.RIDE_OK }
+        for i in ids for day in range(8)
+    ])
+
+    key = f'benchmark{count}'
+    db.session.add(models.Developer(user_id=user.id, key=key))
+    db.session.commit()
+
+    return key
+
+def measure(client, url):
+
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    # Read the response a line at a time, the way a streaming client would
+    response = client.get(url, buffered=False)
+    lines = sum(1 for _ in response.response)
+    response.close()
+
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return peak / 2 ** 20, elapsed * 1000, lines
+
+async def measure_async(client, url):
+
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    # Read the response a chunk at a time, the way a streaming client would
+    response = await client.get(url)
+    chunks = 0
+    async for chunk in response.content.iter_chunked(65536):
+        chunks += 1
+    response.release()
+
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return peak / 2 ** 20, elapsed * 1000, chunks
+
+async def measure_server(urls):
+
+    # The API server, on a local port in this process
+    async with TestClient(TestServer(asyncapi.create_app())) as client:
+        return [await measure_async(client, url) for url in urls]
+
+def main():
+
+    counts = [int(x) for x in sys.argv[1:]] or [500, 2000, 8000]
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(directory, 'benchmark.db')}"
+        app.config['API_MAX_PAGE_SIZE'] = max(counts)
+
+        with app.app_context():
+
+            db.create_all()
+
+            print('          | Flask app                                 | API server')
+            print('locations | one page             | NDJSON stream      | one page             | NDJSON stream')
+
+            for count in counts:
+
+                key = seed(count)
+                client = app.test_client()
+
+                urls = [f'/api/{key}/locations?limit={count}', f'/api/{key}/locations?format=ndjson']
+
+                results = [measure(client, url) for url in urls] + asyncio.run(measure_server(urls))
+
+                print(f'{count:>9} | ' + ' | '.join(f'{mb:6.1f} MiB {ms:7.0f} ms' for mb, ms, parts in results))
+
+            db.session.remove()
+            db.engine.dispose()
+
+if __name__ == '__main__':
+    main()
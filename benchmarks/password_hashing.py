@@ -0,0 +1,72 @@
+
+# Measure how many logins per second (and per core) the password pool can check.
+#
+# Usage: python3 benchmarks/password_hashing.py [logins] [time cost] [memory cost (KiB)] [parallelism]
+#
+# A password is hashed with the given Argon2 cost settings (the config.py values by
+#   default), then checked as many times as there are logins, from as many threads
+#   as PASSWORD_MAX_QUEUED allows, the way concurrent login requests would be.
+#   Run it from the project root, with an instance/config.py in place.
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from WeatherToRide import app
+from WeatherToRide.utils import passwords
+
+def main():
+
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    for i, setting in enumerate(['ARGON2_TIME_COST', 'ARGON2_MEMORY_COST', 'ARGON2_PARALLELISM']):
+        if len(sys.argv) > i + 2:
+            app.config[setting] = int(sys.argv[i + 2])
+
+    cores = os.cpu_count()
+    workers = app.config['PASSWORD_HASH_WORKERS']
+    threads = app.config['PASSWORD_MAX_QUEUED']
+
+    print(f"Argon2 time cost {app.config['ARGON2_TIME_COST']}, memory cost {app.config['ARGON2_MEMORY_COST']} KiB, "
+        f"parallelism {app.config['ARGON2_PARALLELISM']}")
+    print(f'{workers} worker processes, {threads} logins at a time, {cores} cores')
+
+    hashed = passwords.hash('correct horse battery staple')
+
+    # Warm up every worker process
+    passwords.verify('correct horse battery staple', hashed)
+
+    remaining = [logins]
+    lock = threading.Lock()
+
+    def login():
+        while True:
+            with lock:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+            valid, new_hash = passwords.verify('correct horse battery staple', hashed)
+            assert valid
+
+    start = time.perf_counter()
+
+    pool = [threading.Thread(target=login) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+
+    elapsed = time.perf_counter() - start
+
+    stats = passwords.stats()
+
+    print(f'{logins} logins in {elapsed:.2f} s: {logins / elapsed:.1f} logins/s, '
+        f'{logins / elapsed / min(workers, cores):.1f} logins/s per core in use')
+    print(f"Average check {stats['averageWorkSeconds'] * 1000:.0f} ms, "
+        f"average queue {stats['averageQueueSeconds'] * 1000:.0f} ms (max {stats['maxQueueSeconds'] * 1000:.0f} ms)")
+
+if __name__ == '__main__':
+    main()
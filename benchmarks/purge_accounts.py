@@ -0,0 +1,120 @@
+
+# Time the bulk purge of unconfirmed accounts, and check that it leaves no orphaned rows behind.
+#
+# Usage: python3 benchmarks/purge_accounts.py [accounts] [batch size]
+#
+# The app is pointed at a scratch SQLite file, and the accounts (half of them
+#   unconfirmed and old enough to purge, each with two locations, their forecasts,
+#   a route with stored recommendations and an API key) are inserted directly.
+#   The script reports the time and number of statements the purge takes.
+#   Run it from the project root, with an instance/config.py in place.
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from WeatherToRide import app, db, models
+from WeatherToRide.utils import cascade
+
+from sqlalchemy import event, func
+
+import datetime
+
+def seed(accounts):
+
+    old = datetime.datetime.now() - datetime.timedelta(days=60)
+    today = datetime.date.today()
+
+    # Every other account is unconfirmed (the password is never checked, so it isn't hashed)
+    db.session.bulk_insert_mappings(models.User, [
+        { 'id': i, 'name': f'user{i}', 'email': f'user{i}@example.com', 'email_confirmed': i % 2 == 0, '_password': 'x', 'created_at': old }
+        for i in range(1, accounts + 1)
+    ])
+
+    db.session.bulk_insert_mappings(models.Location, [
+        { 'id': i, 'user_id': (i + 1) // 2, 'name': f'Location {i}', 'lat': 33.5, 'lng': -86.8 }
+        for i in range(1, accounts * 2 + 1)
+    ])
+
+    db.session.bulk_insert_mappings(models.Forecast, [
+        { 'location_id': i, 'updated_at': old } for i in range(1, accounts * 2 + 1)
+    ])
+
+    db.session.bulk_insert_mappings(models.ForecastDay, [
+        { 'location_id': i, 'day': day, 'icon': 'clear-day', 'summary': 'Clear.', 'recommendation': models.RIDE_OK }
+        for i in range(1, accounts * 2 + 1) for day in range(8)
+    ])
+
+    db.session.bulk_insert_mappings(models.Route, [
+        { 'id': i, 'user_id': i, 'name': f'Route {i}', 'location_id_1': i * 2 - 1, 'location_id_2': i * 2, 'mon': True }
+        for i in range(1, accounts + 1)
+    ])
+
+    db.session.bulk_insert_mappings(models.RouteRecommendation, [
+        { 'route_id': i, 'day': day, 'date': today + datetime.timedelta(days=day), 'recommendation': models.RIDE_OK }
+        for i in range(1, accounts + 1) for day in range(8)
+    ])
+
+    db.session.bulk_insert_mappings(models.Developer, [
+        { 'user_id': i, 'key': f'key{i}' } for i in range(1, accounts + 1)
+    ])
+
+    db.session.commit()
+
+def count(model):
+    return db.session.query(func.count()).select_from(model).scalar()
+
+def main():
+
+    accounts = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(directory, 'benchmark.db')}"
+
+        with app.app_context():
+
+            db.create_all()
+            seed(accounts)
+
+            statements = []
+
+            def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+                statements.append(statement)
+
+            event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+            start = time.perf_counter()
+            deleted = cascade.purge_unconfirmed(30, batch_size=batch_size, log=lambda message: None)
+            elapsed = time.perf_counter() - start
+
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+            print(f'Purged {deleted} of {accounts} accounts in {elapsed:.2f} s '
+                f'({deleted / elapsed:.0f} accounts/s, {len(statements)} statements, batches of {batch_size})')
+
+            # Everything that belonged to the purged accounts should be gone, and nothing else
+            remaining = accounts - deleted
+            expected = [
+                (models.User, remaining), (models.Location, remaining * 2), (models.Forecast, remaining * 2),
+                (models.ForecastDay, remaining * 16), (models.Route, remaining),
+                (models.RouteRecommendation, remaining * 8), (models.Developer, remaining)
+            ]
+
+            wrong = [(model.__tablename__, count(model), rows) for model, rows in expected if count(model) != rows]
+
+            db.session.remove()
+            db.engine.dispose()
+
+    for table, found, rows in wrong:
+        print(f'{table} has {found} rows, expected {rows}')
+
+    if wrong:
+        sys.exit('The purge left rows behind or deleted too much')
+
+if __name__ == '__main__':
+    main()
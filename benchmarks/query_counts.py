@@ -0,0 +1,141 @@
+
+# Check that the location and route pages run the same number of queries however many rows a user has.
+#
+# Usage: python3 benchmarks/query_counts.py [requests per page]
+#
+# The app is pointed at a scratch SQLite file, and users with 1, 5, 20 and 100
+#   routes (two locations each, with fresh forecasts, so nothing is fetched) are
+#   created directly in the database. For each user, the script counts the
+#   statements sent while loading each page and times the average response.
+#   It exits with an error if the query counts differ between users.
+#   Run it from the project root, with an instance/config.py in place.
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from WeatherToRide import app, db, models
+from WeatherToRide.utils import recommendations
+
+from sqlalchemy import event
+
+import datetime
+
+ROUTE_COUNTS = [1, 5, 20, 100]
+
+def seed(routes):
+
+    user = models.User(name=f'user{routes}', email=f'user{routes}@example.com', password='benchmark')
+    db.session.add(user)
+    db.session.commit()
+
+    # Two locations per route, each with a fresh forecast
+    locations = [
+        models.Location(user_id=user.id, name=f'Location {i}', lat=33.5 + i / 100, lng=-86.8)
+        for i in range(routes * 2)
+    ]
+    db.session.add_all(locations)
+    db.session.commit()
+
+    now = datetime.datetime.now()
+
+    for location in locations:
+        db.session.add(models.Forecast(location_id=location.id, updated_at=now))
+        db.session.add_all([
+            models.ForecastDay(location_id=location.id, day=day, icon='clear-day', summary='Clear throughout the day.', recommendation=models.RIDE_OK)
+            for day in range(8)
+        ])
+
+    # Locations and routes are added directly, since the forms stop at the per-user limits
+    db.session.add_all([
+        models.Route(
+            user_id=user.id, name=f'Route {i}',
+            location_id_1=locations[i * 2].id, location_id_2=locations[i * 2 + 1].id,
+            mon=True, tue=True, wed=True, thu=True, fri=True, sat=True, sun=True
+        )
+        for i in range(routes)
+    ])
+
+    # Store the combined recommendations, as a forecast refresh would
+    recommendations.refresh_locations([x.id for x in locations])
+
+    key = f'benchmark{routes}'
+    db.session.add(models.Developer(user_id=user.id, key=key))
+    db.session.commit()
+
+    return user.id, key
+
+def count_queries(client, url):
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+    if response.status_code != 200:
+        sys.exit(f'{url} returned {response.status_code}')
+
+    return len(statements)
+
+def time_requests(client, url, repeat):
+
+    start = time.perf_counter()
+
+    for _ in range(repeat):
+        client.get(url)
+
+    return (time.perf_counter() - start) / repeat * 1000
+
+def main():
+
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(directory, 'benchmark.db')}"
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        results = {}
+
+        with app.app_context():
+
+            db.create_all()
+
+            users = { routes: seed(routes) for routes in ROUTE_COUNTS }
+
+            for routes, (user_id, key) in users.items():
+
+                client = app.test_client()
+
+                with client.session_transaction() as session:
+                    session['_user_id'] = str(user_id)
+                    session['_fresh'] = True
+
+                # Every row on one page, so that the API listings aren't split by API_PAGE_SIZE
+                pages = ['/locations', f'/api/{key}/locations?limit=1000', '/routes', f'/api/{key}/routes?limit=1000']
+
+                results[routes] = [(count_queries(client, url), time_requests(client, url, repeat)) for url in pages]
+
+            db.session.remove()
+            db.engine.dispose()
+
+    print('locations routes | /locations        | /api/<key>/locations | /routes           | /api/<key>/routes')
+
+    for routes, pages in results.items():
+        print(f'{routes * 2:>9} {routes:>6} | ' + ' | '.join(f'{queries:>2} queries {ms:6.1f} ms' for queries, ms in pages))
+
+    if len({ tuple(queries for queries, ms in pages) for pages in results.values() }) > 1:
+        sys.exit('The number of queries depends on the number of locations or routes')
+
+if __name__ == '__main__':
+    main()
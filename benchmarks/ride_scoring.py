@@ -0,0 +1,108 @@
+# Time the numeric ride scoring over many location-days, against scoring each day in a Python loop.
+#
+# Usage: python3 benchmarks/ride_scoring.py [location-days]
+#
+# Random daily forecasts (with about 5% of the values missing) are scored three
+#   ways: scoring.score over arrays, scoring.score_rows over ForecastDay dicts
+#   (the way forecasts are saved), and one day at a time in plain Python. The
+#   script checks that all three agree. Run it from the project root, with an
+#   instance/config.py in place.
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from WeatherToRide import app
+from WeatherToRide.utils import scoring
+
+import numpy
+
+# A plausible range for each field
+RANGES = {
+    'precip_probability': (0, 1),
+    'precip_intensity': (0, 0.2),
+    'wind_speed': (0, 35),
+    'wind_gust': (0, 55),
+    'temperature_high': (20, 110),
+    'temperature_low': (0, 80),
+    'visibility': (0, 10)
+}
+
+def generate(size, seed=1):
+
+    random = numpy.random.default_rng(seed)
+
+    columns = {}
+    for field, (low, high) in RANGES.items():
+        values = random.uniform(low, high, size)
+        values[random.random(size) < 0.05] = numpy.nan
+        columns[field] = values
+
+    icons = random.choice([0, 1, 2, numpy.nan], size, p=[0.6, 0.2, 0.15, 0.05])
+
+    return columns, icons
+
+def score_loop(rows):
+
+    # The same rules, one day and one field at a time
+    levels = []
+
+    for row in rows:
+
+        level = row['recommendation']
+
+        for thresholds, higher in ((app.config['RIDE_MAX_THRESHOLDS'], True), (app.config['RIDE_MIN_THRESHOLDS'], False)):
+            for field, (warn, danger) in thresholds.items():
+
+                value = row[field]
+                if value is None:
+                    continue
+
+                if higher:
+                    field_level = 2 if value >= danger else 1 if value >= warn else 0
+                else:
+                    field_level = 2 if value <= danger else 1 if value <= warn else 0
+
+                level = field_level if level is None else max(level, field_level)
+
+        levels.append(level)
+
+    return levels
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+def main():
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    columns, icons = generate(size)
+
+    # The same days as ForecastDay dicts, with None for missing values
+    rows = [
+        dict({ field: None if numpy.isnan(v) else float(v) for field, v in zip(columns, values) }, recommendation=None if numpy.isnan(icon) else int(icon))
+        for *values, icon in zip(*columns.values(), icons)
+    ]
+
+    with app.app_context():
+
+        levels, array_ms = timed(scoring.score, columns, icons)
+        expected, loop_ms = timed(score_loop, [dict(x) for x in rows])
+        scored, rows_ms = timed(scoring.score_rows, rows)
+
+    levels = [None if numpy.isnan(x) else int(x) for x in levels]
+
+    assert levels == expected == [x['recommendation'] for x in scored], 'The scores do not agree'
+
+    print(f'{size} location-days')
+    print(f'  arrays (score)            {array_ms:9.1f} ms')
+    print(f'  ForecastDay dicts (score_rows) {rows_ms:4.1f} ms')
+    print(f'  Python loop               {loop_ms:9.1f} ms')
+    print('  levels: ' + ', '.join(f'{level}: {expected.count(level)}' for level in (0, 1, 2, None)))
+
+if __name__ == '__main__':
+    main()
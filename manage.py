@@ -0,0 +1,66 @@
+# This file runs maintenance tasks against the configured database.
+#
+#   python3 manage.py upgrade         Bring the schema up to date (creates it if the database is empty)
+#   python3 manage.py history         List the migrations and when each one was applied
+#   python3 manage.py check-plans     Fail if a hot query does a full table scan
+#   python3 manage.py purge-unconfirmed --days N
+#                                     Delete accounts that haven't confirmed their e-mail in N days
+
+import argparse
+import sys
+
+from WeatherToRide import app
+from WeatherToRide import migrations
+from WeatherToRide.migrations import plans
+from WeatherToRide.utils import cascade
+
+def upgrade(args):
+	version = migrations.upgrade(target=args.target)
+	print(f'The schema is at version {version} (newest is {migrations.head()})')
+
+def history(args):
+	for version, description, applied_at in migrations.history():
+		print(f"{version:>4}  {str(applied_at or 'pending'):<26}  {description}")
+
+def check_plans(args):
+
+	scans = plans.check(log=print if args.verbose else lambda message: None)
+
+	for name, table, detail in scans:
+		print(f'Full scan of {table} in {name}: {detail}')
+
+	if scans:
+		sys.exit(1)
+
+	print('No hot query scans a whole table')
+
+def purge_unconfirmed(args):
+	deleted = cascade.purge_unconfirmed(args.days, batch_size=args.batch_size, log=print)
+	print(f'Deleted {deleted} accounts that were not confirmed within {args.days} days')
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='WeatherToRide maintenance tasks.')
+	commands = parser.add_subparsers(dest='command')
+	commands.required = True
+
+	command = commands.add_parser('upgrade', help='Bring the database schema up to date')
+	command.add_argument('--target', type=int, help='Stop at this schema version')
+	command.set_defaults(run=upgrade)
+
+	command = commands.add_parser('history', help='List the schema migrations')
+	command.set_defaults(run=history)
+
+	command = commands.add_parser('check-plans', help='Fail if a hot query does a full table scan')
+	command.add_argument('--verbose', action='store_true', help='Show the plan for every query')
+	command.set_defaults(run=check_plans)
+
+	command = commands.add_parser('purge-unconfirmed', help='Delete old accounts whose e-mail was never confirmed')
+	command.add_argument('--days', type=int, required=True, help='How old an unconfirmed account has to be')
+	command.add_argument('--batch-size', type=int, default=1000, help='How many accounts to delete per transaction')
+	command.set_defaults(run=purge_unconfirmed)
+
+	args = parser.parse_args()
+
+	with app.app_context():
+		args.run(args)
@@ -34,6 +34,9 @@ sudo pip3 install -r ${PROJECT_FOLDER}/requirements.txt
 sudo apt-get -y install libapache2-mod-wsgi-py3
 sudo a2enmod wsgi
 
+# Enable mod_proxy (the developer JSON API is passed on to serve_api.py)
+sudo a2enmod proxy proxy_http
+
 # Copy the new VirtualHost file to the appropriate location
 sudo cp ${PROJECT_FOLDER}/${PROJECT_NAME}.conf /etc/apache2/sites-available/${PROJECT_NAME}.conf
 
@@ -44,4 +47,14 @@ sudo a2ensite ${PROJECT_NAME}.conf
 # Restart Apache
 sudo service apache2 restart
 
+# Install and start the background worker (forecast refresher)
+sudo cp ${PROJECT_FOLDER}/${PROJECT_NAME}-worker.service /etc/systemd/system/${PROJECT_NAME}-worker.service
+sudo systemctl daemon-reload
+sudo systemctl enable --now ${PROJECT_NAME}-worker
+
+# Install and start the asyncio server for the developer JSON API
+sudo cp ${PROJECT_FOLDER}/${PROJECT_NAME}-api.service /etc/systemd/system/${PROJECT_NAME}-api.service
+sudo systemctl daemon-reload
+sudo systemctl enable --now ${PROJECT_NAME}-api
+
 echo "Finished provisioning system!"
\ No newline at end of file
@@ -1,17 +1,26 @@
 
 # This file should only be used to launch the development server.
 
-from WeatherToRide import app, db
+import os
+
+from WeatherToRide import app, migrations
+from WeatherToRide.utils import outbox, refresher
 
 if __name__ == '__main__':
 
-	# Create the DB tables if they don't already exist
-	db.create_all()
+	# Create the DB tables, or bring them up to date
+	with app.app_context():
+		migrations.upgrade()
 
 	# Configure the development environment
 	app.config['ENV'] = 'development'
 	app.config['TESTING'] = True
 	app.debug = True
 
+	# Keep forecasts fresh and send queued e-mails from background threads (only in the reloader's child process)
+	if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+		refresher.start_thread()
+		outbox.start_thread()
+
 	# Run the development server
 	app.run(host='0.0.0.0', port=5000)
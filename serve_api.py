@@ -0,0 +1,19 @@
+
+# This file launches the asyncio server for the developer JSON API (/api/...).
+#
+# The HTML views are still served by mod_wsgi (or run.py). In production, Apache
+#   passes /api requests on to this server (see WeatherToRide.conf).
+
+import logging
+import sys
+
+from aiohttp import web
+
+from WeatherToRide import app, asyncapi
+
+if __name__ == '__main__':
+
+	logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+	# Serve the API until the process is stopped
+	web.run_app(asyncapi.create_app(), host=app.config['ASYNC_API_HOST'], port=app.config['ASYNC_API_PORT'])
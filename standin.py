@@ -0,0 +1,195 @@
+
+# This file launches a local stand-in for the Dark Sky, Google Geocoding and SendGrid APIs.
+#
+# Point the app at it from instance/config.py:
+#
+#   DARKSKY_URL = 'http://localhost:5001'
+#   GOOGLE_GEOCODE_URL = 'http://localhost:5001/maps/api/geocode/json'
+#   SENDGRID_URL = 'http://localhost:5001'
+#
+# In 'record' mode, requests are passed through to the real providers and each
+#   response is saved to the recordings folder. In 'replay' mode (the default),
+#   saved responses are served back without any network access. Requests that
+#   weren't recorded get a random recording from the same provider, or a
+#   built-in canned response if nothing was recorded.
+#
+# Latency, jitter, error rate and a daily quota can be set to mimic the real
+#   providers under load. See 'python3 standin.py --help'.
+
+from flask import Flask, abort, jsonify, request
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
+import requests
+
+upstreams = {
+    'darksky': 'https://api.darksky.net',
+    'geocode': 'https://maps.googleapis.com',
+    'sendgrid': 'https://api.sendgrid.com'
+}
+
+# Used when nothing has been recorded for a provider
+canned = {
+    'darksky': {
+        'daily': {
+            'data': [
+                { 'time': 0, 'icon': icon, 'summary': summary }
+                for icon, summary in [
+                    ('clear-day', 'Clear throughout the day.'),
+                    ('partly-cloudy-day', 'Partly cloudy in the morning.'),
+                    ('rain', 'Light rain starting in the afternoon.'),
+                    ('wind', 'Breezy until afternoon.'),
+                    ('cloudy', 'Overcast throughout the day.'),
+                    ('clear-day', 'Clear throughout the day.'),
+                    ('snow', 'Light snow (< 1 in.) overnight.'),
+                    ('fog', 'Foggy in the morning.')
+                ]
+            ]
+        }
+    },
+    'geocode': {
+        'status': 'OK',
+        'results': [ { 'geometry': { 'location': { 'lat': 33.502, 'lng': -86.806 } } } ]
+    }
+}
+
+app = Flask(__name__)
+
+settings = None
+calls = {}
+calls_lock = threading.Lock()
+
+def recording_path(provider, key):
+    digest = hashlib.sha1(key.encode()).hexdigest()
+    return os.path.join(settings.recordings, provider, f'{digest}.json')
+
+def simulate(provider):
+
+    """
+
+    Apply the configured latency, jitter, errors and quota to a request.
+
+    Returns:
+        A (body, status) error response, or None if the request should go through
+
+    """
+
+    delay = settings.latency + random.uniform(-settings.jitter, settings.jitter)
+    time.sleep(max(delay, 0) / 1000)
+
+    with calls_lock:
+
+        # The quota starts over every day, like the real ones
+        if calls.get('day') != time.strftime('%Y-%m-%d'):
+            calls.clear()
+            calls['day'] = time.strftime('%Y-%m-%d')
+
+        calls[provider] = calls.get(provider, 0) + 1
+        count = calls[provider]
+
+    if settings.quota and count > settings.quota:
+        return jsonify({ 'error': 'daily usage limit exceeded' }), 429
+
+    if random.random() < settings.error_rate:
+        return jsonify({ 'error': 'simulated upstream error' }), 500
+
+    return None
+
+def serve(provider, key, path):
+
+    error = simulate(provider)
+    if error:
+        return error
+
+    return respond(provider, key, path)
+
+def respond(provider, key, path):
+
+    # Record: pass the request through (the query string is sent as params) and save the response
+    if settings.mode == 'record':
+
+        response = requests.request(
+            request.method,
+            upstreams[provider] + path,
+            params=request.args,
+            data=request.get_data(),
+            headers={ k: v for k, v in request.headers if k.lower() in ('authorization', 'content-type') }
+        )
+
+        if response.ok and response.content:
+            destination = recording_path(provider, key)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            with open(destination, 'w') as f:
+                json.dump(response.json(), f)
+
+        return response.content, response.status_code, { 'Content-Type': response.headers.get('Content-Type', 'application/json') }
+
+    # Replay: the exact recording, any recording from this provider, or the canned response
+    source = recording_path(provider, key)
+
+    if not os.path.exists(source):
+        folder = os.path.dirname(source)
+        recorded = os.listdir(folder) if os.path.isdir(folder) else []
+        source = os.path.join(folder, random.choice(recorded)) if recorded else None
+
+    if source:
+        with open(source) as f:
+            return jsonify(json.load(f))
+
+    if provider in canned:
+        return jsonify(canned[provider])
+
+    abort(404)
+
+@app.route('/forecast/<key>/<coordinates>')
+def darksky(key, coordinates):
+    return serve('darksky', coordinates, request.path)
+
+@app.route('/maps/api/geocode/json')
+def geocode():
+    return serve('geocode', request.args.get('address', '').strip().lower(), request.path)
+
+@app.route('/v3/mail/send', methods=['POST'])
+def sendgrid():
+
+    error = simulate('sendgrid')
+    if error:
+        return error
+
+    if settings.mode == 'record':
+        return respond('sendgrid', request.get_data(as_text=True), request.path)
+
+    # SendGrid accepts mail with an empty 202
+    return '', 202
+
+@app.route('/_standin/stats')
+def stats():
+    with calls_lock:
+        return jsonify(calls)
+
+def parse_args():
+
+    parser = argparse.ArgumentParser(description='Local stand-in for the third-party APIs used by WeatherToRide.')
+    parser.add_argument('--mode', choices=['replay', 'record'], default='replay')
+    parser.add_argument('--recordings', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recordings'),
+        help='Folder for recorded responses')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--latency', type=float, default=0, help='Mean added latency (ms)')
+    parser.add_argument('--jitter', type=float, default=0, help='Random +/- variation in latency (ms)')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of requests that fail with a 500 (0-1)')
+    parser.add_argument('--quota', type=int, default=0, help='Calls per provider per day before answering 429 (0 for no limit)')
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+
+    settings = parse_args()
+
+    # Threaded, so that slow (simulated) responses don't queue up behind each other
+    app.run(host='0.0.0.0', port=settings.port, threaded=True)
@@ -0,0 +1,78 @@
+# Tests for standin.py (run from the project root: python3 -m unittest discover tests)
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+import standin
+
+class RecordModeTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.recordings = tempfile.TemporaryDirectory()
+
+        standin.settings = argparse.Namespace(mode='record', recordings=self.recordings.name,
+            latency=0, jitter=0, error_rate=0, quota=0)
+
+        self.sent = []
+
+    def tearDown(self):
+        self.recordings.cleanup()
+
+    def upstream(self, prepared, **kwargs):
+
+        # Answer in place of the real provider, keeping the request as it would have gone out
+        self.sent.append(prepared)
+
+        response = requests.Response()
+        response.status_code = 200
+        response.headers['Content-Type'] = 'application/json'
+        response._content = json.dumps(standin.canned['geocode']).encode()
+        response.url = prepared.url
+
+        return response
+
+    def get(self, url):
+        with mock.patch.object(requests.adapters.HTTPAdapter, 'send', lambda adapter, prepared, **kwargs: self.upstream(prepared)):
+            return standin.app.test_client().get(url)
+
+    def test_geocode_query_is_sent_once(self):
+
+        response = self.get('/maps/api/geocode/json?address=1+Main+St&key=secret')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.sent), 1)
+
+        url = urlsplit(self.sent[0].url)
+
+        self.assertEqual(f'{url.scheme}://{url.netloc}{url.path}', 'https://maps.googleapis.com/maps/api/geocode/json')
+        self.assertEqual(parse_qs(url.query), { 'address': ['1 Main St'], 'key': ['secret'] })
+
+    def test_darksky_query_is_sent_once(self):
+
+        self.get('/forecast/secret/33.5,-86.8?exclude=minutely&units=us')
+
+        url = urlsplit(self.sent[0].url)
+
+        self.assertEqual(url.path, '/forecast/secret/33.5,-86.8')
+        self.assertEqual(parse_qs(url.query), { 'exclude': ['minutely'], 'units': ['us'] })
+
+    def test_response_is_recorded(self):
+
+        self.get('/maps/api/geocode/json?address=1+Main+St&key=secret')
+
+        with open(standin.recording_path('geocode', '1 main st')) as f:
+            self.assertEqual(json.load(f), standin.canned['geocode'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+# Tests for WeatherToRide/utils/weather.py (run from the project root, with an instance/config.py in place)
+
+import decimal
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from WeatherToRide import app
+from WeatherToRide.utils import weather
+
+class GridCellTest(unittest.TestCase):
+
+    def setUp(self):
+        self.size = app.config['FORECAST_GRID_SIZE']
+
+    def tearDown(self):
+        app.config['FORECAST_GRID_SIZE'] = self.size
+
+    def assertInCell(self, lat, lng):
+
+        # The same comparison as the neighbors query in update_forecasts, on the values a DECIMAL(10, 6) column holds
+        min_lat, min_lng, max_lat, max_lng = (decimal.Decimal(str(x)) for x in weather.cell_bounds(weather.grid_cell(lat, lng)))
+        lat, lng = decimal.Decimal(str(lat)), decimal.Decimal(str(lng))
+
+        self.assertTrue(min_lat <= lat < max_lat and min_lng <= lng < max_lng, f'({lat}, {lng}) is outside of its grid cell')
+
+    def test_coordinates_on_cell_edges(self):
+
+        for size in (0.1, 0.05, 0.01):
+            with self.subTest(size=size):
+
+                app.config['FORECAST_GRID_SIZE'] = size
+
+                # Every edge between -90 and 90 degrees
+                for i in range(-round(90 / size), round(90 / size)):
+                    edge = round(i * size, 6)
+                    self.assertInCell(edge, -edge)
+
+    def test_edge_belongs_to_the_cell_above(self):
+
+        app.config['FORECAST_GRID_SIZE'] = 0.1
+
+        # 0.3 / 0.1 is 2.9999999999999996 as a float
+        self.assertEqual(weather.grid_cell(0.3, -0.3), (3, -3))
+        self.assertEqual(weather.grid_cell(decimal.Decimal('0.300000'), decimal.Decimal('-0.300000')), (3, -3))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,19 @@
+
+# This file launches the background worker that keeps forecasts fresh and sends queued e-mails.
+
+import logging
+import sys
+
+from WeatherToRide import app
+from WeatherToRide.utils import outbox, refresher
+
+if __name__ == '__main__':
+
+	logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+	# Send queued e-mails from a background thread
+	outbox.start_thread()
+
+	# Refresh forecasts until the process is stopped
+	with app.app_context():
+		refresher.ForecastRefresher().run_forever()